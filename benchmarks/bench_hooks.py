@@ -0,0 +1,384 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Scale benchmarks of the config generation of the hooks, on synthetic
+# topologies of services, reverseproxy units and peers, with the hook tools
+# mocked out.
+#
+# Each phase is run in a forked process, so that its peak memory can be
+# measured on its own, and the best time of the repeats is kept. Results
+# are compared against a stored baseline to catch regressions:
+#
+#   make benchmark
+#   make benchmark BENCHMARK_ARGS="--save-baseline"
+#   make benchmark BENCHMARK_ARGS="--scenario 1000x100-peers --repeat 5"
+
+import copy
+import gc
+import json
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+
+import yaml
+
+from mock import patch
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(CHARM_DIR, "hooks"))
+os.environ.setdefault("CHARM_DIR", CHARM_DIR)
+
+import hooks  # noqa
+
+DEFAULT_BASELINE = os.path.join(CHARM_DIR, "benchmarks", "baseline.json")
+
+# Scenarios as tuples of (units, services, peers).
+SCENARIOS = [
+    (1, 1, 0),
+    (100, 10, 0),
+    (100, 10, 2),
+    (1000, 100, 0),
+    (1000, 100, 2),
+    (5000, 500, 0),
+    (5000, 500, 2),
+    ]
+
+PHASES = ("parse_services_yaml", "create_services", "apply_peer_config",
+          "write_service_config", "construct_haproxy_config")
+
+# Regressions below this many seconds, or kilobytes, are ignored as noise.
+MIN_TIME_REGRESSION = 0.01
+MIN_MEMORY_REGRESSION = 1024
+
+
+def scenario_name(units, services, peers):
+    name = "%dx%d" % (units, services)
+    if peers:
+        name += "-peers"
+    return name
+
+
+def load_config_defaults():
+    with open(os.path.join(CHARM_DIR, "config.yaml")) as f:
+        options = yaml.safe_load(f)["options"]
+    return dict((name, option.get("default"))
+                for name, option in options.iteritems())
+
+
+def build_topology(units, services, peers):
+    """
+    Return the services YAML, reverseproxy relation data and peer relation
+    data of a synthetic topology. Units are spread evenly across services,
+    one in ten services leave their port to be allocated, and each peer
+    publishes all the services.
+    """
+    service_list = []
+    for index in range(services):
+        service = {
+            "service_name": "service%d" % index,
+            "service_host": "0.0.0.0",
+            "service_options": ["mode http", "balance leastconn",
+                                "timeout server 60000"],
+            "server_options": "check inter 2000 rise 2 fall 5 maxconn 100",
+            }
+        if index % 10:
+            service["service_port"] = 10000 + index * 2
+        service_list.append(service)
+    services_yaml = yaml.safe_dump(service_list)
+
+    reverseproxy = []
+    for index in range(units):
+        reverseproxy.append({
+            "__unit__": "app%d/%d" % (index % services, index),
+            "__relid__": "reverseproxy:%d" % (index % services),
+            "service_name": "service%d" % (index % services),
+            "private-address": "10.%d.%d.%d" % (
+                index >> 16, (index >> 8) & 255, index & 255),
+            "port": "8080",
+            })
+
+    all_services = yaml.safe_dump([
+        {"service_name": published["service_name"],
+         "service_host": "0.0.0.0",
+         "service_port": published.get("service_port", 20000 + index)}
+        for index, published in enumerate(service_list)])
+    peer = [{"__unit__": "haproxy/%d" % (index + 1),
+             "__relid__": "peer:0",
+             "private-address": "10.255.0.%d" % (index + 1),
+             "all_services": all_services}
+            for index in range(peers)]
+    return services_yaml, reverseproxy, peer
+
+
+class Environment(object):
+    """
+    The hook tools and paths of the hooks, mocked out to serve the given
+    services YAML, relation data and config options.
+    """
+
+    def __init__(self, services_yaml, reverseproxy, peer, config=None):
+        self.services_yaml = services_yaml
+        self.reverseproxy = reverseproxy
+        self.peer = peer
+        self.config = load_config_defaults()
+        self.config.update(config or {})
+        self.config["services"] = self.services_yaml
+        self.charm_state = {}
+        self.patchers = []
+
+    def relations_of_type(self, relation_type):
+        return {"reverseproxy": self.reverseproxy,
+                "peer": self.peer}.get(relation_type, [])
+
+    def config_get(self, key=None):
+        if key is None:
+            return self.config
+        return self.config.get(key)
+
+    def load_charm_state(self, key, default=None):
+        return copy.deepcopy(self.charm_state.get(key, default))
+
+    def save_charm_state(self, key, value):
+        self.charm_state[key] = copy.deepcopy(value)
+
+    def __enter__(self):
+        self.work_dir = tempfile.mkdtemp()
+        service_dir = os.path.join(self.work_dir, "services")
+        os.mkdir(service_dir)
+        for name, value in (
+                ("config_get", self.config_get),
+                ("relations_of_type", self.relations_of_type),
+                ("load_charm_state", self.load_charm_state),
+                ("save_charm_state", self.save_charm_state),
+                ("unit_get", lambda attribute: "10.255.0.0"),
+                ("log", lambda *args, **kwargs: None),
+                ("default_haproxy_service_config_dir", service_dir),
+                ("default_haproxy_lib_dir", self.work_dir),
+                ("default_haproxy_config",
+                 os.path.join(self.work_dir, "haproxy.cfg"))):
+            patcher = patch.object(hooks, name, value)
+            patcher.start()
+            self.patchers.append(patcher)
+        patcher = patch.dict(os.environ, {"JUJU_UNIT_NAME": "haproxy/0"})
+        patcher.start()
+        self.patchers.append(patcher)
+        return self
+
+    def __exit__(self, *exc_info):
+        for patcher in reversed(self.patchers):
+            patcher.stop()
+        del self.patchers[:]
+        shutil.rmtree(self.work_dir)
+
+
+def get_phases(environment):
+    """
+    Return each phase as a tuple of (name, setup, function), 'setup'
+    returning the arguments of 'function', built outside of the measured
+    time and memory.
+    """
+
+    def parsed_services():
+        services = hooks.parse_services_yaml({}, environment.services_yaml)
+        del services[None]
+        services = hooks.ensure_service_host_port(services)
+        for service in services.values():
+            service.setdefault("servers", [])
+        return (services,)
+
+    def created_services():
+        return (hooks.create_services(),)
+
+    def sections():
+        hooks.create_services()
+        return (hooks.create_haproxy_globals(),
+                hooks.create_haproxy_defaults(), None,
+                hooks.load_services())
+
+    return [
+        ("parse_services_yaml", lambda: ({}, environment.services_yaml),
+         hooks.parse_services_yaml),
+        ("create_services", tuple, hooks.create_services),
+        ("apply_peer_config", parsed_services, hooks.apply_peer_config),
+        ("write_service_config", created_services,
+         hooks.write_service_config),
+        ("construct_haproxy_config", sections,
+         hooks.construct_haproxy_config),
+        ]
+
+
+def read_memory_status():
+    """Return the current and peak resident memory, in kilobytes."""
+    status = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                status[name] = int(value.split()[0])
+    return status["VmRSS"], status["VmHWM"]
+
+
+def reset_peak_memory():
+    """Reset the peak resident memory of this process, where supported."""
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except IOError:
+        pass
+
+
+def measure(setup, function):
+    """
+    Run a function in a forked process, returning the time it took, in
+    seconds, and the memory it added at its peak, in kilobytes. Forking
+    keeps the phases from reusing memory freed by the previous ones.
+    """
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        status = 0
+        try:
+            args = setup()
+            gc.collect()
+            reset_peak_memory()
+            rss, _ = read_memory_status()
+            start = time.time()
+            function(*args)
+            duration = time.time() - start
+            _, peak = read_memory_status()
+            os.write(write_end, json.dumps([duration, max(0, peak - rss)]))
+        except BaseException:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os._exit(status)
+    os.close(write_end)
+    output = ""
+    while True:
+        data = os.read(read_end, 4096)
+        if not data:
+            break
+        output += data
+    os.close(read_end)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("Benchmark process failed")
+    return json.loads(output)
+
+
+def run_scenario(units, services, peers, repeat):
+    results = {}
+    topology = build_topology(units, services, peers)
+    with Environment(*topology) as environment:
+        for phase, setup, function in get_phases(environment):
+            measures = [measure(setup, function) for _ in range(repeat)]
+            results[phase] = {
+                "seconds": round(min(duration for duration, _ in measures),
+                                 6),
+                "peak_kb": max(peak for _, peak in measures),
+                }
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Return the regressions of the results against the baseline, as
+    messages, a phase regressing when it got slower, or used more memory,
+    by more than the tolerance ratio.
+    """
+    regressions = []
+    for scenario, phases in sorted(results.iteritems()):
+        for phase, result in sorted(phases.iteritems()):
+            reference = baseline.get(scenario, {}).get(phase)
+            if reference is None:
+                continue
+            for metric, unit, scale, minimum in (
+                    ("seconds", "s", 1, MIN_TIME_REGRESSION),
+                    ("peak_kb", "MB", 1024.0, MIN_MEMORY_REGRESSION)):
+                allowed = max(reference[metric] * (1 + tolerance),
+                              reference[metric] + minimum)
+                if result[metric] > allowed:
+                    regressions.append("%s %s: %.3f%s, baseline %.3f%s" % (
+                        scenario, phase, result[metric] / scale, unit,
+                        reference[metric] / scale, unit))
+    return regressions
+
+
+def format_results(results, baseline):
+    lines = ["%-18s %-26s %10s %10s %10s" % (
+        "scenario", "phase", "seconds", "baseline", "peak MB")]
+    for scenario, phases in sorted(
+            results.iteritems(),
+            key=lambda item: [int(part) for part in
+                              item[0].split("-")[0].split("x")] + [item[0]]):
+        for phase in PHASES:
+            result = phases[phase]
+            reference = baseline.get(scenario, {}).get(phase)
+            lines.append("%-18s %-26s %10.4f %10s %10.1f" % (
+                scenario, phase, result["seconds"],
+                "-" if reference is None else "%.4f" % reference["seconds"],
+                result["peak_kb"] / 1024.0))
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--scenario", action="append", default=[],
+                      help="scenario to run, e.g. 1000x100 or "
+                      "1000x100-peers (all by default)")
+    parser.add_option("-r", "--repeat", type="int", default=3,
+                      help="runs of each phase, the best time being kept")
+    parser.add_option("-b", "--baseline", default=DEFAULT_BASELINE,
+                      help="baseline to compare the results against")
+    parser.add_option("--save-baseline", action="store_true",
+                      default=False, help="save the results as the baseline")
+    parser.add_option("-t", "--tolerance", type="float", default=0.25,
+                      help="slowdown ratio over the baseline tolerated")
+    options, _ = parser.parse_args(args)
+
+    scenarios = SCENARIOS
+    if options.scenario:
+        scenarios = [scenario for scenario in SCENARIOS
+                     if scenario_name(*scenario) in options.scenario]
+    if not scenarios:
+        parser.error("Unknown scenario, known ones are: %s" % ", ".join(
+            scenario_name(*scenario) for scenario in SCENARIOS))
+
+    try:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+    except IOError:
+        baseline = {}
+
+    results = {}
+    for units, services, peers in scenarios:
+        results[scenario_name(units, services, peers)] = run_scenario(
+            units, services, peers, options.repeat)
+    print format_results(results, baseline)
+
+    if options.save_baseline:
+        baseline.update(results)
+        with open(options.baseline, "w") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True,
+                      separators=(",", ": "))
+            f.write("\n")
+        return 0
+
+    regressions = compare(results, baseline, options.tolerance)
+    if regressions:
+        print "\nRegressions over %d%% of the baseline:" % (
+            options.tolerance * 100)
+        for regression in regressions:
+            print "  %s" % regression
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,454 @@
+#!/usr/bin/env python3
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Measure the impact of haproxy reloads and runtime updates on traffic.
+#
+# Starts a pool of local dummy HTTP backends, and a real haproxy running the
+# configuration the hooks render for them (see render_config.py). Then it
+# drives sustained traffic through haproxy with an asyncio load generator,
+# while reloading haproxy the way the charm does ('service haproxy reload')
+# or updating servers through the stats socket. Dropped connections, 5xx
+# responses and the latency tail are reported for the window following
+# each operation, against the traffic outside of them:
+#
+#   benchmarks/reload_impact.py --operation reload --reloads 10
+#   benchmarks/reload_impact.py --operation runtime --keepalive
+#
+# It exits with 1 when an operation was not hitless. Requires haproxy, and
+# the Python 2 environment of the hooks to render the configuration.
+
+import argparse
+import asyncio
+import collections
+import grp
+import json
+import os
+import pwd
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+CHARM_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+RESPONSE_BODY = b"ok\n"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+#------------------------------------------------------------------------------
+# Dummy backends
+#------------------------------------------------------------------------------
+class DummyBackend:
+    """HTTP server answering every request with a short 200 response."""
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.requests = 0
+        self.server = None
+        self.port = None
+
+    async def start(self):
+        self.server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = self.server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                try:
+                    head = await reader.readuntil(b"\r\n\r\n")
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    break
+                headers = head.lower()
+                length = 0
+                for line in headers.split(b"\r\n"):
+                    if line.startswith(b"content-length:"):
+                        length = int(line.split(b":", 1)[1])
+                if length:
+                    await reader.readexactly(length)
+                self.requests += 1
+                if self.delay:
+                    await asyncio.sleep(self.delay)
+                close = b"connection: close" in headers
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: text/plain\r\n"
+                    b"Content-Length: %d\r\nConnection: %s\r\n\r\n%s" % (
+                        len(RESPONSE_BODY),
+                        b"close" if close else b"keep-alive",
+                        RESPONSE_BODY))
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+
+#------------------------------------------------------------------------------
+# haproxy
+#------------------------------------------------------------------------------
+def render_config(args, work_dir, backends, service_port):
+    """Render the haproxy configuration of the hooks for the backends."""
+    user = pwd.getpwuid(os.getuid()).pw_name
+    group = grp.getgrgid(os.getgid()).gr_name
+    config = {
+        "global_user": user,
+        "global_group": group,
+        "global_log": "127.0.0.1 local0",
+        "stats_socket_path": os.path.join(work_dir, "stats.sock"),
+        }
+    for override in args.config:
+        key, _, value = override.partition("=")
+        try:
+            config[key] = json.loads(value)
+        except ValueError:
+            config[key] = value
+    spec = {
+        "config": config,
+        "services": [{
+            "service_name": "web",
+            "service_host": "127.0.0.1",
+            "service_port": service_port,
+            "service_options": ["mode http", "balance roundrobin"],
+            "server_options": "check inter 1000 rise 2 fall 3",
+            }],
+        "units": [{
+            "__unit__": "backend/%d" % index,
+            "private-address": "127.0.0.1",
+            "port": str(backend.port),
+            "service_name": "web",
+            } for index, backend in enumerate(backends)],
+        }
+    path = os.path.join(work_dir, "haproxy.cfg")
+    subprocess.run(
+        [args.python2, os.path.join(BENCHMARKS_DIR, "render_config.py"),
+         "--output", path],
+        input=json.dumps(spec).encode(), check=True,
+        env=dict(os.environ, CHARM_DIR=CHARM_DIR))
+    return path, config
+
+
+class HAProxy:
+    """haproxy daemons started and reloaded like the init script does."""
+
+    def __init__(self, binary, config_path, work_dir, config):
+        self.binary = binary
+        self.config_path = config_path
+        self.pid_file = os.path.join(work_dir, "haproxy.pid")
+        self.socket_path = config["stats_socket_path"]
+        self.server_state_file = config.get("server_state_file")
+        self.pids = set()
+
+    def read_pids(self):
+        try:
+            with open(self.pid_file) as f:
+                return [int(pid) for pid in f.read().split()]
+        except (IOError, ValueError):
+            return []
+
+    def start(self, finish=()):
+        command = [self.binary, "-f", self.config_path, "-p", self.pid_file,
+                   "-D"]
+        if finish:
+            command += ["-sf"] + [str(pid) for pid in finish]
+        subprocess.run(command, check=True)
+        self.pids.update(self.read_pids())
+
+    async def reload(self):
+        """Reload as 'service haproxy reload', after saving the state."""
+        if self.server_state_file:
+            state = await self.command("show servers state")
+            with open(self.server_state_file, "w") as f:
+                f.write(state)
+        await asyncio.get_running_loop().run_in_executor(
+            None, lambda: self.start(finish=self.read_pids()))
+
+    async def command(self, command):
+        reader, writer = await asyncio.open_unix_connection(self.socket_path)
+        try:
+            writer.write(command.encode() + b"\n")
+            await writer.drain()
+            return (await reader.read()).decode()
+        finally:
+            writer.close()
+
+    def stop(self):
+        for pid in self.pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+
+#------------------------------------------------------------------------------
+# Load generator
+#------------------------------------------------------------------------------
+class LoadGenerator:
+    """
+    Closed loop load generator, each worker sending requests one after the
+    other, on a new connection for each unless 'keepalive' is set.
+    """
+
+    def __init__(self, port, concurrency, keepalive, timeout):
+        self.port = port
+        self.concurrency = concurrency
+        self.keepalive = keepalive
+        self.timeout = timeout
+        # Tuples of (start time, latency, status or error kind).
+        self.results = []
+        self.running = False
+
+    async def run(self, duration):
+        self.running = True
+        workers = [asyncio.ensure_future(self.worker())
+                   for _ in range(self.concurrency)]
+        await asyncio.sleep(duration)
+        self.running = False
+        await asyncio.gather(*workers)
+
+    async def worker(self):
+        connection = None
+        request = (b"GET / HTTP/1.1\r\nHost: localhost\r\nConnection: %s"
+                   b"\r\n\r\n" % (b"keep-alive" if self.keepalive
+                                  else b"close"))
+        while self.running:
+            start = time.monotonic()
+            try:
+                if connection is None:
+                    connection = await asyncio.wait_for(
+                        asyncio.open_connection("127.0.0.1", self.port),
+                        self.timeout)
+                reader, writer = connection
+                writer.write(request)
+                status, close = await asyncio.wait_for(
+                    self.read_response(reader), self.timeout)
+                outcome = status
+            except asyncio.TimeoutError:
+                outcome, close = "timeout", True
+            except ConnectionRefusedError:
+                outcome, close = "refused", True
+            except ConnectionResetError:
+                outcome, close = "reset", True
+            except (asyncio.IncompleteReadError, ConnectionError, OSError):
+                outcome, close = "closed", True
+            self.results.append((start, time.monotonic() - start, outcome))
+            if connection is not None and (close or not self.keepalive):
+                connection[1].close()
+                connection = None
+        if connection is not None:
+            connection[1].close()
+
+    @staticmethod
+    async def read_response(reader):
+        head = await reader.readuntil(b"\r\n\r\n")
+        lines = head.split(b"\r\n")
+        status = int(lines[0].split()[1])
+        length = 0
+        close = False
+        for line in lines[1:]:
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"content-length":
+                length = int(value)
+            elif name == b"connection":
+                close = value.strip().lower() == b"close"
+        if length:
+            await reader.readexactly(length)
+        return status, close
+
+
+#------------------------------------------------------------------------------
+# Scenario and report
+#------------------------------------------------------------------------------
+async def runtime_update(haproxy, servers, index):
+    """Take a server out and back, as the charm does on updates."""
+    server = servers[index % len(servers)]
+    await haproxy.command("set weight web/%s 0" % server)
+    await asyncio.sleep(0.1)
+    await haproxy.command("set weight web/%s 100" % server)
+
+
+async def drive(args, haproxy, generator, servers):
+    """Run the load while applying the operations, returning them."""
+    load = asyncio.ensure_future(generator.run(
+        args.warmup + args.reloads * args.interval + args.window))
+    events = []
+    await asyncio.sleep(args.warmup)
+    for index in range(args.reloads):
+        operation = args.operation
+        if operation == "both":
+            operation = ("reload", "runtime")[index % 2]
+        start = time.monotonic()
+        if operation == "reload":
+            await haproxy.reload()
+        else:
+            await runtime_update(haproxy, servers, index)
+        events.append((operation, start, time.monotonic() - start))
+        await asyncio.sleep(max(0, args.interval -
+                                (time.monotonic() - start)))
+    await load
+    return events
+
+
+def summarize(results):
+    latencies = [latency for _, latency, _ in results]
+    outcomes = collections.Counter(
+        outcome if isinstance(outcome, str) else "%dxx" % (outcome // 100)
+        for _, _, outcome in results)
+    errors = sum(count for outcome, count in outcomes.items()
+                 if not outcome[0].isdigit())
+    return {
+        "requests": len(results),
+        "errors": errors,
+        "5xx": outcomes.get("5xx", 0),
+        "outcomes": dict(outcomes),
+        "p50_ms": round((percentile(latencies, 0.5) or 0) * 1000, 2),
+        "p99_ms": round((percentile(latencies, 0.99) or 0) * 1000, 2),
+        "max_ms": round(max(latencies or [0]) * 1000, 2),
+        }
+
+
+def analyze(results, events, window):
+    """
+    Split the results into the windows following each event, and the
+    baseline outside of them.
+    """
+    windows = []
+    in_window = set()
+    for operation, start, duration in events:
+        selected = [index for index, result in enumerate(results)
+                    if start <= result[0] + result[1] and
+                    result[0] < start + duration + window]
+        in_window.update(selected)
+        summary = summarize([results[index] for index in selected])
+        summary.update(operation=operation,
+                       duration_ms=round(duration * 1000, 2))
+        windows.append(summary)
+    baseline = summarize([result for index, result in enumerate(results)
+                          if index not in in_window])
+    return baseline, windows
+
+
+def format_report(baseline, windows):
+    lines = ["%-10s %10s %9s %7s %6s %9s %9s %9s" % (
+        "event", "op ms", "requests", "errors", "5xx", "p50 ms", "p99 ms",
+        "max ms")]
+    rows = [("baseline", baseline)] + [
+        ("%s %d" % (window["operation"], index + 1), window)
+        for index, window in enumerate(windows)]
+    for name, summary in rows:
+        lines.append("%-10s %10s %9d %7d %6d %9.2f %9.2f %9.2f" % (
+            name, summary.get("duration_ms", "-"), summary["requests"],
+            summary["errors"], summary["5xx"], summary["p50_ms"],
+            summary["p99_ms"], summary["max_ms"]))
+    for index, window in enumerate(windows):
+        failures = dict((outcome, count)
+                        for outcome, count in window["outcomes"].items()
+                        if outcome != "2xx")
+        if failures:
+            lines.append("%s %d: %s" % (window["operation"], index + 1,
+                                        failures))
+    return "\n".join(lines)
+
+
+async def run(args, work_dir):
+    backends = [DummyBackend(args.backend_delay / 1000.0)
+                for _ in range(args.backends)]
+    for backend in backends:
+        await backend.start()
+    service_port = free_port()
+    config_path, config = render_config(args, work_dir, backends,
+                                        service_port)
+    haproxy = HAProxy(args.haproxy, config_path, work_dir, config)
+    haproxy.start()
+    try:
+        # Let the health checks mark the servers up.
+        await asyncio.sleep(2)
+        servers = ["backend-%d-%d" % (index, backend.port)
+                   for index, backend in enumerate(backends)]
+        generator = LoadGenerator(service_port, args.concurrency,
+                                  args.keepalive, args.timeout)
+        events = await drive(args, haproxy, generator, servers)
+    finally:
+        haproxy.stop()
+        for backend in backends:
+            await backend.stop()
+    return analyze(generator.results, events, args.window)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--operation", default="reload",
+                        choices=("reload", "runtime", "both"),
+                        help="operation whose impact is measured")
+    parser.add_argument("--reloads", type=int, default=5,
+                        help="number of operations")
+    parser.add_argument("--interval", type=float, default=3,
+                        help="seconds between operations")
+    parser.add_argument("--window", type=float, default=1,
+                        help="seconds after an operation attributed to it")
+    parser.add_argument("--warmup", type=float, default=3,
+                        help="seconds of traffic before the first operation")
+    parser.add_argument("--concurrency", type=int, default=50,
+                        help="concurrent clients")
+    parser.add_argument("--keepalive", action="store_true",
+                        help="reuse client connections")
+    parser.add_argument("--timeout", type=float, default=5,
+                        help="seconds before a request times out")
+    parser.add_argument("--backends", type=int, default=4,
+                        help="number of dummy backends")
+    parser.add_argument("--backend-delay", type=float, default=0,
+                        help="milliseconds the backends wait to respond")
+    parser.add_argument("--config", action="append", default=[],
+                        metavar="KEY=VALUE",
+                        help="charm config option to render haproxy with")
+    parser.add_argument("--haproxy", default=shutil.which("haproxy") or
+                        "/usr/sbin/haproxy", help="haproxy binary")
+    parser.add_argument("--python2", default="python2",
+                        help="Python 2 interpreter to render the config")
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.haproxy):
+        parser.error("haproxy not found, set --haproxy")
+
+    work_dir = tempfile.mkdtemp(prefix="haproxy-reload-")
+    try:
+        baseline, windows = asyncio.run(run(args, work_dir))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(format_report(baseline, windows))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"baseline": baseline, "events": windows}, f,
+                      indent=2, sort_keys=True)
+    hitless = all(not window["errors"] and not window["5xx"]
+                  for window in windows)
+    print("\n%s" % ("All operations were hitless" if hitless else
+                    "Some operations dropped or failed requests"))
+    return 0 if hitless else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
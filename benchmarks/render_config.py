@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Render an haproxy configuration with the hooks, the way config-changed
+# does, from a JSON description of the charm config and reverseproxy units
+# read on stdin:
+#
+#   {"config": {"global_user": "...", ...},
+#    "services": [{"service_name": "web", ...}],
+#    "units": [{"__unit__": "backend/0", "private-address": "127.0.0.1",
+#               "port": "8080", "service_name": "web"}]}
+#
+# This lets tools outside of a unit, such as the reload impact harness, run
+# haproxy with the configuration the charm would generate.
+
+import json
+import optparse
+import sys
+
+import yaml
+
+from mock import patch
+
+from bench_hooks import Environment, hooks
+
+
+def render_config(spec, output):
+    services_yaml = yaml.safe_dump(spec.get("services", []))
+    with Environment(services_yaml, spec.get("units", []), [],
+                     spec.get("config")):
+        with patch.object(hooks, "default_haproxy_config", output):
+            if not hooks.create_services():
+                raise ValueError("No services to render")
+            config_data = hooks.config_get()
+            haproxy_monitoring = None
+            if config_data['enable_monitoring'] is True:
+                haproxy_monitoring = hooks.create_monitoring_stanza()
+            hooks.construct_haproxy_config(
+                hooks.create_haproxy_globals(),
+                hooks.create_haproxy_defaults(),
+                haproxy_monitoring,
+                hooks.load_services(),
+                hooks.create_haproxy_resolvers())
+
+
+def main(args=None):
+    parser = optparse.OptionParser(usage="%prog [options] < spec.json")
+    parser.add_option("-o", "--output", default="haproxy.cfg",
+                      help="path of the configuration to write")
+    options, _ = parser.parse_args(args)
+    try:
+        render_config(json.load(sys.stdin), options.output)
+    except ValueError, e:
+        sys.stderr.write("%s\n" % e)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,489 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Follow the haproxy log and keep per-backend and per-server latency
+# percentiles and status code rates over a sliding window, periodically
+# writing a summary for the Nagios checks.
+#
+# Lines in the 'option httplog' and 'option tcplog' formats, as well as in
+# the "json", "extended-clf" and "timing-only" formats of the charm
+# 'log_format' option, are recognized line by line, so frontends with
+# different formats can share a log.
+
+import json
+import math
+import optparse
+import os
+import sys
+import time
+
+from collections import deque
+
+STATUS_CLASSES = ("1xx", "2xx", "3xx", "4xx", "5xx", "other")
+
+
+class LatencySketch(object):
+    """
+    Mergeable quantile sketch with a bounded relative error, keeping counts
+    of values in logarithmically sized buckets (as in DDSketch). Sketches
+    built on different slots of a window, or for different servers, are
+    merged by adding their bucket counts.
+    """
+
+    # Bucket of each integer value seen so far, per relative accuracy.
+    # Latencies being integer milliseconds, this saves computing a logarithm
+    # for most values.
+    _key_caches = {}
+
+    def __init__(self, relative_accuracy=0.01, max_buckets=2048):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_buckets = max_buckets
+        self._key_cache = self._key_caches.setdefault(relative_accuracy, {})
+        self.buckets = {}
+        self.zeros = 0
+        self.count = 0
+        self.total = 0
+
+    def key(self, value):
+        key = self._key_cache.get(value)
+        if key is None:
+            key = int(math.ceil(math.log(value) / self.log_gamma))
+            if len(self._key_cache) < 1000000:
+                self._key_cache[value] = key
+        return key
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value <= 0:
+            self.zeros += 1
+            return
+        # The cache lookup is inlined, this being the hot path.
+        key = self._key_cache.get(value)
+        if key is None:
+            key = self.key(value)
+        buckets = self.buckets
+        buckets[key] = buckets.get(key, 0) + 1
+        if len(buckets) > self.max_buckets:
+            self.collapse()
+
+    def collapse(self):
+        """Fold the lowest buckets together to bound memory."""
+        keys = sorted(self.buckets)
+        excess = len(keys) - self.max_buckets + 1
+        folded = sum(self.buckets.pop(key) for key in keys[:excess])
+        target = keys[excess]
+        self.buckets[target] = self.buckets[target] + folded
+
+    def merge(self, other):
+        buckets = self.buckets
+        for key, count in other.buckets.iteritems():
+            buckets[key] = buckets.get(key, 0) + count
+        self.zeros += other.zeros
+        self.count += other.count
+        self.total += other.total
+        while len(buckets) > self.max_buckets:
+            self.collapse()
+
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zeros
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if seen > rank:
+                # Middle of the bucket, within the relative accuracy.
+                return 2 * self.gamma ** key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def mean(self):
+        if not self.count:
+            return None
+        return float(self.total) / self.count
+
+
+#------------------------------------------------------------------------------
+# Log parsing. Each parser returns a tuple of
+# (backend, server, total time, response time, status), times being None
+# when not available (-1 in the log), and status None for TCP lines.
+#------------------------------------------------------------------------------
+def to_int(value):
+    try:
+        value = int(value)
+    except ValueError:
+        return None
+    if value < 0:
+        return None
+    return value
+
+
+def parse_status(value):
+    try:
+        return int(value)
+    except ValueError:
+        return None
+
+
+def parse_haproxy_log(message):
+    """
+    Parse the 'option httplog' and 'option tcplog' formats:
+    client:port [date] frontend backend/server Tq/Tw/Tc/Tr/Tt status bytes...
+    client:port [date] frontend backend/server Tw/Tc/Tt bytes ...
+    """
+    fields = message.split(" ", 7)
+    if len(fields) < 7:
+        return None
+    backend, _, server = fields[3].partition("/")
+    timers = fields[4].split("/")
+    if len(timers) == 5:
+        # Not using to_int(), this being the hot path for the default format.
+        total = int(timers[4])
+        response = int(timers[3])
+        return (backend, server, total if total >= 0 else None,
+                response if response >= 0 else None, int(fields[5]))
+    if len(timers) == 3:
+        return (backend, server, to_int(timers[2]), None, None)
+    return None
+
+
+def parse_json_log(message):
+    try:
+        record = json.loads(message)
+    except ValueError:
+        return None
+    total = record.get("Ta", record.get("Tt"))
+    return (record.get("backend"), record.get("server"),
+            None if total is None or total < 0 else total,
+            None if record.get("Tr", -1) < 0 else record["Tr"],
+            record.get("status"))
+
+
+def parse_timing_log(message):
+    """
+    Parse the "timing-only" format:
+    frontend backend/server Tq=.. Tw=.. Tc=.. Tr=.. Ta=.. Tt=.. status=..
+    """
+    fields = message.split(" ")
+    if len(fields) < 3:
+        return None
+    backend, _, server = fields[1].partition("/")
+    values = dict(field.split("=", 1) for field in fields[2:]
+                  if "=" in field)
+    total = values.get("Ta", values.get("Tt"))
+    status = values.get("status")
+    return (backend, server, total and to_int(total),
+            to_int(values.get("Tr", "-1")),
+            status and parse_status(status))
+
+
+def parse_clf_log(message):
+    """
+    Parse the "extended-clf" format:
+    client - - [date] "request" status bytes "" "" port ms frontend backend
+    server Tq Tw Tc Tr Ta ...
+    """
+    head, separator, tail = message.rpartition(' "" "" ')
+    if not separator:
+        return None
+    status = head.rsplit(" ", 2)[1]
+    fields = tail.split(" ", 11)
+    if len(fields) < 11:
+        return None
+    return (fields[3], fields[4], to_int(fields[9]), to_int(fields[8]),
+            parse_status(status))
+
+
+def parse_line(line):
+    """
+    Parse a syslog line from haproxy, whatever its log format, returning
+    None for lines that aren't request logs.
+    """
+    start = line.find("]: ")
+    if start < 0:
+        return None
+    message = line[start + 3:].rstrip("\n")
+    if not message:
+        return None
+    first = message[0]
+    try:
+        if first == "{":
+            return parse_json_log(message)
+        if " Tw=" in message:
+            return parse_timing_log(message)
+        if " - - [" in message:
+            return parse_clf_log(message)
+        return parse_haproxy_log(message)
+    except (IndexError, TypeError, ValueError, AttributeError):
+        pass
+    return None
+
+
+def parse_lines(lines):
+    """Generator of the request records of the given log lines."""
+    for line in lines:
+        if line is None:
+            # Keep idle ticks flowing, so that summaries still get written.
+            yield None
+            continue
+        record = parse_line(line)
+        if record is not None and record[0]:
+            yield record
+
+
+def follow(path, poll_interval=1.0, from_start=False, sleep=time.sleep):
+    """
+    Generator of the lines appended to a log file, following it across
+    rotations, and yielding None when idle.
+    """
+    log_file = None
+    inode = None
+    while True:
+        if log_file is None:
+            try:
+                log_file = open(path)
+                inode = os.fstat(log_file.fileno()).st_ino
+                if not from_start:
+                    log_file.seek(0, os.SEEK_END)
+                from_start = True
+            except IOError:
+                # A log file created later is read from its start.
+                from_start = True
+                yield None
+                sleep(poll_interval)
+                continue
+        lines = log_file.readlines(1 << 20)
+        if lines:
+            # A partial last line is read again once complete.
+            if not lines[-1].endswith("\n"):
+                log_file.seek(-len(lines[-1]), os.SEEK_CUR)
+                lines.pop()
+            for line in lines:
+                yield line
+            if lines:
+                continue
+        try:
+            stat = os.stat(path)
+            if stat.st_ino != inode or stat.st_size < log_file.tell():
+                log_file.close()
+                log_file = None
+                continue
+        except OSError:
+            pass
+        yield None
+        sleep(poll_interval)
+
+
+class ServerStats(object):
+    """Latencies and status codes of a server for a slot of the window."""
+
+    __slots__ = ("requests", "total", "response", "statuses")
+
+    def __init__(self):
+        self.requests = 0
+        self.total = LatencySketch()
+        self.response = LatencySketch()
+        self.statuses = [0] * len(STATUS_CLASSES)
+
+    def add(self, total, response, status):
+        self.requests += 1
+        if total is not None:
+            self.total.add(total)
+        if response is not None:
+            self.response.add(response)
+        if status is not None:
+            index = status // 100 - 1
+            if not 0 <= index < 5:
+                index = 5
+            self.statuses[index] += 1
+
+    def merge(self, other):
+        self.requests += other.requests
+        self.total.merge(other.total)
+        self.response.merge(other.response)
+        self.statuses = [a + b for a, b in zip(self.statuses,
+                                               other.statuses)]
+
+
+class SlidingWindow(object):
+    """
+    Per-server stats over the last 'slots' slots of 'interval' seconds.
+    Memory is bounded by the number of slots, of servers, and the sketch
+    sizes, whatever the request rate. Slots never expire when 'slots' is
+    None.
+    """
+
+    def __init__(self, slots=30, interval=10, clock=time.time):
+        self.slots = slots
+        self.interval = interval
+        self.clock = clock
+        self.window = deque()
+        self.started = None
+
+    def current_slot(self):
+        slot_id = int(self.clock() // self.interval)
+        if not self.window or self.window[-1][0] != slot_id:
+            self.window.append((slot_id, {}))
+            if self.started is None:
+                self.started = slot_id
+            if self.slots is not None:
+                while self.window[0][0] <= slot_id - self.slots:
+                    self.window.popleft()
+        return self.window[-1][1]
+
+    def add_all(self, records, until=None):
+        """
+        Add records to the window, returning on an idle tick (None), or once
+        the clock reaches 'until', so the caller can write a summary.
+        """
+        slot = self.current_slot()
+        slot_id = self.window[-1][0]
+        count = 0
+        for record in records:
+            if record is None:
+                return count
+            count += 1
+            if count & 1023 == 0:
+                # Checking the clock on every record would be too slow.
+                now = self.clock()
+                if until is not None and now >= until:
+                    return count
+                if int(now // self.interval) != slot_id:
+                    slot = self.current_slot()
+                    slot_id = self.window[-1][0]
+            backend, server, total, response, status = record
+            key = (backend, server)
+            stats = slot.get(key)
+            if stats is None:
+                stats = slot[key] = ServerStats()
+            stats.add(total, response, status)
+        return count
+
+    def duration(self):
+        if self.started is None:
+            return 0
+        last = int(self.clock() // self.interval)
+        slots = last - self.started + 1
+        if self.slots is not None:
+            slots = min(self.slots, slots)
+        return slots * self.interval
+
+    def summary(self, duration=None):
+        """
+        Merge the slots into per-backend and per-server summaries, rates
+        being computed over 'duration' seconds, the window by default.
+        """
+        self.current_slot()
+        backends = {}
+        for _, slot in self.window:
+            for (backend_name, server_name), stats in slot.iteritems():
+                backend = backends.setdefault(
+                    backend_name, {"stats": ServerStats(), "servers": {}})
+                backend["stats"].merge(stats)
+                server = backend["servers"].get(server_name)
+                if server is None:
+                    server = backend["servers"][server_name] = ServerStats()
+                server.merge(stats)
+        if duration is None:
+            duration = self.duration()
+        return {
+            "generated": self.clock(),
+            "window": duration,
+            "backends": dict(
+                (name, dict(summarize(backend["stats"], duration),
+                            servers=dict(
+                                (server_name, summarize(stats, duration))
+                                for server_name, stats
+                                in backend["servers"].iteritems())))
+                for name, backend in backends.iteritems()),
+            }
+
+
+def round_or_none(value):
+    return None if value is None else round(value, 1)
+
+
+def summarize(stats, duration):
+    requests = stats.requests
+    summary = {
+        "requests": requests,
+        "rate": round(float(requests) / duration, 3) if duration else None,
+        }
+    for name, sketch in (("total", stats.total),
+                         ("response", stats.response)):
+        summary[name] = {
+            "mean": round_or_none(sketch.mean()),
+            "p50": round_or_none(sketch.quantile(0.5)),
+            "p95": round_or_none(sketch.quantile(0.95)),
+            "p99": round_or_none(sketch.quantile(0.99)),
+            }
+    responses = sum(stats.statuses)
+    summary["status"] = dict(
+        (name, round(float(count) / duration, 3) if duration else None)
+        for name, count in zip(STATUS_CLASSES, stats.statuses))
+    summary["5xx_ratio"] = (round(float(stats.statuses[4]) / responses, 4)
+                            if responses else None)
+    return summary
+
+
+def write_summary(summary, path):
+    temp_file = "%s.%d" % (path, os.getpid())
+    with open(temp_file, "w") as f:
+        json.dump(summary, f, sort_keys=True)
+    os.rename(temp_file, path)
+
+
+def analyze_log(path, interval, clock=time.time):
+    """
+    Return the summary of all the records of the given log file, however
+    long reading it takes.
+    """
+    window = SlidingWindow(None, interval, clock=clock)
+    with open(path) as f:
+        window.add_all(parse_lines(f))
+    return window.summary(duration=0)
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option("-l", "--log", default="/var/log/haproxy.log",
+                      help="haproxy log file to follow")
+    parser.add_option("-o", "--summary",
+                      default="/var/lib/haproxy/latency/summary.json",
+                      help="file to write the summary to")
+    parser.add_option("-w", "--window", type="int", default=300,
+                      help="seconds of the sliding window")
+    parser.add_option("-i", "--interval", type="int", default=10,
+                      help="seconds between summaries, and granularity "
+                      "of the window")
+    parser.add_option("--once", action="store_true", default=False,
+                      help="analyze the whole log and print the summary")
+    options, _ = parser.parse_args(args)
+
+    slots = max(1, options.window // options.interval)
+    if options.once:
+        print json.dumps(analyze_log(options.log, options.interval),
+                         indent=2, sort_keys=True)
+        return 0
+
+    window = SlidingWindow(slots, options.interval)
+    records = parse_lines(follow(options.log))
+    next_summary = 0
+    while True:
+        window.add_all(records, until=next_summary)
+        now = time.time()
+        if now >= next_summary:
+            write_summary(window.summary(), options.summary)
+            next_summary = now + options.interval
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Query and control the running haproxy through its admin stats socket:
+#
+#   haproxy-ctl stat [-p PROXY] [-f FIELD,...] [--csv]
+#   haproxy-ctl info
+#   haproxy-ctl disable|enable BACKEND/SERVER...
+#   haproxy-ctl weight BACKEND/SERVER WEIGHT
+#   haproxy-ctl exec COMMAND... (or - to read commands from stdin)
+#
+# All the commands of a run are pipelined over a single connection.
+
+import optparse
+import socket
+import sys
+
+import haproxy_stats
+
+DEFAULT_FIELDS = "pxname,svname,status,weight,scur,qcur,rate,check_status"
+
+
+def format_table(records, fields):
+    """Format records as a table of the given fields, aligned on columns."""
+    rows = [fields] + [
+        ["" if record.get(field) is None else str(record[field])
+         for field in fields]
+        for record in records]
+    widths = [max(len(row[index]) for row in rows)
+              for index in range(len(fields))]
+    return "\n".join(
+        "  ".join(value.ljust(width)
+                  for value, width in zip(row, widths)).rstrip()
+        for row in rows)
+
+
+def format_csv(records, fields):
+    lines = [",".join(fields)]
+    for record in records:
+        lines.append(",".join(
+            "" if record.get(field) is None else str(record[field])
+            for field in fields))
+    return "\n".join(lines)
+
+
+def stat(client, args):
+    parser = optparse.OptionParser(
+        usage="%prog stat [-p PROXY] [-f FIELD,...] [--csv]")
+    parser.add_option("-p", "--proxy", action="append", default=[],
+                      help="only show the given frontend or backend")
+    parser.add_option("-f", "--fields", default=DEFAULT_FIELDS,
+                      help="comma separated 'show stat' fields to show")
+    parser.add_option("--csv", action="store_true", default=False,
+                      help="output CSV instead of a table")
+    options, _ = parser.parse_args(args)
+    fields = [field for field in options.fields.split(",") if field]
+    records = client.show_stat(set(fields + ["pxname"]))
+    if options.proxy:
+        records = [record for record in records
+                   if record["pxname"] in options.proxy]
+    if options.csv:
+        return format_csv(records, fields)
+    return format_table(records, fields)
+
+
+def info(client, args):
+    return client.command("show info").rstrip("\n")
+
+
+def server_commands(command, args):
+    commands = []
+    for server in args:
+        if "/" not in server:
+            raise ValueError("Servers are given as BACKEND/SERVER: %s" %
+                             server)
+        commands.append("%s server %s" % (command, server))
+    return commands
+
+
+def disable(client, args):
+    return run_commands(client, server_commands("disable", args))
+
+
+def enable(client, args):
+    return run_commands(client, server_commands("enable", args))
+
+
+def weight(client, args):
+    if len(args) != 2:
+        raise ValueError("Usage: weight BACKEND/SERVER WEIGHT")
+    server, value = args
+    return run_commands(client, ["set weight %s %s" % (server, value)])
+
+
+def run_commands(client, commands):
+    """Run pipelined commands, returning their joined responses."""
+    if not commands:
+        raise ValueError("No command given")
+    responses = client.execute(*commands)
+    return "".join(responses).rstrip("\n")
+
+
+def execute(client, args):
+    if args == ["-"]:
+        args = [line.strip() for line in sys.stdin if line.strip()]
+    return run_commands(client, args)
+
+
+ACTIONS = {
+    "stat": stat,
+    "info": info,
+    "disable": disable,
+    "enable": enable,
+    "weight": weight,
+    "exec": execute,
+    }
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage="%%prog [options] {%s} [arguments]" % ",".join(sorted(ACTIONS)))
+    parser.add_option("-s", "--socket", default=haproxy_stats.DEFAULT_SOCKET,
+                      help="path of the haproxy stats socket")
+    parser.add_option("-t", "--timeout", type="float",
+                      default=haproxy_stats.DEFAULT_TIMEOUT,
+                      help="seconds to wait for haproxy")
+    parser.disable_interspersed_args()
+    options, args = parser.parse_args(args)
+    if not args or args[0] not in ACTIONS:
+        parser.print_usage(sys.stderr)
+        return 2
+
+    with haproxy_stats.StatsClient(options.socket, options.timeout) as client:
+        try:
+            output = ACTIONS[args[0]](client, args[1:])
+        except ValueError, e:
+            sys.stderr.write("%s\n" % e)
+            return 2
+        except socket.error, e:
+            sys.stderr.write("Failed to reach haproxy on %s: %s\n" % (
+                options.socket, e))
+            return 1
+    if output:
+        print output
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
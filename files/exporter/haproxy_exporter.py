@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Serve haproxy metrics in the Prometheus text format, from 'show stat' and
+# 'show info' snapshots read on the haproxy stats socket.
+
+import optparse
+import socket
+import sys
+import threading
+import time
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+import haproxy_stats
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+# 'show stat' fields exported for frontends, backends and servers, as
+# tuples of (field, metric name, help). Gauges also carry the scale turning
+# haproxy units (milliseconds) into Prometheus base units (seconds).
+COUNTERS = [
+    ("stot", "sessions_total", "Total number of sessions."),
+    ("bin", "bytes_in_total", "Total number of bytes received."),
+    ("bout", "bytes_out_total", "Total number of bytes sent."),
+    ("dreq", "requests_denied_total", "Total number of denied requests."),
+    ("dresp", "responses_denied_total", "Total number of denied responses."),
+    ("ereq", "request_errors_total", "Total number of request errors."),
+    ("econ", "connection_errors_total", "Total number of connection errors."),
+    ("eresp", "response_errors_total", "Total number of response errors."),
+    ("wretr", "retry_warnings_total", "Total number of retry warnings."),
+    ("wredis", "redispatch_warnings_total",
+     "Total number of redispatch warnings."),
+    ("chkfail", "check_failures_total", "Total number of failed checks."),
+    ("downtime", "downtime_seconds_total", "Total downtime in seconds."),
+    ]
+
+GAUGES = [
+    ("scur", "current_sessions", "Current number of sessions.", 1),
+    ("smax", "max_sessions", "Maximum observed number of sessions.", 1),
+    ("slim", "limit_sessions", "Configured session limit.", 1),
+    ("qcur", "current_queue", "Current number of queued requests.", 1),
+    ("qmax", "max_queue", "Maximum observed number of queued requests.", 1),
+    ("rate", "current_session_rate",
+     "Current number of sessions per second over last elapsed second.", 1),
+    ("rate_lim", "limit_session_rate", "Configured limit on new sessions "
+     "per second.", 1),
+    ("weight", "weight", "Current weight.", 1),
+    ("qtime", "queue_time_average_seconds",
+     "Average queue time of the last 1024 requests.", 0.001),
+    ("ctime", "connect_time_average_seconds",
+     "Average connect time of the last 1024 requests.", 0.001),
+    ("rtime", "response_time_average_seconds",
+     "Average response time of the last 1024 requests.", 0.001),
+    ("ttime", "total_time_average_seconds",
+     "Average total time of the last 1024 requests.", 0.001),
+    ]
+
+HTTP_RESPONSES = ["hrsp_1xx", "hrsp_2xx", "hrsp_3xx", "hrsp_4xx", "hrsp_5xx",
+                  "hrsp_other"]
+
+INFO_GAUGES = [
+    ("Uptime_sec", "uptime_seconds", "Time since haproxy started."),
+    ("CurrConns", "current_connections", "Current number of connections."),
+    ("Maxconn", "max_connections", "Configured connection limit."),
+    ("CumConns", "connections_total", "Total number of connections."),
+    ("ConnRate", "current_connection_rate",
+     "Current number of connections per second."),
+    ("Idle_pct", "idle_percent", "Percentage of idle time."),
+    ]
+
+PROXY_TYPES = [
+    (haproxy_stats.TYPE_FRONTEND, "frontend"),
+    (haproxy_stats.TYPE_BACKEND, "backend"),
+    (haproxy_stats.TYPE_SERVER, "server"),
+    ]
+
+
+def format_labels(labels):
+    return ",".join('%s="%s"' % (
+        name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels)
+
+
+class MetricsWriter(object):
+    """Accumulate samples, grouped by metric as the text format wants."""
+
+    def __init__(self):
+        self.metrics = []
+        self.samples = {}
+
+    def add(self, name, metric_type, help_text, labels, value):
+        if value is None:
+            return
+        if name not in self.samples:
+            self.metrics.append((name, metric_type, help_text))
+            self.samples[name] = []
+        self.samples[name].append((labels, value))
+
+    def render(self):
+        lines = []
+        for name, metric_type, help_text in self.metrics:
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, metric_type))
+            for labels, value in self.samples[name]:
+                if labels:
+                    lines.append("%s{%s} %s" % (
+                        name, format_labels(labels), format_value(value)))
+                else:
+                    lines.append("%s %s" % (name, format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render_metrics(records, info):
+    """
+    Render 'show stat' records and 'show info' values as Prometheus text.
+    'records' and 'info' are None when haproxy could not be reached.
+    """
+    writer = MetricsWriter()
+    writer.add("haproxy_up", "gauge",
+               "Whether haproxy could be reached on its stats socket.", (),
+               int(records is not None))
+    for field, name, help_text in INFO_GAUGES:
+        value = (info or {}).get(field)
+        if isinstance(value, (int, long)):
+            writer.add("haproxy_process_%s" % name, "gauge", help_text, (),
+                       value)
+    for proxy_type, prefix in PROXY_TYPES:
+        for record in records or ():
+            if record.get("type") != proxy_type:
+                continue
+            if proxy_type == haproxy_stats.TYPE_SERVER:
+                labels = (("backend", record["pxname"]),
+                          ("server", record["svname"]))
+            else:
+                labels = ((prefix, record["pxname"]),)
+            if proxy_type != haproxy_stats.TYPE_FRONTEND:
+                writer.add("haproxy_%s_up" % prefix, "gauge",
+                           "Whether the %s is up." % prefix, labels,
+                           int(haproxy_stats.is_server_up(record)))
+            for field, name, help_text in COUNTERS:
+                writer.add("haproxy_%s_%s" % (prefix, name), "counter",
+                           help_text, labels, record.get(field))
+            for field, name, help_text, scale in GAUGES:
+                value = record.get(field)
+                if value is not None and scale != 1:
+                    value = value * scale
+                writer.add("haproxy_%s_%s" % (prefix, name), "gauge",
+                           help_text, labels, value)
+            for field in HTTP_RESPONSES:
+                writer.add("haproxy_%s_http_responses_total" % prefix,
+                           "counter", "Total number of HTTP responses.",
+                           labels + (("code", field[5:]),),
+                           record.get(field))
+    return writer.render()
+
+
+class SnapshotCache(object):
+    """
+    Keep the last snapshot read from haproxy for 'ttl' seconds, so that
+    concurrent or frequent scrapes only read the stats socket once.
+    """
+
+    def __init__(self, socket_path, ttl, timeout=haproxy_stats.DEFAULT_TIMEOUT,
+                 clock=time.time):
+        self.client = haproxy_stats.StatsClient(socket_path, timeout)
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.fetched_at = None
+        self.metrics = None
+
+    def fetch(self):
+        try:
+            stat, info = self.client.execute("show stat", "show info")
+        except socket.error:
+            return render_metrics(None, None)
+        return render_metrics(haproxy_stats.parse_stat(stat),
+                              haproxy_stats.parse_info(info))
+
+    def get(self):
+        with self.lock:
+            now = self.clock()
+            if self.fetched_at is None or now - self.fetched_at >= self.ttl:
+                self.metrics = self.fetch()
+                self.fetched_at = now
+            return self.metrics
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = self.server.cache.get()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--socket", default=haproxy_stats.DEFAULT_SOCKET,
+                      help="path of the haproxy stats socket")
+    parser.add_option("-a", "--address", default="127.0.0.1",
+                      help="address to serve metrics on")
+    parser.add_option("-p", "--port", type="int", default=9101,
+                      help="port to serve metrics on")
+    parser.add_option("-t", "--cache-ttl", type="float", default=5,
+                      help="seconds a snapshot of haproxy stats is served "
+                      "for before being read again")
+    options, _ = parser.parse_args(args)
+
+    server = MetricsServer((options.address, options.port), MetricsHandler)
+    server.cache = SnapshotCache(options.socket, options.cache_ttl)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Check that all the haproxy backends and servers are up, from a single
+# 'show stat' snapshot read on the haproxy stats socket.
+
+import optparse
+import socket
+import sys
+
+import haproxy_stats
+from nagios_plugin import (
+    OK, WARNING, CRITICAL, UNKNOWN, parse_backend_thresholds,
+    parse_threshold, perfdata as format_perfdata, report, threshold_limit)
+
+STAT_FIELDS = ("pxname", "svname", "status", "type")
+
+
+def check_backends(proxies, warning, critical, backend_thresholds=None):
+    """
+    Evaluate each backend against its thresholds on the number of servers
+    down, each of which defaults to the given warning or critical one.
+
+    Returns a tuple of (status, messages, perfdata).
+    """
+    backend_thresholds = backend_thresholds or {}
+    status = OK
+    messages = []
+    perfdata = []
+    for name, proxy in sorted(proxies.iteritems()):
+        backend = proxy["backend"]
+        if backend is None:
+            continue
+        servers = proxy["servers"]
+        down = [server["svname"] for server in servers
+                if not haproxy_stats.is_server_up(server)]
+        # An override may only set one of the thresholds, the other one
+        # still being the global one.
+        backend_warning, backend_critical = backend_thresholds.get(
+            name, (None, None))
+        if backend_warning is None:
+            backend_warning = warning
+        if backend_critical is None:
+            backend_critical = critical
+        warning_limit = threshold_limit(backend_warning, len(servers))
+        critical_limit = threshold_limit(backend_critical, len(servers))
+
+        backend_status = OK
+        if not haproxy_stats.is_server_up(backend):
+            backend_status = CRITICAL
+        elif critical_limit is not None and len(down) > critical_limit:
+            backend_status = CRITICAL
+        elif warning_limit is not None and len(down) > warning_limit:
+            backend_status = WARNING
+        if backend_status != OK:
+            message = "%s: %d/%d servers down" % (
+                name, len(down), len(servers))
+            if down:
+                message += " (%s)" % ", ".join(down)
+            messages.append(message)
+        status = max(status, backend_status)
+        perfdata.append(format_perfdata(
+            "%s_down" % name, len(down), warning_limit, critical_limit, 0,
+            len(servers)))
+    return status, messages, perfdata
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--socket", default=haproxy_stats.DEFAULT_SOCKET,
+                      help="path of the haproxy stats socket")
+    parser.add_option("-w", "--warning", default="",
+                      help="servers down in a backend before warning, "
+                      "as a count or a percentage")
+    parser.add_option("-c", "--critical", default="0",
+                      help="servers down in a backend before critical, "
+                      "as a count or a percentage")
+    parser.add_option("-b", "--backend", action="append", default=[],
+                      metavar="BACKEND=WARNING,CRITICAL",
+                      help="thresholds for a given backend")
+    options, _ = parser.parse_args(args)
+
+    try:
+        records = haproxy_stats.show_stat(options.socket,
+                                          fields=STAT_FIELDS)
+    except socket.error, e:
+        return report(UNKNOWN, "failed to read haproxy stats: %s" % e)
+
+    proxies = haproxy_stats.group_by_proxy(records)
+    status, messages, perfdata = check_backends(
+        proxies, parse_threshold(options.warning),
+        parse_threshold(options.critical),
+        parse_backend_thresholds(options.backend))
+    if status == OK:
+        servers = sum(len(proxy["servers"]) for proxy in proxies.values())
+        summary = "All haproxy backends looking good (%d servers)" % servers
+    else:
+        summary = "; ".join(messages)
+    return report(status, summary, perfdata)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
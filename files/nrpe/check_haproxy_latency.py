@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Check the latency percentiles and 5xx ratio of each haproxy backend, from
+# the summary written by the haproxy log analyzer.
+
+import json
+import optparse
+import sys
+import time
+
+from nagios_plugin import (
+    OK, UNKNOWN, STATUS_NAMES, evaluate, parse_thresholds,
+    perfdata as format_perfdata, report, threshold_limit)
+
+DEFAULT_SUMMARY = "/var/lib/haproxy/latency/summary.json"
+
+
+def check_summary(summary, thresholds):
+    """
+    Evaluate each backend of a log analyzer summary against the thresholds
+    on its total time percentiles (in milliseconds) and 5xx ratio (in
+    percent).
+
+    Returns a tuple of (status, messages, perfdata).
+    """
+    status = OK
+    messages = []
+    perfdata = []
+    for name, backend in sorted(summary.get("backends", {}).iteritems()):
+        ratio = backend.get("5xx_ratio")
+        metrics = [
+            ("p95", backend["total"]["p95"], "ms", None),
+            ("p99", backend["total"]["p99"], "ms", None),
+            ("5xx", None if ratio is None else ratio * 100, "%", 100),
+            ]
+        for metric, value, unit, maximum in metrics:
+            warning, critical = thresholds[metric]
+            warning = threshold_limit(warning, maximum)
+            critical = threshold_limit(critical, maximum)
+            metric_status = evaluate(value, warning, critical)
+            if metric_status != OK:
+                messages.append("%s %s %g%s (%s)" % (
+                    name, metric, value, unit, STATUS_NAMES[metric_status]))
+            status = max(status, metric_status)
+            if value is not None:
+                perfdata.append(format_perfdata(
+                    "%s_%s" % (name, metric), value, warning, critical, 0,
+                    maximum, unit))
+        if backend.get("rate") is not None:
+            perfdata.append(format_perfdata("%s_rate" % name,
+                                            backend["rate"], minimum=0))
+    return status, messages, perfdata
+
+
+def main(args=None, clock=time.time):
+    parser = optparse.OptionParser()
+    parser.add_option("-f", "--summary", default=DEFAULT_SUMMARY,
+                      help="summary written by the log analyzer")
+    parser.add_option("--p95", default="", metavar="WARNING,CRITICAL",
+                      help="thresholds on the 95th percentile of the total "
+                      "time of requests, in milliseconds")
+    parser.add_option("--p99", default="", metavar="WARNING,CRITICAL",
+                      help="thresholds on the 99th percentile of the total "
+                      "time of requests, in milliseconds")
+    parser.add_option("--5xx", dest="errors", default="",
+                      metavar="WARNING,CRITICAL",
+                      help="thresholds on the percentage of 5xx responses")
+    parser.add_option("--max-age", type="int", default=120,
+                      help="seconds after which the summary is stale")
+    options, _ = parser.parse_args(args)
+
+    try:
+        with open(options.summary) as f:
+            summary = json.load(f)
+    except (IOError, ValueError), e:
+        return report(UNKNOWN, "failed to read the log analyzer summary: %s"
+                      % e)
+    age = clock() - summary.get("generated", 0)
+    if age > options.max_age:
+        return report(UNKNOWN, "log analyzer summary is %ds old" % age)
+
+    status, messages, perfdata = check_summary(summary, {
+        "p95": parse_thresholds(options.p95),
+        "p99": parse_thresholds(options.p99),
+        "5xx": parse_thresholds(options.errors),
+        })
+    if status == OK:
+        summary_text = "All haproxy backend latencies looking good"
+    else:
+        summary_text = "; ".join(messages)
+    return report(status, summary_text, perfdata)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
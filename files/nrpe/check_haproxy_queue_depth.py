@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Check the queue depth, session saturation and session rate headroom of the
+# haproxy frontends and backends, from a single 'show stat' snapshot read on
+# the haproxy stats socket.
+
+import optparse
+import socket
+import sys
+
+import haproxy_stats
+from nagios_plugin import (
+    OK, UNKNOWN, STATUS_NAMES, evaluate, parse_thresholds,
+    perfdata as format_perfdata, report, threshold_limit)
+
+STAT_FIELDS = ("pxname", "svname", "type", "qcur", "qmax", "scur", "slim",
+               "rate", "rate_lim")
+
+
+def percent(value, total):
+    if value is None or not total:
+        return None
+    return value * 100.0 / total
+
+
+def check_proxy(label, record, thresholds):
+    """
+    Evaluate a frontend or backend record, returning a list of
+    (status, message, perfdata) for each metric it has limits for.
+    """
+    results = []
+
+    def add(metric, value, limits, below=False, minimum=0, maximum=None,
+            unit="", description=None):
+        if value is None:
+            return
+        warning = threshold_limit(limits[0], maximum)
+        critical = threshold_limit(limits[1], maximum)
+        status = evaluate(value, warning, critical, below)
+        message = None
+        if status != OK:
+            message = "%s %s %g%s" % (label, description or metric, value,
+                                      unit)
+        results.append((status, message, format_perfdata(
+            "%s_%s" % (label, metric), value, warning, critical, minimum,
+            maximum, unit)))
+
+    if record["type"] == haproxy_stats.TYPE_BACKEND:
+        add("qcur", record.get("qcur"), thresholds["queue"],
+            description="queue depth")
+        add("qmax", record.get("qmax"), thresholds["max_queue"],
+            description="max queue depth")
+    add("saturation", percent(record.get("scur"), record.get("slim")),
+        thresholds["saturation"], maximum=100, unit="%",
+        description="session saturation")
+    rate_lim = record.get("rate_lim")
+    if rate_lim:
+        add("rate_headroom", percent(rate_lim - (record.get("rate") or 0),
+                                     rate_lim),
+            thresholds["rate_headroom"], below=True, maximum=100, unit="%",
+            description="session rate headroom")
+    return results
+
+
+def check_proxies(records, thresholds):
+    """
+    Evaluate every frontend and backend, without stopping at the first one
+    in trouble.
+
+    Returns a tuple of (status, messages, perfdata).
+    """
+    status = OK
+    messages = []
+    perfdata = []
+    for record in sorted(records, key=lambda r: (r["pxname"], r["type"])):
+        if record["type"] == haproxy_stats.TYPE_BACKEND:
+            label = record["pxname"]
+        elif record["type"] == haproxy_stats.TYPE_FRONTEND:
+            label = "%s_frontend" % record["pxname"]
+        else:
+            continue
+        for metric_status, message, metric_perfdata in check_proxy(
+                label, record, thresholds):
+            status = max(status, metric_status)
+            if message is not None:
+                messages.append("%s (%s)" % (
+                    message, STATUS_NAMES[metric_status]))
+            perfdata.append(metric_perfdata)
+    return status, messages, perfdata
+
+
+def main(args=None):
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--socket", default=haproxy_stats.DEFAULT_SOCKET,
+                      help="path of the haproxy stats socket")
+    parser.add_option("-q", "--queue", default=",0",
+                      metavar="WARNING,CRITICAL",
+                      help="thresholds on the current queue of backends")
+    parser.add_option("-m", "--max-queue", default=",100",
+                      metavar="WARNING,CRITICAL",
+                      help="thresholds on the max queue of backends")
+    parser.add_option("-S", "--saturation", default="80,95",
+                      metavar="WARNING,CRITICAL",
+                      help="thresholds on the percentage of the session "
+                      "limit in use")
+    parser.add_option("-r", "--rate-headroom", default="20,5",
+                      metavar="WARNING,CRITICAL",
+                      help="thresholds on the percentage of the session "
+                      "rate limit left, for proxies having one")
+    options, _ = parser.parse_args(args)
+
+    thresholds = {
+        "queue": parse_thresholds(options.queue),
+        "max_queue": parse_thresholds(options.max_queue),
+        "saturation": parse_thresholds(options.saturation),
+        "rate_headroom": parse_thresholds(options.rate_headroom),
+        }
+    try:
+        records = haproxy_stats.show_stat(options.socket,
+                                          fields=STAT_FIELDS)
+    except socket.error, e:
+        return report(UNKNOWN, "failed to read haproxy stats: %s" % e)
+
+    status, messages, perfdata = check_proxies(records, thresholds)
+    if status == OK:
+        summary = "All haproxy queue depths looking good"
+    else:
+        summary = "; ".join(messages)
+    return report(status, summary, perfdata)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Check the average response and total times and the 5xx ratio of each
+# haproxy backend over a rolling window against its SLO thresholds. Each run
+# adds a 'show stat' sample to a state file, and the window is computed from
+# the deltas between samples.
+
+import json
+import optparse
+import os
+import socket
+import sys
+import time
+
+import haproxy_stats
+from nagios_plugin import (
+    OK, UNKNOWN, STATUS_NAMES, evaluate, parse_backend_thresholds,
+    perfdata as format_perfdata, report, threshold_limit)
+
+STAT_FIELDS = ("pxname", "svname", "type", "stot", "hrsp_1xx", "hrsp_2xx",
+               "hrsp_3xx", "hrsp_4xx", "hrsp_5xx", "hrsp_other", "rtime",
+               "ttime")
+
+RESPONSE_FIELDS = ("hrsp_1xx", "hrsp_2xx", "hrsp_3xx", "hrsp_4xx",
+                   "hrsp_5xx", "hrsp_other")
+
+DEFAULT_STATE = "/var/lib/nagios/check_haproxy_slo.json"
+
+
+def take_sample(records):
+    """
+    Return the counters and average times of each backend, as a mapping of
+    backend name to [sessions, responses, 5xx responses, rtime, ttime].
+    """
+    sample = {}
+    for record in records:
+        if record.get("type") != haproxy_stats.TYPE_BACKEND:
+            continue
+        sample[record["pxname"]] = [
+            record.get("stot") or 0,
+            sum(record.get(field) or 0 for field in RESPONSE_FIELDS),
+            record.get("hrsp_5xx") or 0,
+            record.get("rtime"),
+            record.get("ttime"),
+            ]
+    return sample
+
+
+def add_sample(samples, now, sample, window):
+    """
+    Append a sample, dropping the ones no longer needed: those older than
+    the window, except the newest of them, which the deltas start from.
+    """
+    samples = samples + [[now, sample]]
+    start = now - window
+    while len(samples) > 2 and samples[1][0] <= start:
+        samples.pop(0)
+    return samples
+
+
+def delta(new, old):
+    """Return the increase of a counter, which restarts from 0 on reload."""
+    if new < old:
+        return new
+    return new - old
+
+
+def window_stats(samples):
+    """
+    Compute the SLO metrics of each backend from consecutive samples.
+
+    Average times are the averages sampled by haproxy (over its last 1024
+    requests), weighted by the sessions of each interval. Returns a mapping
+    of backend name to a dict of requests, response_time, total_time and
+    5xx (a percentage), metrics being None without traffic.
+    """
+    totals = {}
+    for (_, old), (_, new) in zip(samples, samples[1:]):
+        for name, values in new.iteritems():
+            if name not in old:
+                continue
+            sessions, responses, errors, rtime, ttime = values
+            previous = old[name]
+            total = totals.setdefault(name, [0, 0, 0, 0, 0, 0, 0])
+            requests = delta(sessions, previous[0])
+            total[0] += requests
+            total[1] += delta(responses, previous[1])
+            total[2] += delta(errors, previous[2])
+            if requests and rtime is not None:
+                total[3] += rtime * requests
+                total[4] += requests
+            if requests and ttime is not None:
+                total[5] += ttime * requests
+                total[6] += requests
+    stats = {}
+    for name, (requests, responses, errors, rtime, rtime_requests, ttime,
+               ttime_requests) in totals.iteritems():
+        stats[name] = {
+            "requests": requests,
+            "response_time": (float(rtime) / rtime_requests
+                              if rtime_requests else None),
+            "total_time": (float(ttime) / ttime_requests
+                           if ttime_requests else None),
+            "5xx": errors * 100.0 / responses if responses else None,
+            }
+    return stats
+
+
+def check_backends(stats, thresholds):
+    """
+    Evaluate each backend against its SLO thresholds, given per metric as
+    mappings of backend name to thresholds.
+
+    Returns a tuple of (status, messages, perfdata).
+    """
+    status = OK
+    messages = []
+    perfdata = []
+    no_thresholds = (None, None)
+    for name, backend in sorted(stats.iteritems()):
+        for metric, unit, maximum, description in (
+                ("response_time", "ms", None, "average response time"),
+                ("total_time", "ms", None, "average total time"),
+                ("5xx", "%", 100, "5xx ratio")):
+            value = backend[metric]
+            warning, critical = thresholds[metric].get(name, no_thresholds)
+            warning = threshold_limit(warning, maximum)
+            critical = threshold_limit(critical, maximum)
+            metric_status = evaluate(value, warning, critical)
+            if metric_status != OK:
+                messages.append("%s %s %g%s (%s)" % (
+                    name, description, round(value, 1), unit,
+                    STATUS_NAMES[metric_status]))
+            status = max(status, metric_status)
+            if value is not None:
+                perfdata.append(format_perfdata(
+                    "%s_%s" % (name, metric), round(value, 2), warning,
+                    critical, 0, maximum, unit))
+    return status, messages, perfdata
+
+
+def load_samples(path):
+    try:
+        with open(path) as f:
+            return json.load(f)["samples"]
+    except (IOError, ValueError, KeyError, TypeError):
+        return []
+
+
+def save_samples(path, samples):
+    temp_file = "%s.%d" % (path, os.getpid())
+    with open(temp_file, "w") as f:
+        json.dump({"samples": samples}, f)
+    os.rename(temp_file, path)
+
+
+def main(args=None, clock=time.time):
+    parser = optparse.OptionParser()
+    parser.add_option("-s", "--socket", default=haproxy_stats.DEFAULT_SOCKET,
+                      help="path of the haproxy stats socket")
+    parser.add_option("-f", "--state", default=DEFAULT_STATE,
+                      help="file keeping the samples of previous runs")
+    parser.add_option("-W", "--window", type="int", default=900,
+                      help="seconds of the rolling window")
+    parser.add_option("-R", "--response-time", action="append", default=[],
+                      metavar="BACKEND=WARNING,CRITICAL",
+                      help="thresholds on the average response time of a "
+                      "backend, in milliseconds")
+    parser.add_option("-T", "--total-time", action="append", default=[],
+                      metavar="BACKEND=WARNING,CRITICAL",
+                      help="thresholds on the average total time of a "
+                      "backend, in milliseconds")
+    parser.add_option("-E", "--5xx", dest="errors", action="append",
+                      default=[], metavar="BACKEND=WARNING,CRITICAL",
+                      help="thresholds on the percentage of 5xx responses "
+                      "of a backend")
+    options, _ = parser.parse_args(args)
+
+    try:
+        records = haproxy_stats.show_stat(options.socket,
+                                          fields=STAT_FIELDS)
+    except socket.error, e:
+        return report(UNKNOWN, "failed to read haproxy stats: %s" % e)
+
+    samples = add_sample(load_samples(options.state), clock(),
+                         take_sample(records), options.window)
+    try:
+        save_samples(options.state, samples)
+    except (IOError, OSError), e:
+        return report(UNKNOWN, "failed to save the samples: %s" % e)
+    if len(samples) < 2:
+        return report(OK, "Collecting a first sample of haproxy stats")
+
+    status, messages, perfdata = check_backends(window_stats(samples), {
+        "response_time": parse_backend_thresholds(options.response_time),
+        "total_time": parse_backend_thresholds(options.total_time),
+        "5xx": parse_backend_thresholds(options.errors),
+        })
+    if status == OK:
+        summary = "All haproxy backends within their SLOs over %ds" % (
+            samples[-1][0] - samples[0][0])
+    else:
+        summary = "; ".join(messages)
+    return report(status, summary, perfdata)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,105 @@
+#--------------------------------------------
+# This file is managed by Juju
+#--------------------------------------------
+#
+# Copyright 2014 Canonical Ltd.
+#
+# Helpers shared by the haproxy Nagios plugins.
+
+OK = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+STATUS_NAMES = {OK: "OK", WARNING: "WARNING", CRITICAL: "CRITICAL",
+                UNKNOWN: "UNKNOWN"}
+
+
+def parse_threshold(value):
+    """
+    Parse a threshold, either an absolute value ("2") or a percentage
+    ("50%"), into a tuple of (value, is_percentage). Returns None for an
+    empty threshold.
+    """
+    if value is None or str(value).strip() == "":
+        return None
+    value = str(value).strip()
+    if value.endswith("%"):
+        return (float(value[:-1]), True)
+    return (float(value), False)
+
+
+def parse_thresholds(value):
+    """
+    Parse a "WARNING,CRITICAL" pair of thresholds, either of which may be
+    empty.
+    """
+    warning, _, critical = (value or "").partition(",")
+    return parse_threshold(warning), parse_threshold(critical)
+
+
+def parse_backend_thresholds(values):
+    """
+    Parse 'BACKEND=WARNING,CRITICAL' arguments into a mapping of backend
+    name to a tuple of thresholds.
+    """
+    thresholds = {}
+    for value in values or ():
+        name, _, limits = value.partition("=")
+        thresholds[name] = parse_thresholds(limits)
+    return thresholds
+
+
+def threshold_limit(threshold, total=None):
+    """
+    Return the limit a threshold amounts to, percentages being relative to
+    the given total.
+    """
+    if threshold is None:
+        return None
+    value, percent = threshold
+    if percent:
+        if total is None:
+            return value
+        return value * total / 100.0
+    return value
+
+
+def evaluate(value, warning_limit, critical_limit, below=False):
+    """
+    Return the status of a value against its limits, which are upper
+    limits unless 'below' is set.
+    """
+    if value is None:
+        return OK
+    for status, limit in ((CRITICAL, critical_limit),
+                          (WARNING, warning_limit)):
+        if limit is None:
+            continue
+        if (value < limit) if below else (value > limit):
+            return status
+    return OK
+
+
+def format_number(value):
+    if value is None:
+        return ""
+    return "%g" % value
+
+
+def perfdata(label, value, warning=None, critical=None, minimum=None,
+             maximum=None, unit=""):
+    """Format a perfdata item the way Nagios expects it."""
+    return "'%s'=%s%s;%s;%s;%s;%s" % (
+        label, format_number(value), unit, format_number(warning),
+        format_number(critical), format_number(minimum),
+        format_number(maximum))
+
+
+def report(status, summary, perfdata_items=()):
+    """Print the plugin output and return its exit status."""
+    output = "%s: %s" % (STATUS_NAMES[status], summary)
+    if perfdata_items:
+        output += "|" + " ".join(perfdata_items)
+    print output
+    return status
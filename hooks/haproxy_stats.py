@@ -0,0 +1,266 @@
+"""
+Client for the haproxy stats socket.
+
+This module is used by the charm hooks, and is also installed on the unit
+for the monitoring tools shipped with the charm, which read all of their
+data from a single 'show stat' snapshot instead of scraping the HTML stats
+page.
+"""
+
+import csv
+import os
+import socket
+import time
+
+DEFAULT_SOCKET = "/var/lib/haproxy/stats.sock"
+DEFAULT_TIMEOUT = 10
+
+# Fields of 'show stat' that are not numbers, all others are converted to
+# integers (or None when empty).
+STRING_FIELDS = frozenset([
+    "pxname", "svname", "status", "tracked", "check_status", "last_chk",
+    "last_agt", "agent_status", "hanafail", "cookie", "mode", "algo", "addr",
+    ])
+
+# Values of 'type' in 'show stat'.
+TYPE_FRONTEND = 0
+TYPE_BACKEND = 1
+TYPE_SERVER = 2
+TYPE_LISTENER = 3
+
+
+def send_command(command, socket_path=DEFAULT_SOCKET,
+                 timeout=DEFAULT_TIMEOUT):
+    """
+    Send a command to the haproxy stats socket and return the response.
+
+    Raises socket.error if haproxy can't be reached.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(socket_path)
+        sock.sendall(command + "\n")
+        response = []
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            response.append(data)
+    finally:
+        sock.close()
+    return "".join(response)
+
+
+class StatsClient(object):
+    """
+    Connection to the haproxy stats socket kept open across commands, in
+    the interactive ('prompt') mode of the socket.
+
+    Commands passed together to execute() are pipelined: they are all sent
+    at once and their responses read back in order, saving a round trip
+    and a connection per command. The connection is closed by haproxy
+    once idle for the 'stats timeout', in which case it is opened again.
+    """
+
+    PROMPT = "\n> "
+
+    def __init__(self, socket_path=DEFAULT_SOCKET, timeout=DEFAULT_TIMEOUT):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.sock = None
+        self.buffer = ""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            sock.sendall("prompt\n")
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+        self.buffer = ""
+        # The prompt shows up as soon as the interactive mode is on.
+        while not self.buffer.endswith("> "):
+            self.receive()
+        self.buffer = ""
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+    def receive(self):
+        data = self.sock.recv(65536)
+        if not data:
+            self.close()
+            raise socket.error("Connection closed by haproxy")
+        self.buffer += data
+
+    def execute(self, *commands):
+        """
+        Send the given commands, returning the list of their responses.
+
+        Raises socket.error if haproxy can't be reached.
+        """
+        reused = self.sock is not None
+        try:
+            return self._execute(commands)
+        except socket.error:
+            self.close()
+            if not reused:
+                raise
+        # The connection may have timed out while idle, try a new one.
+        return self._execute(commands)
+
+    def _execute(self, commands):
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall("".join(command + "\n" for command in commands))
+        responses = []
+        while len(responses) < len(commands):
+            end = self.buffer.find(self.PROMPT)
+            if end < 0:
+                self.receive()
+                continue
+            # Responses end with an empty line, before the prompt.
+            responses.append(self.buffer[:end])
+            self.buffer = self.buffer[end + len(self.PROMPT):]
+        return responses
+
+    def command(self, command):
+        """Send a command, returning its response."""
+        return self.execute(command)[0]
+
+    def show_stat(self, fields=None):
+        return parse_stat(self.command("show stat"), fields)
+
+    def show_info(self):
+        return parse_info(self.command("show info"))
+
+
+def convert_number(value):
+    if value.isdigit():
+        return int(value)
+    if value == "":
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def parse_stat(data, fields=None):
+    """
+    Parse the CSV output of 'show stat' into a list of records, one dict per
+    frontend, backend and server, with numeric fields converted to integers.
+
+    Converting every field of a large config takes a while, so callers only
+    interested in some fields can pass their names as 'fields'.
+    """
+    lines = data.splitlines()
+    if not lines or not lines[0].startswith("# "):
+        return []
+    columns = [(index, name, name not in STRING_FIELDS)
+               for index, name in enumerate(lines[0][2:].split(","))
+               if name and (fields is None or name in fields)]
+    records = []
+    for row in csv.reader(line for line in lines[1:] if line):
+        record = {}
+        for index, name, numeric in columns:
+            if index >= len(row):
+                break
+            value = row[index]
+            if numeric:
+                value = convert_number(value)
+            record[name] = value
+        records.append(record)
+    return records
+
+
+def show_stat(socket_path=DEFAULT_SOCKET, timeout=DEFAULT_TIMEOUT,
+              fields=None):
+    """Return the parsed 'show stat' records from haproxy."""
+    return parse_stat(send_command("show stat", socket_path, timeout),
+                      fields)
+
+
+def cached_show_stat(cache_file, max_age, socket_path=DEFAULT_SOCKET,
+                     timeout=DEFAULT_TIMEOUT, fields=None):
+    """
+    Return the parsed 'show stat' records from a snapshot shared through
+    'cache_file', which is only read again from haproxy once older than
+    'max_age' seconds. This lets tools running many short-lived processes,
+    such as munin plugins, read haproxy once per run.
+    """
+    try:
+        if time.time() - os.path.getmtime(cache_file) < max_age:
+            with open(cache_file) as f:
+                return parse_stat(f.read(), fields)
+    except (IOError, OSError):
+        pass
+    data = send_command("show stat", socket_path, timeout)
+    temp_file = "%s.%d" % (cache_file, os.getpid())
+    try:
+        with open(temp_file, "w") as f:
+            f.write(data)
+        os.rename(temp_file, cache_file)
+    except (IOError, OSError):
+        pass
+    return parse_stat(data, fields)
+
+
+def parse_info(data):
+    """
+    Parse the output of 'show info' into a dict, with numeric values
+    converted to integers.
+    """
+    info = {}
+    for line in data.splitlines():
+        name, separator, value = line.partition(":")
+        if not separator:
+            continue
+        info[name.strip()] = convert_number(value.strip())
+    return info
+
+
+def show_info(socket_path=DEFAULT_SOCKET, timeout=DEFAULT_TIMEOUT):
+    """Return the parsed 'show info' of haproxy."""
+    return parse_info(send_command("show info", socket_path, timeout))
+
+
+def group_by_proxy(records):
+    """
+    Group 'show stat' records by proxy name, returning a mapping of proxy
+    name to a dict with the 'frontend' and 'backend' records (or None), and
+    the list of 'servers' records.
+    """
+    proxies = {}
+    for record in records:
+        proxy = proxies.setdefault(
+            record["pxname"],
+            {"frontend": None, "backend": None, "servers": []})
+        if record.get("type") == TYPE_FRONTEND:
+            proxy["frontend"] = record
+        elif record.get("type") == TYPE_BACKEND:
+            proxy["backend"] = record
+        elif record.get("type") == TYPE_SERVER:
+            proxy["servers"].append(record)
+    return proxies
+
+
+def is_server_up(record):
+    """
+    Return whether the given server record is in service. Servers without
+    health checks, draining, or on their way down are still considered up.
+    """
+    status = record.get("status") or ""
+    return not status.startswith(("DOWN", "MAINT"))
@@ -1,18 +1,38 @@
 #!/usr/bin/env python
 
 import base64
+import copy
+import cProfile
 import glob
+import grp
+import hashlib
+import json
 import os
+import pwd
 import re
 import socket
 import shutil
 import subprocess
 import sys
+import time
 import yaml
+import zlib
 
+from contextlib import contextmanager
+from distutils.sysconfig import get_python_lib
 from itertools import izip, tee, groupby
 
-from charmhelpers.core.host import pwgen
+import haproxy_stats
+
+from charmhelpers.core.host import (
+    pwgen,
+    add_user_to_group,
+    mkdir,
+    service_restart,
+    service_running,
+    service_start,
+    service_stop,
+    )
 from charmhelpers.core.hookenv import (
     log,
     config as config_get,
@@ -28,15 +48,54 @@ from charmhelpers.core.hookenv import (
 from charmhelpers.fetch import apt_install
 from charmhelpers.contrib.charmsupport import nrpe
 
+# LibYAML parses and dumps services an order of magnitude faster.
+try:
+    from yaml import CSafeLoader as YAMLLoader, CSafeDumper as YAMLDumper
+except ImportError:
+    from yaml import SafeLoader as YAMLLoader, SafeDumper as YAMLDumper
+
 
 ###############################################################################
 # Global variables
 ###############################################################################
 default_haproxy_config_dir = "/etc/haproxy"
 default_haproxy_config = "%s/haproxy.cfg" % default_haproxy_config_dir
+default_haproxy_config_parts_dir = "%s/conf.d" % default_haproxy_config_dir
+default_haproxy_environment_file = "/etc/default/haproxy"
 default_haproxy_service_config_dir = "/var/run/haproxy"
 default_haproxy_lib_dir = "/var/lib/haproxy"
+default_charm_state_file = "%s/charm-state.yaml" % default_haproxy_lib_dir
+default_haproxy_stats_socket = "%s/stats.sock" % default_haproxy_lib_dir
+default_resolv_conf = "/etc/resolv.conf"
+default_resolvers_name = "dns"
 service_affecting_packages = ['haproxy']
+default_server_weight = 100
+default_agent_inter = "2s"
+released_server_ids_reserve = 32
+released_service_port_cooldown = 24 * 60 * 60
+all_services_encoding = "zlib+base64"
+default_upstart_dir = "/etc/init"
+default_haproxy_ctl_path = "/usr/local/bin/haproxy-ctl"
+default_exporter_path = "/usr/local/bin/haproxy-exporter"
+default_exporter_job = "%s/haproxy-exporter.conf" % default_upstart_dir
+default_log_analyzer_path = "/usr/local/bin/haproxy-log-analyzer"
+default_log_analyzer_job = "%s/haproxy-log-analyzer.conf" % default_upstart_dir
+default_latency_summary = "%s/latency/summary.json" % default_haproxy_lib_dir
+default_munin_plugin = "/usr/local/share/munin/plugins/haproxy_"
+default_munin_plugins_dir = "/etc/munin/plugins"
+default_munin_plugin_conf = "/etc/munin/plugin-conf.d/haproxy"
+default_hook_timings_file = "%s/hook-timings.jsonl" % default_haproxy_lib_dir
+default_hook_profiles_dir = "%s/hook-profiles" % default_haproxy_lib_dir
+hook_timings_max_size = 1024 * 1024
+
+# Durations of the phases of the running hook, as (phase, seconds), nested
+# phases being named after their parents ("config_changed.services").
+hook_phases = []
+hook_phase_stack = []
+# Services of the running hook, built once and shared by its consumers.
+hook_services = {}
+# YAML parsed during the running hook, by the SHA-1 of its content.
+hook_yaml_cache = {}
 
 dupe_options = [
     "mode tcp",
@@ -53,6 +112,7 @@ frontend_only_options = [
     "capture response header",
     "clitimeout",
     "default_backend",
+    "log-format",
     "maxconn",
     "monitor fail",
     "monitor-net",
@@ -76,6 +136,54 @@ frontend_only_options = [
     "use_backend",
     ]
 
+# Built-in log formats, as tuples of (HTTP format, TCP format), before being
+# escaped for the configuration file. A None format leaves the logs of such
+# frontends to 'option httplog' or 'option tcplog'. The "json" format has the
+# URI go through the json converter, as it may contain any character.
+log_format_presets = {
+    "json": (
+        '{"timestamp":%Ts.%ms,"client_ip":"%ci","client_port":%cp,'
+        '"frontend":"%f","backend":"%b","server":"%s",'
+        '"Tq":%Tq,"Tw":%Tw,"Tc":%Tc,"Tr":%Tr,"Ta":%Ta,"Tt":%Tt,'
+        '"status":%ST,"bytes_read":%B,"termination_state":"%tsc",'
+        '"actconn":%ac,"feconn":%fc,"beconn":%bc,"srv_conn":%sc,'
+        '"retries":"%rc","srv_queue":%sq,"backend_queue":%bq,'
+        '"method":"%HM","uri":%{+Q}[capture.req.uri,json(utf8s)],'
+        '"version":"%HV"}',
+        '{"timestamp":%Ts.%ms,"client_ip":"%ci","client_port":%cp,'
+        '"frontend":"%f","backend":"%b","server":"%s",'
+        '"Tw":%Tw,"Tc":%Tc,"Tt":%Tt,'
+        '"bytes_read":%B,"termination_state":"%ts",'
+        '"actconn":%ac,"feconn":%fc,"beconn":%bc,"srv_conn":%sc,'
+        '"retries":"%rc","srv_queue":%sq,"backend_queue":%bq}'),
+    "extended-clf": (
+        '%ci - - [%trg] %{+Q}r %ST %B "" "" %cp %ms %ft %b %s '
+        '%Tq %Tw %Tc %Tr %Ta %tsc %ac %fc %bc %sc %rc %sq %bq',
+        None),
+    "timing-only": (
+        '%ft %b/%s Tq=%Tq Tw=%Tw Tc=%Tc Tr=%Tr Ta=%Ta Tt=%Tt status=%ST '
+        'retries=%rc queue=%sq/%bq',
+        '%ft %b/%s Tw=%Tw Tc=%Tc Tt=%Tt retries=%rc queue=%sq/%bq'),
+    }
+
+# Server keywords only meaningful for servers running their own health
+# checks, with the number of arguments they take.
+check_server_keywords = {
+    "check": 0,
+    "check-send-proxy": 0,
+    "check-ssl": 0,
+    "addr": 1,
+    "port": 1,
+    "inter": 1,
+    "fastinter": 1,
+    "downinter": 1,
+    "rise": 1,
+    "fall": 1,
+    "observe": 1,
+    "error-limit": 1,
+    "on-error": 1,
+    }
+
 
 ###############################################################################
 # Supporting functions
@@ -95,17 +203,181 @@ def ensure_package_status(packages, status):
         dpkg.communicate(input=selections)
 
 
+#------------------------------------------------------------------------------
+# load_yaml:  Parses YAML, only once per hook for a given content.  Callers
+#             get their own copy of the data, free to modify it.
+#------------------------------------------------------------------------------
+def load_yaml(data):
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    key = hashlib.sha1(data).hexdigest()
+    if key not in hook_yaml_cache:
+        hook_yaml_cache[key] = yaml.load(data, Loader=YAMLLoader)
+    return copy.deepcopy(hook_yaml_cache[key])
+
+
+#------------------------------------------------------------------------------
+# dump_yaml:  Dumps data as YAML, only using standard tags.
+#------------------------------------------------------------------------------
+def dump_yaml(data, **kwargs):
+    return yaml.dump(data, Dumper=YAMLDumper, **kwargs)
+
+
+#------------------------------------------------------------------------------
+# load_charm_state:  Returns the value stored under the given key in the
+#                    persisted charm state, or the given default.
+#------------------------------------------------------------------------------
+def load_charm_state(key, default=None):
+    if not os.path.exists(default_charm_state_file):
+        return default
+    with open(default_charm_state_file) as f:
+        state = load_yaml(f.read()) or {}
+    return state.get(key, default)
+
+
+#------------------------------------------------------------------------------
+# save_charm_state:  Stores the given value under the given key in the
+#                    persisted charm state, which survives across hooks.
+#------------------------------------------------------------------------------
+def save_charm_state(key, value):
+    state = {}
+    if os.path.exists(default_charm_state_file):
+        with open(default_charm_state_file) as f:
+            state = load_yaml(f.read()) or {}
+    state[key] = value
+    state_dir = os.path.dirname(default_charm_state_file)
+    if not os.path.exists(state_dir):
+        os.makedirs(state_dir)
+    temp_file = default_charm_state_file + ".new"
+    with open(temp_file, 'w') as f:
+        f.write(dump_yaml(state, default_flow_style=False))
+    os.rename(temp_file, default_charm_state_file)
+
+
+#------------------------------------------------------------------------------
+# write_managed_file:  Writes the given content to a file unless it already
+#                      has it, returning whether the file changed.
+#------------------------------------------------------------------------------
+def write_managed_file(path, content, mode=0644):
+    if os.path.exists(path):
+        with open(path) as f:
+            if f.read() == content:
+                return False
+    temp_file = path + ".new"
+    with open(temp_file, 'w') as f:
+        f.write(content)
+    os.chmod(temp_file, mode)
+    os.rename(temp_file, path)
+    return True
+
+
+#------------------------------------------------------------------------------
+# timed_phase:  Context manager recording how long the enclosed phase of the
+#               running hook takes.
+#------------------------------------------------------------------------------
+@contextmanager
+def timed_phase(name):
+    hook_phase_stack.append(name)
+    phase = ".".join(hook_phase_stack)
+    start = time.time()
+    try:
+        yield
+    finally:
+        hook_phases.append((phase, time.time() - start))
+        hook_phase_stack.pop()
+
+
+#------------------------------------------------------------------------------
+# write_hook_timing:  Appends a record of the hook run and its phases to the
+#                     hook timings file, rotating it once it gets large.
+#------------------------------------------------------------------------------
+def write_hook_timing(hook_name, duration, status):
+    record = {
+        "hook": hook_name,
+        "unit": os.environ.get("JUJU_UNIT_NAME"),
+        "timestamp": time.time(),
+        "duration": round(duration, 6),
+        "status": status,
+        "phases": [{"phase": phase, "duration": round(seconds, 6)}
+                   for phase, seconds in hook_phases],
+        }
+    try:
+        if (os.path.exists(default_hook_timings_file) and
+                os.path.getsize(default_hook_timings_file) >
+                hook_timings_max_size):
+            os.rename(default_hook_timings_file,
+                      default_hook_timings_file + ".1")
+        with open(default_hook_timings_file, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + "\n")
+    except (IOError, OSError), e:
+        log("Failed to write hook timings: %s" % e)
+
+
+#------------------------------------------------------------------------------
+# write_hook_profile:  Dumps the profile of a hook run, in the pstats format,
+#                      keeping only the most recent profiles.
+#------------------------------------------------------------------------------
+def write_hook_profile(profiler, hook_name, keep=50):
+    try:
+        if not os.path.exists(default_hook_profiles_dir):
+            os.makedirs(default_hook_profiles_dir)
+        profiler.dump_stats(os.path.join(
+            default_hook_profiles_dir,
+            "%s-%s.prof" % (hook_name, time.strftime("%Y%m%dT%H%M%S"))))
+        profiles = sorted(
+            glob.glob(os.path.join(default_hook_profiles_dir, "*.prof")),
+            key=os.path.getmtime)
+        for path in profiles[:-keep]:
+            os.remove(path)
+    except (IOError, OSError), e:
+        log("Failed to write hook profile: %s" % e)
+
+
 #------------------------------------------------------------------------------
 # enable_haproxy:  Enabled haproxy at boot time
 #------------------------------------------------------------------------------
 def enable_haproxy():
-    default_haproxy = "/etc/default/haproxy"
+    default_haproxy = default_haproxy_environment_file
     with open(default_haproxy) as f:
         enabled_haproxy = f.read().replace('ENABLED=0', 'ENABLED=1')
     with open(default_haproxy, 'w') as f:
         f.write(enabled_haproxy)
 
 
+#------------------------------------------------------------------------------
+# set_haproxy_config_files:  Makes haproxy load the given configuration files
+#                            after the main one, through the extra options of
+#                            /etc/default/haproxy, keeping the other options
+#                            there.  Returns whether the options changed.
+#------------------------------------------------------------------------------
+def set_haproxy_config_files(config_files):
+    default_haproxy = default_haproxy_environment_file
+    content = ""
+    if os.path.exists(default_haproxy):
+        with open(default_haproxy) as f:
+            content = f.read()
+    options = []
+    match = re.search('^EXTRAOPTS="?([^"\n]*)"?$', content, re.M)
+    if match is not None:
+        tokens = iter(match.group(1).split())
+        for token in tokens:
+            if token == "-f":
+                next(tokens, None)
+            else:
+                options.append(token)
+    for config_file in config_files:
+        options.extend(["-f", config_file])
+    extra_options = 'EXTRAOPTS="%s"' % " ".join(options)
+    if match is not None:
+        content = "%s%s%s" % (content[:match.start()], extra_options,
+                              content[match.end():])
+    else:
+        if content and not content.endswith("\n"):
+            content += "\n"
+        content += extra_options + "\n"
+    return write_managed_file(default_haproxy, content)
+
+
 #------------------------------------------------------------------------------
 # create_haproxy_globals:  Creates the global section of the haproxy config
 #------------------------------------------------------------------------------
@@ -125,6 +397,17 @@ def create_haproxy_globals():
         haproxy_globals.append("    quiet")
     haproxy_globals.append("    spread-checks %d" %
                            config_data['global_spread_checks'])
+    haproxy_globals.append(
+        "    stats socket %s mode %s group %s level admin" %
+        (get_stats_socket(config_data),
+         config_data.get('stats_socket_mode') or "660",
+         config_data['global_group']))
+    if config_data.get('stats_socket_timeout'):
+        haproxy_globals.append("    stats timeout %s" %
+                               config_data['stats_socket_timeout'])
+    if config_data.get('server_state_file'):
+        haproxy_globals.append("    server-state-file %s" %
+                               config_data['server_state_file'])
     return '\n'.join(haproxy_globals)
 
 
@@ -144,9 +427,73 @@ def create_haproxy_defaults():
     haproxy_defaults.append("    retries %d" % config_data['default_retries'])
     for timeout_item in default_timeouts:
         haproxy_defaults.append("    timeout %s" % timeout_item.strip())
+    if config_data.get('server_state_file'):
+        haproxy_defaults.append("    load-server-state-from-file global")
     return '\n'.join(haproxy_defaults)
 
 
+#------------------------------------------------------------------------------
+# is_ip_address:  Returns whether the given host is an IPv4 or IPv6 address
+#                 rather than a hostname
+#------------------------------------------------------------------------------
+def is_ip_address(host):
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            socket.inet_pton(family, host)
+            return True
+        except (socket.error, ValueError):
+            pass
+    return False
+
+
+#------------------------------------------------------------------------------
+# get_nameservers:  Returns the list of nameserver addresses (ip:port) to use
+#                   from the 'dns_resolvers' setting, either a list of
+#                   addresses or 'resolv.conf' to use the host nameservers
+#------------------------------------------------------------------------------
+def get_nameservers(dns_resolvers, resolv_conf=default_resolv_conf):
+    if dns_resolvers.strip() == "resolv.conf":
+        addresses = []
+        if os.path.exists(resolv_conf):
+            with open(resolv_conf) as f:
+                for line in f:
+                    fields = line.split()
+                    if len(fields) > 1 and fields[0] == "nameserver":
+                        addresses.append(fields[1])
+    else:
+        addresses = dns_resolvers.replace(",", " ").split()
+    nameservers = []
+    for address in addresses:
+        if is_ip_address(address):
+            address = "%s:53" % address
+        nameservers.append(address)
+    return nameservers
+
+
+#------------------------------------------------------------------------------
+# create_haproxy_resolvers:  Creates the resolvers section of the haproxy
+#                            config, or None if DNS resolution is disabled
+#------------------------------------------------------------------------------
+def create_haproxy_resolvers():
+    config_data = config_get()
+    if not config_data.get('dns_resolvers'):
+        return None
+    nameservers = get_nameservers(config_data['dns_resolvers'])
+    if not nameservers:
+        log("No nameservers found for DNS resolution.")
+        return None
+    haproxy_resolvers = []
+    haproxy_resolvers.append("resolvers %s" % default_resolvers_name)
+    for index, nameserver in enumerate(nameservers):
+        haproxy_resolvers.append("    nameserver dns%d %s" %
+                                 (index + 1, nameserver))
+    haproxy_resolvers.append("    resolve_retries 3")
+    haproxy_resolvers.append("    timeout retry 1s")
+    haproxy_resolvers.append("    hold valid %s" %
+                             config_data.get('dns_hold_valid', '10s'))
+    return '\n'.join(haproxy_resolvers)
+
+
 #------------------------------------------------------------------------------
 # load_haproxy_config:  Convenience function that loads (as a string) the
 #                       current haproxy configuration file.
@@ -155,7 +502,13 @@ def create_haproxy_defaults():
 #------------------------------------------------------------------------------
 def load_haproxy_config(haproxy_config_file="/etc/haproxy/haproxy.cfg"):
     if os.path.isfile(haproxy_config_file):
-        return open(haproxy_config_file).read()
+        haproxy_config = open(haproxy_config_file).read()
+        # The charm's configuration continues in the files of its parts dir.
+        if haproxy_config_file == default_haproxy_config:
+            for config_file in get_haproxy_config_files():
+                with open(config_file) as f:
+                    haproxy_config += "\n\n" + f.read()
+        return haproxy_config
     else:
         return None
 
@@ -209,19 +562,75 @@ def get_listen_stanzas(haproxy_config_file="/etc/haproxy/haproxy.cfg"):
                    for addr, port, service in bind_stanzas)))
 
 
+#------------------------------------------------------------------------------
+# get_proxy_names: Convenience function that scans the existing haproxy
+#                  configuration file and returns a list of the frontends and
+#                  backends configured, as tuples of (kind, name).
+#------------------------------------------------------------------------------
+def get_proxy_names(haproxy_config_file="/etc/haproxy/haproxy.cfg"):
+    haproxy_config = load_haproxy_config(haproxy_config_file)
+    if haproxy_config is None:
+        return []
+    proxies = []
+    for section, name in re.findall(
+            r"^\s*(frontend|backend|listen)\s+([^\s]+)", haproxy_config,
+            re.M):
+        if name == "haproxy_monitoring":
+            continue
+        if section in ("frontend", "listen"):
+            proxies.append(("frontend", name))
+        if section in ("backend", "listen"):
+            proxies.append(("backend", name))
+    return proxies
+
+
+#------------------------------------------------------------------------------
+# get_listen_ports:  Returns the ports haproxy listens on for the given
+#                    services and the monitoring stanza, as tuples of (port,
+#                    protocol).
+#------------------------------------------------------------------------------
+def get_listen_ports(services_dict, config_data):
+    ports = set()
+    for service in (services_dict or {}).itervalues():
+        ports.add((int(service["service_port"]), "TCP"))
+    if config_data.get('enable_monitoring') is True:
+        ports.add((int(config_data['monitoring_port']), "TCP"))
+    return ports
+
+
+#------------------------------------------------------------------------------
+# get_open_ports:  Returns the service ports opened by the charm, as tuples
+#                  of (port, protocol).  Before they were recorded, those were
+#                  the ports of the current haproxy configuration.
+#------------------------------------------------------------------------------
+def get_open_ports():
+    open_ports = load_charm_state("open_ports")
+    if open_ports is None:
+        return set((port, "TCP") for port in get_service_ports())
+    return set((port, protocol) for port, protocol in open_ports)
+
+
 #------------------------------------------------------------------------------
 # update_service_ports:  Convenience function that evaluate the old and new
 #                        service ports to decide which ports need to be
-#                        opened and which to close
+#                        opened and which to close, only running open-port
+#                        and close-port for the differences, and records the
+#                        open ports.  Ports are given as tuples of (port,
+#                        protocol), or as port numbers for TCP.
 #------------------------------------------------------------------------------
 def update_service_ports(old_service_ports=None, new_service_ports=None):
     if old_service_ports is None or new_service_ports is None:
         return None
-    for port in old_service_ports:
-        if port not in new_service_ports:
-            close_port(port)
-    for port in new_service_ports:
-        open_port(port)
+    old_ports, new_ports = [
+        set(port if isinstance(port, tuple) else (port, "TCP")
+            for port in ports)
+        for ports in (old_service_ports, new_service_ports)]
+    for port, protocol in sorted(old_ports - new_ports):
+        close_port(port, protocol)
+    for port, protocol in sorted(new_ports - old_ports):
+        open_port(port, protocol)
+    save_charm_state("open_ports", [[port, protocol]
+                                    for port, protocol in sorted(new_ports)])
 
 
 #------------------------------------------------------------------------------
@@ -237,6 +646,21 @@ def update_sysctl(config_data):
         subprocess.call(["sysctl", "-p", "/etc/sysctl.d/50-haproxy.conf"])
 
 
+#------------------------------------------------------------------------------
+# is_http_mode: Returns whether a service with the given options runs in http
+#               mode, set in its options or, failing that, by 'default_mode'.
+#------------------------------------------------------------------------------
+def is_http_mode(service_options, config_data=None):
+    service_options = [option.strip() for option in service_options or []]
+    if "mode tcp" in service_options:
+        return False
+    if "mode http" in service_options:
+        return True
+    if config_data is None:
+        config_data = config_get()
+    return config_data.get('default_mode') != "tcp"
+
+
 #------------------------------------------------------------------------------
 # create_listen_stanza: Function to create a generic listen section in the
 #                       haproxy config
@@ -253,10 +677,13 @@ def update_sysctl(config_data):
 #                                   http_status: status to handle
 #                                   content: base 64 content for HAProxy to
 #                                            write to socket
+#                       rate_limit: Dict of per-source limits, see
+#                                   create_rate_limit_options
 #------------------------------------------------------------------------------
 def create_listen_stanza(service_name=None, service_ip=None,
                          service_port=None, service_options=None,
-                         server_entries=None, service_errorfiles=None):
+                         server_entries=None, service_errorfiles=None,
+                         rate_limit=None):
     if service_name is None or service_ip is None or service_port is None:
         return None
     fe_options = []
@@ -286,6 +713,10 @@ def create_listen_stanza(service_name=None, service_ip=None,
     service_config.append("    default_backend %s" % (service_name,))
     service_config.extend("    %s" % service_option.strip()
                           for service_option in fe_options)
+    if rate_limit:
+        service_config.extend(
+            "    %s" % option for option in create_rate_limit_options(
+                service_name, rate_limit, is_http_mode(fe_options)))
     service_config.append("")
     service_config.append("backend %s" % (service_name,))
     service_config.extend("    %s" % service_option.strip()
@@ -311,6 +742,58 @@ def create_listen_stanza(service_name=None, service_ip=None,
     return '\n'.join(service_config)
 
 
+#------------------------------------------------------------------------------
+# rate_limit_allowlist_path: Path of the ACL file listing the source CIDRs
+#                            exempted from rate limiting for a service
+#------------------------------------------------------------------------------
+def rate_limit_allowlist_path(service_name):
+    return os.path.join(default_haproxy_lib_dir, "service_%s" % service_name,
+                        "rate_limit_allowlist.acl")
+
+
+#------------------------------------------------------------------------------
+# create_rate_limit_options: Creates the frontend options implementing a
+#                            per-source rate limit, tracked in a stick-table
+#                            rate_limit: Dict of
+#                              conn_cur: max concurrent connections per source
+#                              http_req_rate: max HTTP requests per source
+#                                             over 'period' (http mode only)
+#                              period: rate period, defaults to 10s
+#                              action: deny (default) or tarpit, for requests
+#                                      over the rate
+#                              table_size: stick-table size, defaults to 100k
+#                              expire: stick-table expiry, defaults to 60s
+#                              allowlist: list of CIDRs never limited
+#------------------------------------------------------------------------------
+def create_rate_limit_options(service_name, rate_limit, http_mode=True):
+    conn_cur = rate_limit.get("conn_cur")
+    http_req_rate = http_mode and rate_limit.get("http_req_rate")
+    if not (conn_cur or http_req_rate):
+        return []
+    period = rate_limit.get("period", "10s")
+    stored = []
+    if conn_cur:
+        stored.append("conn_cur")
+    if http_req_rate:
+        stored.append("http_req_rate(%s)" % period)
+    options = ["stick-table type ip size %s expire %s store %s" % (
+        rate_limit.get("table_size", "100k"),
+        rate_limit.get("expire", "60s"), ",".join(stored))]
+    track = "tcp-request connection track-sc0 src"
+    if rate_limit.get("allowlist"):
+        options.append("acl rate_limit_allowed src -f %s" %
+                       rate_limit_allowlist_path(service_name))
+        track += " unless rate_limit_allowed"
+    options.append(track)
+    if conn_cur:
+        options.append("tcp-request connection reject "
+                       "if { sc0_conn_cur gt %d }" % int(conn_cur))
+    if http_req_rate:
+        options.append("http-request %s if { sc0_http_req_rate gt %d }" % (
+            rate_limit.get("action", "deny"), int(http_req_rate)))
+    return options
+
+
 #------------------------------------------------------------------------------
 # create_monitoring_stanza:  Function to create the haproxy monitoring section
 #                            service_name: Arbitrary name
@@ -360,7 +843,7 @@ def parse_services_yaml(services, yaml_data):
     that you union multiple services "server" entries, as these are the haproxy
     backends that are contacted.
     """
-    yaml_services = yaml.safe_load(yaml_data)
+    yaml_services = load_yaml(yaml_data)
     if yaml_services is None:
         return services
 
@@ -410,6 +893,18 @@ def merge_service(old_service, new_service):
 
 
 def ensure_service_host_port(services):
+    """
+    Give the services without a host and port one, which stays stable
+    across config regenerations, so that adding or removing a service
+    doesn't move the ports of the others.
+
+    Allocated ports are persisted by service name. The port of a service
+    that went away stays reserved for it, should it come back, for
+    'released_service_port_cooldown' seconds before being handed out to
+    another service. New services get the first free port, two by two from
+    the highest explicit port, or from the monitoring port. The port after
+    each service port is kept free for its peer backend.
+    """
     config_data = config_get()
     seen = []
     missing = []
@@ -423,12 +918,59 @@ def ensure_service_host_port(services):
         seen.append((options["service_host"], int(options["service_port"])))
 
     seen.sort()
-    last_port = seen and seen[-1][1] or int(config_data["monitoring_port"])
+    monitoring_port = int(config_data["monitoring_port"])
+    first_port = (seen and seen[-1][1] or monitoring_port) + 2
+    allocation = load_charm_state("service_ports",
+                                  {"ports": {}, "released": []})
+    now = time.time()
+
+    # Release the ports of the services that went away, and forget the ones
+    # released long enough ago.
+    missing_names = set(options["service_name"] for options in missing)
+    for service_name, port in sorted(allocation["ports"].items()):
+        if service_name not in missing_names:
+            del allocation["ports"][service_name]
+            allocation["released"].append([service_name, port, now])
+    allocation["released"] = [
+        released for released in allocation["released"]
+        if now - released[2] < released_service_port_cooldown]
+
+    # Services use their port and the next one, for their peer backend.
+    used_ports = set([monitoring_port])
+    for _, port in seen:
+        used_ports.update((port, port + 1))
+    reserved_ports = set()
+    for _, port, _ in allocation["released"]:
+        reserved_ports.update((port, port + 1))
+    for service_name, port in allocation["ports"].items():
+        if not used_ports.isdisjoint((port, port + 1)):
+            del allocation["ports"][service_name]
+        else:
+            reserved_ports.update((port, port + 1))
     for options in missing:
-        last_port += 2
+        service_name = options["service_name"]
+        port = allocation["ports"].get(service_name)
+        if port is None:
+            for released_name, released_port, _ in allocation["released"]:
+                if (released_name == service_name and used_ports.isdisjoint(
+                        (released_port, released_port + 1))):
+                    port = released_port
+                    break
+        if port is None:
+            port = first_port
+            while not (used_ports.isdisjoint((port, port + 1)) and
+                       reserved_ports.isdisjoint((port, port + 1))):
+                port += 2
+        used_ports.update((port, port + 1))
+        reserved_ports.update((port, port + 1))
+        allocation["ports"][service_name] = port
+        allocation["released"] = [
+            released for released in allocation["released"]
+            if released[1] != port]
         options["service_host"] = "0.0.0.0"
-        options["service_port"] = last_port
+        options["service_port"] = port
 
+    save_charm_state("service_ports", allocation)
     return services
 
 
@@ -447,20 +989,27 @@ def is_proxy(service_name):
 
 
 #------------------------------------------------------------------------------
-# create_services:  Function that will create the services configuration
-#                   from the config data and/or relation information
+# build_services:  Function that will build the services configuration
+#                  from the config data and/or relation information. It
+#                  doesn't write the service snippets, but saves the ports
+#                  and server ids it allocates to the charm state, so that
+#                  they stay stable across hooks.
 #------------------------------------------------------------------------------
-def create_services():
-    services_dict = get_config_services()
+def build_services():
+    with timed_phase("parse_services"):
+        services_dict = get_config_services()
+    resolvers_enabled = bool(config_get().get('dns_resolvers'))
 
     # Augment services_dict with service definitions from relation data.
-    relation_data = relations_of_type("reverseproxy")
+    with timed_phase("relations"):
+        relation_data = relations_of_type("reverseproxy")
 
     # Handle relations which specify their own services clauses
-    for relation_info in relation_data:
-        if "services" in relation_info:
-            services_dict = parse_services_yaml(services_dict,
-                                                relation_info['services'])
+    with timed_phase("parse_services"):
+        for relation_info in relation_data:
+            if "services" in relation_info:
+                services_dict = parse_services_yaml(
+                    services_dict, relation_info['services'])
 
     if len(services_dict) == 0:
         log("No services configured, exiting.")
@@ -519,14 +1068,32 @@ def create_services():
         if not service_names:
             service_names.add(services_dict[None]["service_name"])
 
+        # With DNS resolvers, units publishing a hostname are resolved at
+        # runtime, so that address changes don't need a new hook to apply.
+        resolve_options = []
+        hostname = relation_info.get('hostname')
+        if resolvers_enabled and hostname and not is_ip_address(hostname):
+            host = hostname
+            resolve_options.append("resolvers %s init-addr last,libc,none" %
+                                   default_resolvers_name)
+
+        # Optional agent port, the unit reports its own weight through it
+        agent_port = relation_info.get('agent-port')
+
         for service_name in service_names:
             service = services_dict[service_name]
+            server_options = service.get('server_options', [])
+            if agent_port:
+                server_options = list(server_options) + [
+                    "agent-check agent-port %s agent-inter %s" % (
+                        agent_port,
+                        service.get('agent_inter', default_agent_inter))]
+            if resolve_options:
+                server_options = list(server_options) + resolve_options
 
             # Add the server entries
             servers = service.setdefault("servers", [])
-            servers.append((server_name, host, port,
-                            services_dict[service_name].get(
-                                'server_options', [])))
+            servers.append((server_name, host, port, server_options))
 
     has_servers = False
     for service_name, service in services_dict.iteritems():
@@ -538,22 +1105,97 @@ def create_services():
         return
 
     del services_dict[None]
-    services_dict = ensure_service_host_port(services_dict)
-    services_dict = apply_peer_config(services_dict)
-    write_service_config(services_dict)
+    with timed_phase("apply"):
+        services_dict = ensure_service_host_port(services_dict)
+        services_dict = apply_peer_config(services_dict)
+        services_dict = apply_hash_config(services_dict)
+        services_dict = apply_health_checks(services_dict)
+        services_dict = apply_check_tracking(services_dict)
+        services_dict = apply_log_format(services_dict)
+        services_dict = allocate_server_ids(services_dict)
     return services_dict
 
 
+#------------------------------------------------------------------------------
+# create_services:  Builds the services configuration and writes the service
+#                   snippets, keeping the services for the rest of the hook.
+#------------------------------------------------------------------------------
+def create_services():
+    services_dict = build_services()
+    hook_services.clear()
+    hook_services["services"] = services_dict
+    if services_dict is not None:
+        with timed_phase("write"):
+            write_service_config(services_dict)
+    return services_dict
+
+
+#------------------------------------------------------------------------------
+# get_services:  Returns the services of the running hook, only building them
+#                when no earlier step of the hook did.
+#------------------------------------------------------------------------------
+def get_services():
+    if "services" not in hook_services:
+        hook_services["services"] = build_services()
+    return hook_services["services"]
+
+
+#------------------------------------------------------------------------------
+# get_published_services:  Returns the settings publishing the services of
+#                          the running hook to the website and peer
+#                          relations: their YAML, compressed when larger than
+#                          'all_services_compress_size', and its digest. The
+#                          encoding is always set, even when empty, so that
+#                          it doesn't outlive a compressed payload.
+#------------------------------------------------------------------------------
+def get_published_services():
+    if "published" not in hook_services:
+        services_dict = get_services()
+        all_services = ""
+        if services_dict is not None:
+            all_services = dump_yaml(sorted(services_dict.itervalues()))
+        settings = {
+            "all_services": all_services,
+            "all_services_digest": hashlib.sha1(all_services).hexdigest(),
+            "all_services_encoding": "",
+            }
+        compress_size = config_get().get('all_services_compress_size')
+        if compress_size and len(all_services) > compress_size:
+            settings["all_services"] = base64.b64encode(
+                zlib.compress(all_services, 9))
+            settings["all_services_encoding"] = all_services_encoding
+        hook_services["published"] = settings
+    return hook_services["published"]
+
+
+#------------------------------------------------------------------------------
+# get_relation_services:  Returns the services YAML published by a remote
+#                         unit, decompressing it if needed. Returns None when
+#                         it can't be decoded.
+#------------------------------------------------------------------------------
+def get_relation_services(relation_info):
+    all_services = relation_info.get("all_services")
+    if (all_services and relation_info.get("all_services_encoding") ==
+            all_services_encoding):
+        try:
+            all_services = zlib.decompress(base64.b64decode(all_services))
+        except (TypeError, zlib.error), e:
+            log("Can't decode the services of '%s', skipping: %s" % (
+                relation_info.get("__unit__"), e))
+            return None
+    return all_services
+
+
 def apply_peer_config(services_dict):
     peer_data = relations_of_type("peer")
 
     peer_services = {}
     for relation_info in peer_data:
         unit_name = relation_info["__unit__"]
-        peer_services_data = relation_info.get("all_services")
+        peer_services_data = get_relation_services(relation_info)
         if peer_services_data is None:
             continue
-        service_data = yaml.safe_load(peer_services_data)
+        service_data = load_yaml(peer_services_data)
         for service in service_data:
             service_name = service["service_name"]
             if service_name in services_dict:
@@ -583,6 +1225,17 @@ def apply_peer_config(services_dict):
             if "timeout" in option:
                 peer_service["service_options"].append(option)
 
+        # Sources must be tracked where clients connect, which is now the
+        # peer listen stanza, rather than behind it where every connection
+        # comes from a peer.
+        if "rate_limit" in original_service:
+            peer_service["rate_limit"] = original_service.pop("rate_limit")
+            # The peer listen stanza is in TCP mode, where HTTP requests
+            # can't be counted.
+            if peer_service["rate_limit"].get("http_req_rate"):
+                log("WARNING: http_req_rate of service '%s' is not applied "
+                    "with peers, only its conn_cur limit is." % service_name)
+
         servers = peer_service["servers"]
         # Add ourselves to the list of servers for the peer listen stanza.
         servers.append((unit_name, private_address,
@@ -608,6 +1261,386 @@ def apply_peer_config(services_dict):
     return services_dict
 
 
+def get_server_option_list(server):
+    """
+    Return the options of the given server entry as a list of strings.
+    """
+    server_options = server[3] or []
+    if isinstance(server_options, basestring):
+        return [server_options]
+    return list(server_options)
+
+
+def is_checked_server(server):
+    return any("check" in option.split()
+               for option in get_server_option_list(server))
+
+
+def add_server_options(server, options):
+    """
+    Return a copy of the given server entry with the given options appended
+    to its server options. The original options are never modified in
+    place, since they are often shared between all servers of a service.
+    """
+    server_options = get_server_option_list(server)
+    server_options.extend(options)
+    return type(server)((server[0], server[1], server[2], server_options))
+
+
+def get_server_id(server):
+    """
+    Return the explicit id set in the given server entry options, if any.
+    """
+    for option in get_server_option_list(server):
+        m = re.search(r"(?:^|\s)id\s+(\d+)", option)
+        if m is not None:
+            return int(m.group(1))
+    return None
+
+
+def get_server_keys(servers):
+    """
+    Return the keys identifying each of the given server entries across
+    config regenerations: the server name, which is derived from the unit
+    name, qualified by address for servers sharing a name.
+    """
+    keys = []
+    seen = set()
+    for server in servers:
+        key = server[0]
+        if key in seen:
+            key = "%s@%s:%s" % (server[0], server[1], server[2])
+        seen.add(key)
+        keys.append(key)
+    return keys
+
+
+def allocate_server_ids(services_dict):
+    """
+    Give every server an explicit id which stays stable across config
+    regenerations, so that stats counters, server state and cookie based
+    persistence keep following the same unit.
+
+    Allocated ids are persisted per backend, keyed by server name. Ids of
+    departed servers are not recycled right away: they stay reserved for
+    the same server, should it come back, and are only handed out to new
+    servers once more than 'released_server_ids_reserve' of them have
+    accumulated, oldest first.
+    """
+    allocations = load_charm_state("server_ids", {})
+    backends = set()
+    for service_config in services_dict.itervalues():
+        backend = service_config["service_name"]
+        backends.add(backend)
+        allocation = allocations.setdefault(
+            backend, {"ids": {}, "released": [], "next": 1})
+        servers = service_config.get("servers") or []
+        keys = get_server_keys(servers)
+
+        # Release the ids of the servers that went away.
+        for key, server_id in sorted(allocation["ids"].items()):
+            if key not in keys:
+                del allocation["ids"][key]
+                allocation["released"].append([key, server_id])
+
+        # Explicit ids from the services config always win.
+        used_ids = set()
+        for key, server in izip(keys, servers):
+            server_id = get_server_id(server)
+            if server_id is not None:
+                allocation["ids"][key] = server_id
+                used_ids.add(server_id)
+        allocation["released"] = [
+            released for released in allocation["released"]
+            if released[1] not in used_ids]
+
+        allocated_servers = []
+        for key, server in izip(keys, servers):
+            if get_server_id(server) is not None:
+                allocated_servers.append(server)
+                continue
+            server_id = allocation["ids"].get(key)
+            if server_id is None or server_id in used_ids:
+                server_id = reclaim_server_id(allocation, key, used_ids)
+            allocation["ids"][key] = server_id
+            used_ids.add(server_id)
+            allocated_servers.append(
+                add_server_options(server, ["id %d" % server_id]))
+        service_config["servers"] = allocated_servers
+
+    for backend in set(allocations) - backends:
+        del allocations[backend]
+    save_charm_state("server_ids", allocations)
+    return services_dict
+
+
+def reclaim_server_id(allocation, key, used_ids):
+    """
+    Pick an id for a server that doesn't have one allocated yet: its own
+    previously released id if there is one, otherwise the oldest released
+    id once the reserve is exhausted, otherwise a fresh one.
+    """
+    released = allocation["released"]
+    for index, (released_key, server_id) in enumerate(released):
+        if released_key == key and server_id not in used_ids:
+            del released[index]
+            return server_id
+    while len(released) > released_server_ids_reserve:
+        _, server_id = released.pop(0)
+        if server_id not in used_ids:
+            return server_id
+    reserved_ids = used_ids.union(released_id for _, released_id in released)
+    server_id = allocation["next"]
+    while server_id in reserved_ids:
+        server_id += 1
+    allocation["next"] = server_id + 1
+    return server_id
+
+
+def apply_hash_config(services_dict):
+    """
+    Configure services that set a 'hash_type' for hash based balancing.
+
+    Consistent hashing places servers on the hash ring according to their
+    numeric id and weight, so on top of the stable ids given to every
+    server by allocate_server_ids(), each server also gets an explicit
+    weight. Adding or removing a server then only remaps the keys that
+    belong to that server.
+    """
+    for service_name, service in services_dict.iteritems():
+        hash_type = service.get("hash_type")
+        if not hash_type:
+            continue
+        service_options = service.setdefault("service_options", [])
+        if not any(option.startswith("hash-type")
+                   for option in service_options):
+            service_options.append("hash-type %s" % hash_type)
+
+        weight = int(service.get("server_weight", default_server_weight))
+        service["servers"] = [
+            add_server_options(server, ["weight %d" % weight])
+            for server in service.get("servers", [])]
+    return services_dict
+
+
+def create_health_check_options(health_check, http_mode=True):
+    """
+    Translate a structured 'health_check' service setting into a tuple of
+    (service options, server options).
+
+    The health check may specify an HTTP check ('method', 'uri', 'version',
+    'expect'), the check timing ('inter', 'fastinter', 'downinter', 'rise',
+    'fall') and passive health checking of the traffic ('observe', which
+    defaults to layer7 for HTTP checks and layer4 otherwise, 'error_limit',
+    and 'on_error', which defaults to mark-down). Setting 'observe' to false
+    disables passive checking.
+    """
+    service_options = []
+    server_options = ["check"]
+    http_check = http_mode and "uri" in health_check
+    if http_check:
+        httpchk = "option httpchk %s %s" % (
+            health_check.get("method", "GET"), health_check["uri"])
+        if "version" in health_check:
+            httpchk += " %s" % health_check["version"]
+        service_options.append(httpchk)
+        if "expect" in health_check:
+            service_options.append(
+                "http-check expect %s" % health_check["expect"])
+    for setting in ("inter", "fastinter", "downinter", "rise", "fall"):
+        if setting in health_check:
+            server_options.append("%s %s" % (setting, health_check[setting]))
+    observe = health_check.get("observe",
+                               http_check and "layer7" or "layer4")
+    if observe:
+        server_options.append("observe %s" % observe)
+        if "error_limit" in health_check:
+            server_options.append(
+                "error-limit %s" % health_check["error_limit"])
+        server_options.append(
+            "on-error %s" % health_check.get("on_error", "mark-down"))
+    return service_options, server_options
+
+
+def apply_health_checks(services_dict):
+    """
+    Apply the 'health_check' policy of each service to all of its servers,
+    whether they come from relations or from the services configuration.
+    """
+    config_data = config_get()
+    for service in services_dict.itervalues():
+        health_check = service.get("health_check")
+        if not health_check:
+            continue
+        service_options = service.setdefault("service_options", [])
+        check_service_options, check_server_options = (
+            create_health_check_options(
+                health_check, is_http_mode(service_options, config_data)))
+        for option in check_service_options:
+            if option not in service_options:
+                service_options.append(option)
+
+        checked_servers = []
+        for server in service.get("servers", []):
+            if is_checked_server(server):
+                options = check_server_options[1:]
+            else:
+                options = check_server_options
+            checked_servers.append(add_server_options(server, options))
+        service["servers"] = checked_servers
+    return services_dict
+
+
+def escape_log_format(log_format):
+    """
+    Escape a log format for the configuration file, where it must be given
+    as a single word.
+    """
+    return re.sub(r"""([\\ "'#])""", r"\\\1", log_format)
+
+
+def create_log_format_option(log_format, http_mode=True):
+    """
+    Return the 'log-format' option for a built-in log format or a custom
+    one, or None if there is none for the frontend mode.
+    """
+    if log_format in log_format_presets:
+        http_format, tcp_format = log_format_presets[log_format]
+        log_format = http_format if http_mode else tcp_format
+    if not log_format:
+        return None
+    return "log-format %s" % escape_log_format(log_format)
+
+
+def apply_log_format(services_dict):
+    """
+    Set the log format of each service frontend, from its 'log_format'
+    setting or the 'log_format' option.
+    """
+    config_data = config_get()
+    default_log_format = config_data.get('log_format')
+    for service in services_dict.itervalues():
+        log_format = service.get("log_format", default_log_format)
+        service_options = service.get("service_options", [])
+        if not log_format or any(option.strip().startswith("log-format")
+                                 for option in service_options):
+            continue
+        option = create_log_format_option(
+            log_format, is_http_mode(service_options, config_data))
+        if option is not None:
+            service.setdefault("service_options", []).append(option)
+    return services_dict
+
+
+def split_check_options(server_options):
+    """
+    Split the given list of server options into the health check keywords
+    (with their arguments) and the remaining options.
+    """
+    check_options = []
+    remaining = []
+    for option in server_options:
+        tokens = option.split()
+        kept = []
+        while tokens:
+            token = tokens.pop(0)
+            if token in check_server_keywords:
+                nargs = check_server_keywords[token]
+                check_options.append(" ".join([token] + tokens[:nargs]))
+                del tokens[:nargs]
+            else:
+                kept.append(token)
+        if kept:
+            remaining.append(" ".join(kept))
+    return check_options, remaining
+
+
+def remove_check_options(server_options):
+    """
+    Remove the health check keywords (and their arguments) from the given
+    list of server options.
+    """
+    return split_check_options(server_options)[1]
+
+
+def is_check_service_option(option):
+    """
+    Whether the given service option changes how servers are health checked,
+    e.g. 'option httpchk', 'http-check expect' or 'default-server inter 2s'.
+    """
+    tokens = option.split()
+    if not tokens:
+        return False
+    if tokens[0] in ("http-check", "tcp-check", "external-check",
+                     "default-server"):
+        return True
+    return (tokens[0] == "option" and len(tokens) > 1 and
+            (tokens[1].endswith("chk") or tokens[1].endswith("-check")))
+
+
+def get_check_signature(service, server):
+    """
+    Return what determines the outcome of the health check of the given
+    server in the given service: the check related service options and the
+    check keywords of the server.
+    """
+    service_options = tuple(
+        option.strip() for option in service.get("service_options") or []
+        if is_check_service_option(option))
+    check_options = tuple(sorted(
+        split_check_options(get_server_option_list(server))[0]))
+    return service_options, check_options
+
+
+def apply_check_tracking(services_dict):
+    """
+    Health check servers shared by several backends only once.
+
+    A unit joining with several sitenames is added to several backends,
+    each of which would check the same address on its own. For every
+    address checked the same way (same check service options and server
+    check keywords) in more than one backend, the first backend (by name)
+    keeps the check, and the others track its state instead. Backends
+    checking the same address differently keep their own checks.
+    """
+    checked = {}
+    for service in services_dict.itervalues():
+        for server in service.get("servers") or []:
+            if is_checked_server(server):
+                key = (server[1], str(server[2]),
+                       get_check_signature(service, server))
+                checked.setdefault(key, []).append(
+                    (service["service_name"], server[0]))
+
+    tracked = {}
+    for key, servers in checked.iteritems():
+        backends = set(backend for backend, _ in servers)
+        if len(backends) < 2:
+            continue
+        canonical = min(servers)
+        for backend, server_name in servers:
+            if backend != canonical[0]:
+                tracked[(backend, server_name) + key[:2]] = canonical
+
+    if not tracked:
+        return services_dict
+
+    for service in services_dict.itervalues():
+        tracking_servers = []
+        for server in service.get("servers") or []:
+            key = (service["service_name"], server[0],
+                   server[1], str(server[2]))
+            if key in tracked:
+                server_options = remove_check_options(
+                    get_server_option_list(server))
+                server_options.append("track %s/%s" % tracked[key])
+                server = type(server)(
+                    (server[0], server[1], server[2], server_options))
+            tracking_servers.append(server)
+        service["servers"] = tracking_servers
+    return services_dict
+
+
 def write_service_config(services_dict):
     # Construct the new haproxy.cfg file
     for service_key, service_config in services_dict.items():
@@ -626,6 +1659,17 @@ def write_service_config(services_dict):
             with open(full_path, 'w') as f:
                 f.write(base64.b64decode(errorfile["content"]))
 
+        rate_limit = service_config.get('rate_limit')
+        if rate_limit and rate_limit.get('allowlist'):
+            path = rate_limit_allowlist_path(service_config['service_name'])
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            allowlist = rate_limit['allowlist']
+            if isinstance(allowlist, basestring):
+                allowlist = allowlist.split()
+            with open(path, 'w') as f:
+                f.write("".join("%s\n" % cidr for cidr in allowlist))
+
         service_name = service_config["service_name"]
         if not os.path.exists(default_haproxy_service_config_dir):
             os.mkdir(default_haproxy_service_config_dir, 0600)
@@ -636,7 +1680,7 @@ def write_service_config(services_dict):
                 service_config['service_host'],
                 service_config['service_port'],
                 service_config['service_options'],
-                server_entries, errorfiles))
+                server_entries, errorfiles, rate_limit))
 
 
 #------------------------------------------------------------------------------
@@ -696,22 +1740,140 @@ def remove_services(service_name=None):
 #                            haproxy_monitoring, haproxy_services
 #                            are all strings that will be written without
 #                            any checks.
-#                            haproxy_monitoring and haproxy_services are
-#                            optional arguments
+#                            haproxy_monitoring, haproxy_services and
+#                            haproxy_resolvers are optional arguments
 #------------------------------------------------------------------------------
 def construct_haproxy_config(haproxy_globals=None,
                              haproxy_defaults=None,
                              haproxy_monitoring=None,
-                             haproxy_services=None):
+                             haproxy_services=None,
+                             haproxy_resolvers=None):
     if None in (haproxy_globals, haproxy_defaults):
         return
-    with open(default_haproxy_config, 'w') as haproxy_config:
-        config_string = ''
-        for config in (haproxy_globals, haproxy_defaults, haproxy_monitoring,
-                       haproxy_services):
-            if config is not None:
-                config_string += config + '\n\n'
-        haproxy_config.write(config_string)
+    config_string = ''
+    for config in (haproxy_globals, haproxy_defaults, haproxy_resolvers,
+                   haproxy_monitoring, haproxy_services):
+        if config is not None:
+            config_string += config + '\n\n'
+    return write_managed_file(default_haproxy_config, config_string)
+
+
+#------------------------------------------------------------------------------
+# get_haproxy_config_parts:  Returns the parts of the haproxy configuration
+#                            loaded after haproxy.cfg, as tuples of (name,
+#                            content): the monitoring stanza, if given, and
+#                            each service snippet.
+#------------------------------------------------------------------------------
+def get_haproxy_config_parts(haproxy_monitoring=None):
+    parts = []
+    if haproxy_monitoring is not None:
+        parts.append(("haproxy_monitoring", haproxy_monitoring))
+    for service in sorted(glob.glob("%s/*.service" %
+                                    default_haproxy_service_config_dir)):
+        with open(service) as f:
+            parts.append((os.path.basename(service)[:-len(".service")],
+                          f.read()))
+    return parts
+
+
+#------------------------------------------------------------------------------
+# get_haproxy_config_files:  Returns the configuration files haproxy loads
+#                            after haproxy.cfg, in order.
+#------------------------------------------------------------------------------
+def get_haproxy_config_files():
+    return sorted(glob.glob("%s/*.cfg" % default_haproxy_config_parts_dir))
+
+
+#------------------------------------------------------------------------------
+# write_haproxy_config_parts:  Writes each part of the configuration to its
+#                              own file, only rewriting the changed ones and
+#                              removing the ones of parts that went away,
+#                              and makes haproxy load them.  Returns whether
+#                              any file changed.
+#------------------------------------------------------------------------------
+def write_haproxy_config_parts(parts):
+    if not os.path.exists(default_haproxy_config_parts_dir):
+        os.makedirs(default_haproxy_config_parts_dir)
+    changed = False
+    config_files = []
+    for name, content in sorted(parts):
+        config_file = os.path.join(default_haproxy_config_parts_dir,
+                                   "%s.cfg" % name)
+        config_files.append(config_file)
+        if write_managed_file(config_file, content + "\n\n"):
+            log("Updated %s" % config_file)
+            changed = True
+    for config_file in get_haproxy_config_files():
+        if config_file not in config_files:
+            log("Removing %s" % config_file)
+            os.remove(config_file)
+            changed = True
+    return set_haproxy_config_files(config_files) or changed
+
+
+#------------------------------------------------------------------------------
+# get_haproxy_referenced_files:  Returns the paths of the files a haproxy
+#                                configuration loads by path: errorfiles and
+#                                ACL patterns loaded with '-f'.
+#------------------------------------------------------------------------------
+def get_haproxy_referenced_files(haproxy_config):
+    return [errorfile or pattern_file for errorfile, pattern_file in
+            re.findall(r"^\s*errorfile\s+\d+\s+(\S+)|\s-f\s+(\S+)",
+                       haproxy_config, re.M)]
+
+
+#------------------------------------------------------------------------------
+# get_haproxy_config_fingerprint:  Returns a digest of haproxy.cfg, of the
+#                                  files loaded after it, and of the files
+#                                  they reference.
+#------------------------------------------------------------------------------
+def get_haproxy_config_fingerprint():
+    digest = hashlib.sha1()
+    referenced_files = []
+    for config_file in [default_haproxy_config] + get_haproxy_config_files():
+        with open(config_file) as f:
+            haproxy_config = f.read()
+        digest.update("%s\0%s\0" % (config_file, haproxy_config))
+        referenced_files.extend(get_haproxy_referenced_files(haproxy_config))
+    for referenced_file in sorted(set(referenced_files)):
+        content = ""
+        if os.path.exists(referenced_file):
+            with open(referenced_file) as f:
+                content = f.read()
+        digest.update("%s\0%s\0" % (referenced_file, content))
+    return digest.hexdigest()
+
+
+#------------------------------------------------------------------------------
+# haproxy_admin_command:  Sends a command to the haproxy stats socket and
+#                         returns the response, or None if haproxy couldn't
+#                         be reached.
+#------------------------------------------------------------------------------
+def haproxy_admin_command(command, socket_path=None):
+    try:
+        return haproxy_stats.send_command(
+            command, socket_path or get_stats_socket())
+    except socket.error, e:
+        log("Failed to send '%s' to haproxy: %s" % (command, e))
+        return None
+
+
+#------------------------------------------------------------------------------
+# save_server_state:  Dumps the current servers state (health, weights) into
+#                     the configured server-state-file, for the next haproxy
+#                     process to load on startup.
+#------------------------------------------------------------------------------
+def save_server_state():
+    server_state_file = config_get().get('server_state_file')
+    if not server_state_file:
+        return False
+    server_state = haproxy_admin_command("show servers state")
+    if not server_state:
+        return False
+    with open(server_state_file + ".new", 'w') as f:
+        f.write(server_state)
+    os.rename(server_state_file + ".new", server_state_file)
+    return True
 
 
 #------------------------------------------------------------------------------
@@ -722,8 +1884,14 @@ def service_haproxy(action=None, haproxy_config=default_haproxy_config):
     if None in (action, haproxy_config):
         return None
     elif action == "check":
-        command = ['/usr/sbin/haproxy', '-f', haproxy_config, '-c']
+        command = ['/usr/sbin/haproxy', '-f', haproxy_config]
+        if haproxy_config == default_haproxy_config:
+            for config_file in get_haproxy_config_files():
+                command.extend(['-f', config_file])
+        command.append('-c')
     else:
+        if action in ("reload", "restart"):
+            save_server_state()
         command = ['service', 'haproxy', action]
     return_value = subprocess.call(command)
     return return_value == 0
@@ -748,30 +1916,56 @@ def config_changed():
     ensure_package_status(service_affecting_packages,
                           config_data['package_status'])
 
-    old_service_ports = get_service_ports()
+    old_service_ports = get_open_ports()
     old_stanzas = get_listen_stanzas()
-    haproxy_globals = create_haproxy_globals()
-    haproxy_defaults = create_haproxy_defaults()
-    if config_data['enable_monitoring'] is True:
-        haproxy_monitoring = create_monitoring_stanza()
-    else:
-        haproxy_monitoring = None
-    remove_services()
-    if not create_services():
-        sys.exit()
-    haproxy_services = load_services()
+    with timed_phase("globals"):
+        haproxy_globals = create_haproxy_globals()
+        haproxy_defaults = create_haproxy_defaults()
+        haproxy_resolvers = create_haproxy_resolvers()
+        if config_data['enable_monitoring'] is True:
+            haproxy_monitoring = create_monitoring_stanza()
+        else:
+            haproxy_monitoring = None
+    with timed_phase("services"):
+        remove_services()
+        services_dict = create_services()
+        if not services_dict:
+            sys.exit()
+        haproxy_parts = get_haproxy_config_parts(haproxy_monitoring)
     update_sysctl(config_data)
-    construct_haproxy_config(haproxy_globals,
-                             haproxy_defaults,
-                             haproxy_monitoring,
-                             haproxy_services)
-
-    if service_haproxy("check"):
-        update_service_ports(old_service_ports, get_service_ports())
-        service_haproxy("reload")
+    with timed_phase("render"):
+        construct_haproxy_config(haproxy_globals,
+                                 haproxy_defaults,
+                                 haproxy_resolvers=haproxy_resolvers)
+        write_haproxy_config_parts(haproxy_parts)
+        fingerprint = get_haproxy_config_fingerprint()
+
+    # Only check and reload a configuration haproxy isn't running already.
+    # The fingerprint is only trusted while haproxy runs, since it may have
+    # been restarted with another configuration since it was saved.
+    reload_needed = (
+        fingerprint != load_charm_state("haproxy_config_fingerprint") or
+        not service_haproxy("status"))
+    if reload_needed:
+        with timed_phase("check"):
+            config_ok = service_haproxy("check")
+    else:
+        log("HAProxy configuration unchanged, not reloading.")
+        config_ok = True
+    if config_ok:
+        update_service_ports(old_service_ports,
+                             get_listen_ports(services_dict, config_data))
+        if reload_needed:
+            with timed_phase("reload"):
+                if service_haproxy("reload"):
+                    save_charm_state("haproxy_config_fingerprint",
+                                     fingerprint)
+        with timed_phase("munin"):
+            update_munin_plugins()
         if not (get_listen_stanzas() == old_stanzas):
-            notify_website()
-            notify_peer()
+            with timed_phase("notify"):
+                notify_website()
+                notify_peer()
     else:
         # XXX Ideally the config should be restored to a working state if the
         # check fails, otherwise an inadvertent reload will cause the service
@@ -823,7 +2017,18 @@ def notify_relation(relation, changed=False, relation_ids=None):
     default_host = get_hostname()
     default_port = 80
 
-    for rid in relation_ids or get_relation_ids(relation):
+    # Digests of the settings last set on each relation, to skip setting
+    # them again, which would run the hooks of every remote unit.
+    previously_published = load_charm_state("published_relations", {})
+    published = dict(previously_published)
+    if not relation_ids:
+        relation_ids = get_relation_ids(relation)
+        for rid in previously_published:
+            if (rid is not None and rid.startswith(relation + ":") and
+                    rid not in relation_ids):
+                del published[rid]
+
+    for rid in relation_ids:
         service_names = set()
         if rid is None:
             rid = relation_id()
@@ -846,24 +2051,32 @@ def notify_relation(relation, changed=False, relation_ids=None):
             log("Remote units requested more than a single service name."
                 "Falling back to default host/port.")
 
+        requestedservice = None
         if service_name is not None:
             # If a specfic service has been asked for then return the ip:port
             # for that service, else pass back the default
-            requestedservice = get_config_service(service_name)
+            requestedservice = (get_services() or {}).get(service_name)
+            if requestedservice is None:
+                log("Service '%s' is not configured. "
+                    "Falling back to default host/port." % service_name)
+        if requestedservice is not None:
             my_host = get_hostname(requestedservice['service_host'])
             my_port = requestedservice['service_port']
         else:
             my_host = default_host
             my_port = default_port
 
-        all_services = ""
-        services_dict = create_services()
-        if services_dict is not None:
-            all_services = yaml.safe_dump(sorted(services_dict.itervalues()))
+        settings = {"port": str(my_port), "hostname": my_host}
+        settings.update(get_published_services())
+        digest = hashlib.sha1(json.dumps(settings, sort_keys=True)).hexdigest()
+        if published.get(rid) == digest:
+            log("Relation %s is up to date, not setting it." % rid)
+            continue
+        relation_set(relation_id=rid, **settings)
+        published[rid] = digest
 
-        relation_set(relation_id=rid, port=str(my_port),
-                     hostname=my_host,
-                     all_services=all_services)
+    if published != previously_published:
+        save_charm_state("published_relations", published)
 
 
 def notify_website(changed=False, relation_ids=None):
@@ -874,37 +2087,344 @@ def notify_peer(changed=False, relation_ids=None):
     notify_relation("peer", changed=changed, relation_ids=relation_ids)
 
 
+def get_stats_socket(config_data=None):
+    """Return the path of the admin stats socket."""
+    if config_data is None:
+        config_data = config_get()
+    return (config_data.get('stats_socket_path') or
+            default_haproxy_stats_socket)
+
+
+def install_stats_library():
+    """
+    Install the stats socket client module where the monitoring tools
+    shipped with the charm can import it, defaulting to the configured
+    stats socket.
+    """
+    library = read_charm_file("hooks", "haproxy_stats.py")
+    library = re.sub(r'(?m)^DEFAULT_SOCKET = .*$',
+                     'DEFAULT_SOCKET = "%s"' % get_stats_socket(), library)
+    library_dst = get_python_lib(prefix="/usr/local")
+    if not os.path.exists(library_dst):
+        os.makedirs(library_dst)
+    write_managed_file(os.path.join(library_dst, "haproxy_stats.py"),
+                       library)
+
+
+def install_haproxy_ctl():
+    """
+    Install haproxy-ctl, to query and control haproxy through the stats
+    socket.
+    """
+    install_stats_library()
+    write_managed_file(default_haproxy_ctl_path,
+                       read_charm_file("files", "ctl", "haproxy_ctl.py"),
+                       0755)
+
+
 def install_nrpe_scripts():
+    install_stats_library()
     scripts_src = os.path.join(os.environ["CHARM_DIR"], "files",
                                "nrpe")
     scripts_dst = "/usr/lib/nagios/plugins"
     if not os.path.exists(scripts_dst):
         os.makedirs(scripts_dst)
-    for fname in glob.glob(os.path.join(scripts_src, "*.sh")):
+    for fname in (glob.glob(os.path.join(scripts_src, "*.sh")) +
+                  glob.glob(os.path.join(scripts_src, "*.py"))):
         shutil.copy2(fname,
                      os.path.join(scripts_dst, os.path.basename(fname)))
+    # The checks run as nagios, which needs access to the stats socket.
+    grant_stats_socket_access("nagios", config_get("global_group"))
+
+
+def grant_stats_socket_access(user, group):
+    """
+    Add the given user to the group of the stats socket, restarting nrpe
+    when it wasn't a member yet, since its running processes keep the
+    groups they were started with.
+    """
+    try:
+        user_gid = pwd.getpwnam(user).pw_gid
+    except KeyError:
+        log("User '%s' not set up, stats socket access not granted" % user)
+        return
+    group_entry = grp.getgrnam(group)
+    if user_gid == group_entry.gr_gid or user in group_entry.gr_mem:
+        return
+    add_user_to_group(user, group)
+    if service_running("nagios-nrpe-server"):
+        service_restart("nagios-nrpe-server")
+
+
+def get_nrpe_check_arguments():
+    """
+    Return the arguments of the haproxy check, with the per-backend
+    thresholds on servers down set as 'down_thresholds' in the services
+    configuration.
+    """
+    return get_nrpe_backend_arguments(
+        lambda service: service.get("down_thresholds"), "-b")
+
+
+def get_nrpe_backend_arguments(get_thresholds, option):
+    """
+    Return the per-backend threshold arguments of a check, for each service
+    having thresholds, as returned by 'get_thresholds', given as a mapping
+    of 'warning' and 'critical' values.
+    """
+    arguments = []
+    services = get_config_services()
+    for service_name, service in sorted(services.iteritems()):
+        if service_name is None:
+            continue
+        thresholds = get_thresholds(service)
+        if not thresholds:
+            continue
+        limits = "%s,%s" % (thresholds.get("warning", ""),
+                            thresholds.get("critical", ""))
+        # With peers, the servers end up in the '_be' backend.
+        for backend in (service_name, service_name + "_be"):
+            arguments.append("%s %s=%s" % (option, backend, limits))
+    return arguments
+
+
+def get_nrpe_slo_check_arguments():
+    """
+    Return the arguments of the SLO check, with the per-backend thresholds
+    set as 'slo' in the services configuration.
+    """
+    arguments = get_nrpe_threshold_arguments(
+        (("--window", "nagios_slo_window"),))
+    for metric, option in (("response_time", "-R"), ("total_time", "-T"),
+                           ("5xx", "-E")):
+        arguments.extend(get_nrpe_backend_arguments(
+            lambda service: (service.get("slo") or {}).get(metric),
+            option))
+    return arguments
+
+
+def get_nrpe_threshold_arguments(options):
+    """
+    Return the threshold arguments of a check, given as tuples of (check
+    option, charm option), for the charm options that are set.
+    """
+    config_data = config_get()
+    arguments = []
+    for option, key in options:
+        value = config_data.get(key)
+        if value:
+            arguments.append("%s=%s" % (option, value))
+    return arguments
+
+
+def get_nrpe_queue_check_arguments():
+    """
+    Return the arguments of the queue depth check, with its thresholds taken
+    from the charm configuration.
+    """
+    return get_nrpe_threshold_arguments((
+        ("--queue", "nagios_queue_thresholds"),
+        ("--max-queue", "nagios_max_queue_thresholds"),
+        ("--saturation", "nagios_saturation_thresholds"),
+        ("--rate-headroom", "nagios_rate_headroom_thresholds")))
 
 
 def update_nrpe_config():
     install_nrpe_scripts()
     nrpe_compat = nrpe.NRPE()
-    nrpe_compat.add_check('haproxy', 'Check HAProxy', 'check_haproxy.sh')
+    nrpe_compat.add_check('haproxy', 'Check HAProxy', " ".join(
+        ['check_haproxy.py'] + get_nrpe_check_arguments()))
     nrpe_compat.add_check('haproxy_queue', 'Check HAProxy queue depth',
-                          'check_haproxy_queue_depth.sh')
+                          " ".join(['check_haproxy_queue_depth.py'] +
+                                   get_nrpe_queue_check_arguments()))
+    nrpe_compat.add_check('haproxy_slo', 'Check HAProxy backend SLOs',
+                          " ".join(['check_haproxy_slo.py'] +
+                                   get_nrpe_slo_check_arguments()))
+    if config_get().get('latency_window'):
+        nrpe_compat.add_check(
+            'haproxy_latency', 'Check HAProxy backend latencies',
+            " ".join(['check_haproxy_latency.py'] +
+                     get_nrpe_threshold_arguments((
+                         ("--p95", "nagios_latency_p95_thresholds"),
+                         ("--p99", "nagios_latency_p99_thresholds"),
+                         ("--5xx", "nagios_latency_5xx_thresholds")))))
     nrpe_compat.write()
 
 
+def create_upstart_job(description, user, group, command):
+    """Return an upstart job respawning the given command."""
+    return "\n".join([
+        "# This file is managed by Juju",
+        'description "%s"' % description,
+        "",
+        "start on runlevel [2345]",
+        "stop on runlevel [!2345]",
+        "",
+        "respawn",
+        "setuid %s" % user,
+        "setgid %s" % group,
+        "",
+        "exec %s" % command,
+        ""])
+
+
+def update_upstart_service(name, files):
+    """
+    Install the given files, as tuples of (path, content, mode), along with
+    the upstart job 'name', and make sure the job runs, restarting it if
+    any of them changed. Without files, the job is stopped and removed.
+    """
+    job_path = os.path.join(default_upstart_dir, "%s.conf" % name)
+    if not files:
+        if os.path.exists(job_path):
+            service_stop(name)
+            os.remove(job_path)
+        return
+    changed = False
+    for path, content, mode in files:
+        changed = write_managed_file(path, content, mode) or changed
+    running = service_running(name)
+    if running and changed:
+        # Upstart only reads job changes when the job starts.
+        service_stop(name)
+        running = False
+    if not running:
+        service_start(name)
+
+
+def read_charm_file(*path):
+    with open(os.path.join(os.environ["CHARM_DIR"], *path)) as f:
+        return f.read()
+
+
+def create_exporter_job(config_data):
+    """Return the upstart job running the metrics exporter."""
+    return create_upstart_job(
+        "haproxy Prometheus metrics exporter", config_data['global_user'],
+        config_data['global_group'],
+        "%s --socket %s --address %s --port %d --cache-ttl %s" % (
+            default_exporter_path, get_stats_socket(config_data),
+            config_data.get('metrics_address') or "127.0.0.1",
+            config_data['metrics_port'],
+            config_data.get('metrics_cache_ttl', 5)))
+
+
+def update_metrics_exporter():
+    """
+    Install, reconfigure or remove the Prometheus metrics exporter, which
+    runs while 'metrics_port' is set. Its port is only opened when
+    'metrics_open_port' is set.
+    """
+    config_data = config_get()
+    port = config_data.get('metrics_port') or 0
+    if port:
+        install_stats_library()
+        update_upstart_service("haproxy-exporter", [
+            (default_exporter_path,
+             read_charm_file("files", "exporter", "haproxy_exporter.py"),
+             0755),
+            (default_exporter_job, create_exporter_job(config_data), 0644),
+            ])
+    else:
+        update_upstart_service("haproxy-exporter", [])
+    # The state holds the port opened for the exporter, if any.
+    opened_port = config_data.get('metrics_open_port') and port or 0
+    old_port = load_charm_state("metrics_port", 0)
+    if opened_port and opened_port != old_port:
+        open_port(opened_port)
+    if old_port and old_port != opened_port:
+        close_port(old_port)
+    save_charm_state("metrics_port", opened_port)
+
+
+def create_log_analyzer_job(config_data):
+    """Return the upstart job running the log analyzer."""
+    # The analyzer runs in the adm group, which can read the system logs.
+    return create_upstart_job(
+        "haproxy log latency analyzer", config_data['global_user'], "adm",
+        "%s --log %s --summary %s --window %d" % (
+            default_log_analyzer_path, config_data['latency_log_file'],
+            default_latency_summary, config_data['latency_window']))
+
+
+def update_log_analyzer():
+    """
+    Install, reconfigure or remove the log analyzer, which runs while
+    'latency_window' is set.
+    """
+    config_data = config_get()
+    if not config_data.get('latency_window'):
+        update_upstart_service("haproxy-log-analyzer", [])
+        return
+    mkdir(os.path.dirname(default_latency_summary),
+          owner=config_data['global_user'],
+          group=config_data['global_group'], perms=0755)
+    update_upstart_service("haproxy-log-analyzer", [
+        (default_log_analyzer_path,
+         read_charm_file("files", "analyzer", "haproxy_log_analyzer.py"),
+         0755),
+        (default_log_analyzer_job, create_log_analyzer_job(config_data),
+         0644),
+        ])
+
+
+def update_munin_plugins():
+    """
+    Link a munin plugin for each frontend and backend of the haproxy
+    configuration, removing the ones of proxies that went away. Does
+    nothing until munin-node is installed by the munin relation.
+    """
+    if not os.path.isdir(default_munin_plugins_dir):
+        return
+    install_stats_library()
+    if not os.path.exists(os.path.dirname(default_munin_plugin)):
+        os.makedirs(os.path.dirname(default_munin_plugin))
+    with open(os.path.join(os.environ["CHARM_DIR"], "files", "munin",
+                           "haproxy_")) as f:
+        write_managed_file(default_munin_plugin, f.read(), 0755)
+    config_data = config_get()
+    changed = write_managed_file(default_munin_plugin_conf, "\n".join([
+        "# This file is managed by Juju",
+        "[haproxy_*]",
+        "group %s" % config_data['global_group'],
+        "env.socket %s" % get_stats_socket(config_data),
+        ""]))
+
+    wanted = set("haproxy_%s_%s" % proxy for proxy in get_proxy_names())
+    for path in glob.glob(os.path.join(default_munin_plugins_dir,
+                                       "haproxy_*")):
+        name = os.path.basename(path)
+        if (name not in wanted and os.path.islink(path) and
+                os.readlink(path) == default_munin_plugin):
+            os.remove(path)
+            changed = True
+    for name in wanted:
+        path = os.path.join(default_munin_plugins_dir, name)
+        if not os.path.lexists(path):
+            os.symlink(default_munin_plugin, path)
+            changed = True
+    if changed:
+        service_restart("munin-node")
+
+
 ###############################################################################
 # Main section
 ###############################################################################
 
 
-def main(hook_name):
+def run_hook(hook_name):
     if hook_name == "install":
         install_hook()
     elif hook_name in ("config-changed", "upgrade-charm"):
         config_changed()
-        update_nrpe_config()
+        with timed_phase("ctl"):
+            install_haproxy_ctl()
+        with timed_phase("nrpe"):
+            update_nrpe_config()
+        with timed_phase("exporter"):
+            update_metrics_exporter()
+        with timed_phase("log_analyzer"):
+            update_log_analyzer()
     elif hook_name == "start":
         start_hook()
     elif hook_name == "stop":
@@ -923,6 +2443,8 @@ def main(hook_name):
         website_interface("joined")
     elif hook_name == "peer-relation-changed":
         reverseproxy_interface("changed")
+    elif hook_name == "munin-relation-changed":
+        update_munin_plugins()
     elif hook_name in ("nrpe-external-master-relation-joined",
                        "local-monitors-relation-joined"):
         update_nrpe_config()
@@ -930,6 +2452,34 @@ def main(hook_name):
         print "Unknown hook"
         sys.exit(1)
 
+
+def main(hook_name):
+    """
+    Run the given hook, recording how long it and its phases took, and
+    profiling it when 'profile_hooks' is set.
+    """
+    del hook_phases[:]
+    hook_services.clear()
+    hook_yaml_cache.clear()
+    profiler = None
+    if config_get().get('profile_hooks'):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.time()
+    status = "error"
+    try:
+        run_hook(hook_name)
+        status = "ok"
+    except SystemExit, e:
+        status = "ok" if e.code in (None, 0) else "failed"
+        raise
+    finally:
+        duration = time.time() - start
+        if profiler is not None:
+            profiler.disable()
+            write_hook_profile(profiler, hook_name)
+        write_hook_timing(hook_name, duration, status)
+
 if __name__ == "__main__":
     hook_name = os.path.basename(sys.argv[0])
     # Also support being invoked directly with hook as argument name.
@@ -1,10 +1,12 @@
+import os
+import shutil
 import sys
+import tempfile
 
 from testtools import TestCase
 from mock import patch
 
 import hooks
-from utils_for_tests import patch_open
 
 
 class ConfigChangedTest(TestCase):
@@ -12,15 +14,29 @@ class ConfigChangedTest(TestCase):
     def setUp(self):
         super(ConfigChangedTest, self).setUp()
         self.config_get = self.patch_hook("config_get")
-        self.get_service_ports = self.patch_hook("get_service_ports")
+        self.get_open_ports = self.patch_hook("get_open_ports")
+        self.update_service_ports = self.patch_hook("update_service_ports")
         self.get_listen_stanzas = self.patch_hook("get_listen_stanzas")
         self.create_haproxy_globals = self.patch_hook(
             "create_haproxy_globals")
         self.create_haproxy_defaults = self.patch_hook(
             "create_haproxy_defaults")
+        self.create_haproxy_resolvers = self.patch_hook(
+            "create_haproxy_resolvers")
         self.remove_services = self.patch_hook("remove_services")
         self.create_services = self.patch_hook("create_services")
-        self.load_services = self.patch_hook("load_services")
+        self.get_haproxy_config_parts = self.patch_hook(
+            "get_haproxy_config_parts")
+        self.write_haproxy_config_parts = self.patch_hook(
+            "write_haproxy_config_parts")
+        self.get_haproxy_config_fingerprint = self.patch_hook(
+            "get_haproxy_config_fingerprint")
+        self.get_haproxy_config_fingerprint.return_value = "new-fingerprint"
+        self.charm_state = {"haproxy_config_fingerprint": "old-fingerprint"}
+        self.load_charm_state = self.patch_hook("load_charm_state")
+        self.load_charm_state.side_effect = (
+            lambda key, default=None: self.charm_state.get(key, default))
+        self.save_charm_state = self.patch_hook("save_charm_state")
         self.construct_haproxy_config = self.patch_hook(
             "construct_haproxy_config")
         self.service_haproxy = self.patch_hook(
@@ -29,10 +45,14 @@ class ConfigChangedTest(TestCase):
             "update_sysctl")
         self.notify_website = self.patch_hook("notify_website")
         self.notify_peer = self.patch_hook("notify_peer")
+        self.update_munin_plugins = self.patch_hook("update_munin_plugins")
         self.log = self.patch_hook("log")
         sys_exit = patch.object(sys, "exit")
         self.sys_exit = sys_exit.start()
         self.addCleanup(sys_exit.stop)
+        services = patch.dict(hooks.hook_services, clear=True)
+        services.start()
+        self.addCleanup(services.stop)
 
     def patch_hook(self, hook_name):
         mock_controller = patch.object(hooks, hook_name)
@@ -63,6 +83,71 @@ class ConfigChangedTest(TestCase):
         self.notify_website.assert_not_called()
         self.notify_peer.assert_not_called()
 
+    def test_config_changed_updates_munin_plugins(self):
+        self.service_haproxy.return_value = True
+
+        hooks.config_changed()
+
+        self.update_munin_plugins.assert_called_once_with()
+
+    def test_config_changed_writes_config_parts(self):
+        self.service_haproxy.return_value = True
+        self.config_get.return_value = {"package_status": "install",
+                                        "enable_monitoring": False}
+
+        hooks.config_changed()
+
+        self.construct_haproxy_config.assert_called_once_with(
+            self.create_haproxy_globals.return_value,
+            self.create_haproxy_defaults.return_value,
+            haproxy_resolvers=self.create_haproxy_resolvers.return_value)
+        self.get_haproxy_config_parts.assert_called_once_with(None)
+        self.write_haproxy_config_parts.assert_called_once_with(
+            self.get_haproxy_config_parts.return_value)
+        self.service_haproxy.assert_any_call("check")
+        self.service_haproxy.assert_any_call("reload")
+        self.save_charm_state.assert_called_once_with(
+            "haproxy_config_fingerprint", "new-fingerprint")
+
+    def test_config_changed_opens_ports_of_services(self):
+        self.service_haproxy.return_value = True
+        self.config_get.return_value = {"package_status": "install",
+                                        "enable_monitoring": False}
+        self.create_services.return_value = {
+            "foo": {"service_name": "foo", "service_port": 80},
+            "bar": {"service_name": "bar", "service_port": 81}}
+
+        hooks.config_changed()
+
+        self.update_service_ports.assert_called_once_with(
+            self.get_open_ports.return_value, set([(80, "TCP"), (81, "TCP")]))
+
+    def test_config_changed_skips_reload_of_unchanged_config(self):
+        self.charm_state["haproxy_config_fingerprint"] = "new-fingerprint"
+
+        self.service_haproxy.return_value = True
+
+        hooks.config_changed()
+
+        self.service_haproxy.assert_called_once_with("status")
+        self.assertFalse(self.save_charm_state.called)
+        self.update_munin_plugins.assert_called_once_with()
+        self.log.assert_called_once_with(
+            "HAProxy configuration unchanged, not reloading.")
+
+    def test_config_changed_reloads_unchanged_config_if_not_running(self):
+        """
+        The fingerprint of the last reloaded configuration isn't trusted when
+        haproxy isn't running, as it could have been restarted since.
+        """
+        self.charm_state["haproxy_config_fingerprint"] = "new-fingerprint"
+        self.service_haproxy.side_effect = lambda action: action != "status"
+
+        hooks.config_changed()
+
+        self.service_haproxy.assert_any_call("check")
+        self.service_haproxy.assert_any_call("reload")
+
     def test_config_changed_no_notify_website_failed_check(self):
         self.service_haproxy.return_value = False
         self.get_listen_stanzas.side_effect = (
@@ -74,47 +159,199 @@ class ConfigChangedTest(TestCase):
 
         self.notify_website.assert_not_called()
         self.notify_peer.assert_not_called()
+        self.update_munin_plugins.assert_not_called()
         self.log.assert_called_once_with(
             "HAProxy configuration check failed, exiting.")
         self.sys_exit.assert_called_once_with(1)
 
 
 class HelpersTest(TestCase):
+
+    def setUp(self):
+        super(HelpersTest, self).setUp()
+        self.config_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.config_dir)
+        self.config_file = os.path.join(self.config_dir, "haproxy.cfg")
+        for name, value in (
+                ("default_haproxy_config", self.config_file),
+                ("default_haproxy_config_parts_dir",
+                 os.path.join(self.config_dir, "conf.d")),
+                ("default_haproxy_environment_file",
+                 os.path.join(self.config_dir, "default")),
+                ("default_haproxy_service_config_dir",
+                 os.path.join(self.config_dir, "services"))):
+            patcher = patch.object(hooks, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        log = patch.object(hooks, "log")
+        log.start()
+        self.addCleanup(log.stop)
+
+    def read_file(self, *path):
+        with open(os.path.join(self.config_dir, *path)) as f:
+            return f.read()
+
+    def write_file(self, content, *path):
+        if not os.path.exists(os.path.dirname(os.path.join(self.config_dir,
+                                                           *path))):
+            os.makedirs(os.path.dirname(os.path.join(self.config_dir,
+                                                     *path)))
+        with open(os.path.join(self.config_dir, *path), 'w') as f:
+            f.write(content)
+
     def test_constructs_haproxy_config(self):
-        with patch_open() as (mock_open, mock_file):
-            hooks.construct_haproxy_config('foo-globals', 'foo-defaults',
-                                           'foo-monitoring', 'foo-services')
-
-            mock_file.write.assert_called_with(
-                'foo-globals\n\n'
-                'foo-defaults\n\n'
-                'foo-monitoring\n\n'
-                'foo-services\n\n'
-            )
-            mock_open.assert_called_with(hooks.default_haproxy_config, 'w')
+        self.assertTrue(hooks.construct_haproxy_config(
+            'foo-globals', 'foo-defaults', 'foo-monitoring', 'foo-services'))
 
-    def test_constructs_nothing_if_globals_is_none(self):
-        with patch_open() as (mock_open, mock_file):
-            hooks.construct_haproxy_config(None, 'foo-defaults',
-                                           'foo-monitoring', 'foo-services')
+        self.assertEqual(
+            'foo-globals\n\n'
+            'foo-defaults\n\n'
+            'foo-monitoring\n\n'
+            'foo-services\n\n',
+            self.read_file("haproxy.cfg"))
 
-            self.assertFalse(mock_open.called)
-            self.assertFalse(mock_file.called)
+    def test_constructs_haproxy_config_with_resolvers(self):
+        hooks.construct_haproxy_config('foo-globals', 'foo-defaults',
+                                       'foo-monitoring', 'foo-services',
+                                       'foo-resolvers')
 
-    def test_constructs_nothing_if_defaults_is_none(self):
-        with patch_open() as (mock_open, mock_file):
-            hooks.construct_haproxy_config('foo-globals', None,
-                                           'foo-monitoring', 'foo-services')
+        self.assertEqual(
+            'foo-globals\n\n'
+            'foo-defaults\n\n'
+            'foo-resolvers\n\n'
+            'foo-monitoring\n\n'
+            'foo-services\n\n',
+            self.read_file("haproxy.cfg"))
 
-            self.assertFalse(mock_open.called)
-            self.assertFalse(mock_file.called)
+    def test_constructs_nothing_if_globals_is_none(self):
+        self.assertIsNone(hooks.construct_haproxy_config(
+            None, 'foo-defaults', 'foo-monitoring', 'foo-services'))
+        self.assertFalse(os.path.exists(self.config_file))
+
+    def test_constructs_nothing_if_defaults_is_none(self):
+        self.assertIsNone(hooks.construct_haproxy_config(
+            'foo-globals', None, 'foo-monitoring', 'foo-services'))
+        self.assertFalse(os.path.exists(self.config_file))
 
     def test_constructs_haproxy_config_without_optionals(self):
-        with patch_open() as (mock_open, mock_file):
-            hooks.construct_haproxy_config('foo-globals', 'foo-defaults')
-
-            mock_file.write.assert_called_with(
-                'foo-globals\n\n'
-                'foo-defaults\n\n'
-            )
-            mock_open.assert_called_with(hooks.default_haproxy_config, 'w')
+        hooks.construct_haproxy_config('foo-globals', 'foo-defaults')
+
+        self.assertEqual('foo-globals\n\nfoo-defaults\n\n',
+                         self.read_file("haproxy.cfg"))
+
+    def test_doesnt_rewrite_unchanged_haproxy_config(self):
+        hooks.construct_haproxy_config('foo-globals', 'foo-defaults')
+
+        self.assertFalse(hooks.construct_haproxy_config('foo-globals',
+                                                        'foo-defaults'))
+        self.assertTrue(hooks.construct_haproxy_config('bar-globals',
+                                                       'foo-defaults'))
+
+    def test_gets_config_parts(self):
+        self.write_file("listen foo", "services", "foo.service")
+        self.write_file("listen bar", "services", "bar.service")
+        self.write_file("", "services", "bar__80.is.proxy")
+
+        self.assertEqual(
+            [("haproxy_monitoring", "listen haproxy_monitoring"),
+             ("bar", "listen bar"), ("foo", "listen foo")],
+            hooks.get_haproxy_config_parts("listen haproxy_monitoring"))
+        self.assertEqual([("bar", "listen bar"), ("foo", "listen foo")],
+                         hooks.get_haproxy_config_parts())
+
+    def test_writes_config_parts(self):
+        self.write_file('ENABLED=1\nEXTRAOPTS="-de -f /old.cfg"\n',
+                        "default")
+        self.write_file("listen gone\n\n", "conf.d", "gone.cfg")
+        self.write_file("listen bar\n\n", "conf.d", "bar.cfg")
+
+        self.assertTrue(hooks.write_haproxy_config_parts(
+            [("foo", "listen foo"), ("bar", "listen bar")]))
+
+        parts_dir = os.path.join(self.config_dir, "conf.d")
+        self.assertEqual(["bar.cfg", "foo.cfg"], sorted(os.listdir(parts_dir)))
+        self.assertEqual("listen foo\n\n",
+                         self.read_file("conf.d", "foo.cfg"))
+        self.assertEqual(
+            'ENABLED=1\nEXTRAOPTS="-de -f %s/bar.cfg -f %s/foo.cfg"\n' % (
+                parts_dir, parts_dir),
+            self.read_file("default"))
+        self.assertFalse(hooks.write_haproxy_config_parts(
+            [("foo", "listen foo"), ("bar", "listen bar")]))
+
+    def test_adds_extra_options_for_config_parts(self):
+        self.write_file('ENABLED=1', "default")
+
+        hooks.set_haproxy_config_files(["/foo.cfg"])
+
+        self.assertEqual('ENABLED=1\nEXTRAOPTS="-f /foo.cfg"\n',
+                         self.read_file("default"))
+
+    def test_loads_config_with_parts(self):
+        self.write_file("global\n", "haproxy.cfg")
+        self.write_file("listen foo 0.0.0.0:80\n", "conf.d", "foo.cfg")
+
+        self.assertEqual("global\n\n\nlisten foo 0.0.0.0:80\n",
+                         hooks.load_haproxy_config(self.config_file))
+        self.assertEqual((("foo", "0.0.0.0", 80),),
+                         hooks.get_listen_stanzas(self.config_file))
+
+    def test_fingerprints_config_with_parts(self):
+        self.write_file("global\n", "haproxy.cfg")
+        fingerprint = hooks.get_haproxy_config_fingerprint()
+        self.write_file("listen foo 0.0.0.0:80\n", "conf.d", "foo.cfg")
+
+        self.assertNotEqual(fingerprint,
+                            hooks.get_haproxy_config_fingerprint())
+
+    def test_fingerprints_files_referenced_by_config(self):
+        """
+        Errorfiles and ACL pattern files are loaded by haproxy along with its
+        configuration, so changing them changes the fingerprint too.
+        """
+        errorfile = os.path.join(self.config_dir, "service_foo", "503.http")
+        allowlist = os.path.join(self.config_dir, "service_foo",
+                                 "rate_limit_allowlist.acl")
+        self.write_file("global\n", "haproxy.cfg")
+        self.write_file(
+            "listen foo 0.0.0.0:80\n"
+            "    acl rate_limit_allowed src -f %s\n"
+            "    errorfile 503 %s\n" % (allowlist, errorfile),
+            "conf.d", "foo.cfg")
+        self.write_file("10.0.0.0/8\n", "service_foo",
+                        "rate_limit_allowlist.acl")
+        self.write_file("HTTP/1.0 503 Unavailable\n", "service_foo",
+                        "503.http")
+        fingerprint = hooks.get_haproxy_config_fingerprint()
+        self.assertEqual(fingerprint, hooks.get_haproxy_config_fingerprint())
+
+        self.write_file("HTTP/1.0 503 Try later\n", "service_foo",
+                        "503.http")
+        errorfile_fingerprint = hooks.get_haproxy_config_fingerprint()
+        self.assertNotEqual(fingerprint, errorfile_fingerprint)
+
+        self.write_file("10.0.0.0/8\n192.168.0.0/16\n", "service_foo",
+                        "rate_limit_allowlist.acl")
+        self.assertNotEqual(errorfile_fingerprint,
+                            hooks.get_haproxy_config_fingerprint())
+
+    def test_get_haproxy_referenced_files(self):
+        self.assertEqual(
+            ["/foo/allowlist.acl", "/foo/503.http", "/bar.lst"],
+            hooks.get_haproxy_referenced_files(
+                "listen foo\n"
+                "    acl allowed src -f /foo/allowlist.acl\n"
+                "    errorfile 503 /foo/503.http\n"
+                "    http-request deny if { path -i -f /bar.lst }\n"
+                "    option httplog\n"))
+
+    @patch('subprocess.call')
+    def test_checks_config_with_parts(self, call):
+        self.write_file("listen foo 0.0.0.0:80\n", "conf.d", "foo.cfg")
+        call.return_value = 0
+
+        self.assertTrue(hooks.service_haproxy('check', self.config_file))
+
+        call.assert_called_once_with([
+            '/usr/sbin/haproxy', '-f', self.config_file, '-f',
+            os.path.join(self.config_dir, "conf.d", "foo.cfg"), '-c'])
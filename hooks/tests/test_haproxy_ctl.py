@@ -0,0 +1,76 @@
+import imp
+import os
+import socket
+
+from testtools import TestCase
+from mock import patch, MagicMock
+
+import haproxy_stats
+from test_haproxy_stats import SHOW_STAT
+
+ctl = imp.load_source(
+    "haproxy_ctl", os.path.join(os.environ["CHARM_DIR"], "files", "ctl",
+                                "haproxy_ctl.py"))
+
+
+class HAProxyCtlTest(TestCase):
+
+    def setUp(self):
+        super(HAProxyCtlTest, self).setUp()
+        self.client = MagicMock()
+        self.client.show_stat.side_effect = (
+            lambda fields: haproxy_stats.parse_stat(SHOW_STAT, fields))
+
+    def test_formats_stat_table(self):
+        output = ctl.stat(self.client, ["-f", "svname,status,scur",
+                                        "-p", "web_be"])
+
+        self.assertEqual(
+            "svname      status  scur\n"
+            "foo-0-4242  UP      1\n"
+            "foo-1-4242  DOWN    0\n"
+            "BACKEND     UP      1",
+            output)
+        self.client.show_stat.assert_called_once_with(
+            set(["pxname", "svname", "status", "scur"]))
+
+    def test_formats_stat_csv(self):
+        output = ctl.stat(self.client, ["-f", "pxname,qcur", "--csv"])
+
+        self.assertEqual(
+            "pxname,qcur\nweb,\nweb_be,0\nweb_be,0\nweb_be,0", output)
+
+    def test_pipelines_server_commands(self):
+        self.client.execute.return_value = ["", ""]
+
+        ctl.disable(self.client, ["web_be/foo-0-4242", "web_be/foo-1-4242"])
+
+        self.client.execute.assert_called_once_with(
+            "disable server web_be/foo-0-4242",
+            "disable server web_be/foo-1-4242")
+
+    def test_rejects_servers_without_backend(self):
+        self.assertRaises(ValueError, ctl.enable, self.client, ["foo"])
+        self.assertFalse(self.client.execute.called)
+
+    @patch('sys.stdin')
+    def test_executes_commands_from_stdin(self, stdin):
+        stdin.__iter__.return_value = iter(
+            ["set weight web_be/foo-0-4242 10\n", "\n", "show info\n"])
+        self.client.execute.return_value = ["", "Name: HAProxy\n"]
+
+        self.assertEqual("Name: HAProxy", ctl.execute(self.client, ["-"]))
+        self.client.execute.assert_called_once_with(
+            "set weight web_be/foo-0-4242 10", "show info")
+
+    @patch('sys.stderr')
+    @patch('haproxy_stats.StatsClient.execute')
+    def test_main_fails_when_haproxy_is_down(self, execute, stderr):
+        execute.side_effect = socket.error("Connection refused")
+
+        self.assertEqual(1, ctl.main(["-s", "/some/socket", "exec",
+                                      "show info"]))
+
+    @patch('sys.stderr')
+    def test_main_usage(self, stderr):
+        self.assertEqual(2, ctl.main(["foo"]))
@@ -0,0 +1,93 @@
+import imp
+import os
+import socket
+
+from testtools import TestCase
+from mock import patch
+
+import haproxy_stats
+from test_haproxy_stats import SHOW_STAT
+
+exporter = imp.load_source(
+    "haproxy_exporter", os.path.join(os.environ["CHARM_DIR"], "files",
+                                     "exporter", "haproxy_exporter.py"))
+
+LATENCY_STAT = (
+    "# pxname,svname,scur,stot,status,type,qtime,ctime,rtime,ttime,"
+    "hrsp_2xx,hrsp_5xx,\n"
+    "web_be,foo-0-4242,1,60,UP,2,0,2,35,40,58,2,\n"
+    "web_be,BACKEND,1,120,UP,1,0,1,30,1250,110,10,\n")
+
+
+class RenderMetricsTest(TestCase):
+
+    def test_renders_proxies_and_servers(self):
+        metrics = exporter.render_metrics(
+            haproxy_stats.parse_stat(SHOW_STAT), {"Uptime_sec": 3600})
+
+        self.assertIn("# TYPE haproxy_up gauge\nhaproxy_up 1\n", metrics)
+        self.assertIn("haproxy_process_uptime_seconds 3600\n", metrics)
+        self.assertIn(
+            "# TYPE haproxy_frontend_sessions_total counter\n"
+            'haproxy_frontend_sessions_total{frontend="web"} 120\n',
+            metrics)
+        self.assertIn('haproxy_backend_up{backend="web_be"} 1\n', metrics)
+        self.assertIn(
+            "# TYPE haproxy_server_up gauge\n"
+            'haproxy_server_up{backend="web_be",server="foo-0-4242"} 1\n'
+            'haproxy_server_up{backend="web_be",server="foo-1-4242"} 0\n',
+            metrics)
+        self.assertNotIn("haproxy_frontend_up", metrics)
+        self.assertNotIn("haproxy_frontend_current_queue", metrics)
+
+    def test_renders_latencies_in_seconds(self):
+        metrics = exporter.render_metrics(
+            haproxy_stats.parse_stat(LATENCY_STAT), {})
+
+        self.assertIn('haproxy_backend_total_time_average_seconds'
+                      '{backend="web_be"} 1.25\n', metrics)
+        self.assertIn('haproxy_server_response_time_average_seconds'
+                      '{backend="web_be",server="foo-0-4242"} 0.035\n',
+                      metrics)
+        self.assertIn('haproxy_backend_http_responses_total'
+                      '{backend="web_be",code="5xx"} 10\n', metrics)
+
+    def test_renders_haproxy_down(self):
+        self.assertEqual(
+            "# HELP haproxy_up Whether haproxy could be reached on its stats "
+            "socket.\n# TYPE haproxy_up gauge\nhaproxy_up 0\n",
+            exporter.render_metrics(None, None))
+
+    def test_escapes_label_values(self):
+        self.assertEqual('server="a\\"b\\\\c"',
+                         exporter.format_labels([("server", 'a"b\\c')]))
+
+
+class SnapshotCacheTest(TestCase):
+
+    def setUp(self):
+        super(SnapshotCacheTest, self).setUp()
+        self.now = 100
+        self.cache = exporter.SnapshotCache("/some/socket", 5,
+                                            clock=lambda: self.now)
+
+    @patch('haproxy_stats.StatsClient.execute')
+    def test_reads_haproxy_once_per_ttl(self, execute):
+        execute.return_value = [SHOW_STAT, "Uptime_sec: 10\n"]
+
+        first = self.cache.get()
+        self.now += 4
+        self.assertIs(first, self.cache.get())
+        execute.assert_called_once_with("show stat", "show info")
+
+        self.now += 1
+        self.cache.get()
+        self.assertEqual(2, execute.call_count)
+
+    @patch('haproxy_stats.StatsClient.execute')
+    def test_caches_haproxy_being_down(self, execute):
+        execute.side_effect = socket.error("Connection refused")
+
+        self.assertIn("haproxy_up 0\n", self.cache.get())
+        self.cache.get()
+        self.assertEqual(1, execute.call_count)
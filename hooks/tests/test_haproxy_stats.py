@@ -0,0 +1,148 @@
+import socket
+
+from testtools import TestCase
+from mock import patch, MagicMock
+
+import haproxy_stats
+
+SHOW_STAT = (
+    "# pxname,svname,qcur,qmax,scur,smax,slim,stot,status,weight,"
+    "type,check_status,\n"
+    "web,FRONTEND,,,3,10,2000,120,OPEN,,0,,\n"
+    "web_be,foo-0-4242,0,2,1,5,100,60,UP,100,2,L7OK,\n"
+    "web_be,foo-1-4242,0,0,0,5,100,60,DOWN,100,2,L4CON,\n"
+    "web_be,BACKEND,0,2,1,10,200,120,UP,200,1,,\n"
+    "\n")
+
+
+class StatsSocketTest(TestCase):
+
+    @patch('socket.socket')
+    def test_sends_command(self, mock_socket):
+        sock = MagicMock()
+        sock.recv.side_effect = ["foo", "bar", ""]
+        mock_socket.return_value = sock
+
+        result = haproxy_stats.send_command("show info", "/some/socket")
+
+        self.assertEqual("foobar", result)
+        mock_socket.assert_called_once_with(socket.AF_UNIX,
+                                            socket.SOCK_STREAM)
+        sock.connect.assert_called_once_with("/some/socket")
+        sock.sendall.assert_called_once_with("show info\n")
+        sock.close.assert_called_once_with()
+
+    @patch('socket.socket')
+    def test_closes_socket_on_errors(self, mock_socket):
+        sock = MagicMock()
+        sock.connect.side_effect = socket.error("No such file or directory")
+        mock_socket.return_value = sock
+
+        self.assertRaises(socket.error, haproxy_stats.send_command,
+                          "show info", "/some/socket")
+        sock.close.assert_called_once_with()
+
+    def test_parses_show_stat(self):
+        records = haproxy_stats.parse_stat(SHOW_STAT)
+
+        self.assertEqual(4, len(records))
+        self.assertEqual(
+            {"pxname": "web_be", "svname": "foo-1-4242", "qcur": 0,
+             "qmax": 0, "scur": 0, "smax": 5, "slim": 100, "stot": 60,
+             "status": "DOWN", "weight": 100, "type": 2,
+             "check_status": "L4CON"},
+            records[2])
+        self.assertIsNone(records[0]["qcur"])
+
+    def test_parses_empty_show_stat(self):
+        self.assertEqual([], haproxy_stats.parse_stat(""))
+
+    def test_parses_show_info(self):
+        info = haproxy_stats.parse_info(
+            "Name: HAProxy\nVersion: 1.5.3\nUptime_sec: 3600\n"
+            "CurrConns: 12\nnode: \n\n")
+
+        self.assertEqual(
+            {"Name": "HAProxy", "Version": "1.5.3", "Uptime_sec": 3600,
+             "CurrConns": 12, "node": None},
+            info)
+
+    def test_groups_by_proxy(self):
+        proxies = haproxy_stats.group_by_proxy(
+            haproxy_stats.parse_stat(SHOW_STAT))
+
+        self.assertEqual(["web", "web_be"], sorted(proxies))
+        self.assertEqual("FRONTEND", proxies["web"]["frontend"]["svname"])
+        self.assertIsNone(proxies["web"]["backend"])
+        self.assertEqual("BACKEND", proxies["web_be"]["backend"]["svname"])
+        self.assertEqual(["foo-0-4242", "foo-1-4242"],
+                         [server["svname"]
+                          for server in proxies["web_be"]["servers"]])
+
+    def test_server_status(self):
+        for status in ("UP", "UP 1/3", "NOLB", "DRAIN", "no check"):
+            self.assertTrue(haproxy_stats.is_server_up({"status": status}))
+        for status in ("DOWN", "DOWN 1/2", "MAINT", "MAINT(via)"):
+            self.assertFalse(haproxy_stats.is_server_up({"status": status}))
+
+
+class StatsClientTest(TestCase):
+
+    def setUp(self):
+        super(StatsClientTest, self).setUp()
+        self.sockets = []
+        self.connect_error = None
+        patcher = patch('socket.socket', side_effect=self.new_socket)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.client = haproxy_stats.StatsClient("/some/socket")
+
+    def new_socket(self, family, type):
+        sock = MagicMock()
+        sock.recv.side_effect = self.responses.pop(0)
+        sock.connect.side_effect = self.connect_error
+        self.sockets.append(sock)
+        return sock
+
+    def test_pipelines_commands(self):
+        self.responses = [
+            ["\n> ", "Name: HAProxy\n\n> ", SHOW_STAT[:50],
+             SHOW_STAT[50:] + "\n> \n> "]]
+
+        info, stat, disable = self.client.execute(
+            "show info", "show stat", "disable server web_be/foo-0-4242")
+
+        self.assertEqual("Name: HAProxy\n", info)
+        self.assertEqual(SHOW_STAT, stat)
+        self.assertEqual("", disable)
+        sock = self.sockets[0]
+        sock.connect.assert_called_once_with("/some/socket")
+        self.assertEqual(
+            [(("prompt\n",),),
+             (("show info\nshow stat\n"
+               "disable server web_be/foo-0-4242\n",),)],
+            sock.sendall.call_args_list)
+
+    def test_reuses_connection(self):
+        self.responses = [["> ", "Name: HAProxy\n\n> ", SHOW_STAT + "\n> "]]
+
+        self.assertEqual({"Name": "HAProxy"}, self.client.show_info())
+        self.assertEqual(4, len(self.client.show_stat()))
+        self.assertEqual(1, len(self.sockets))
+
+    def test_reconnects_after_idle_timeout(self):
+        self.responses = [["> ", "Name: HAProxy\n\n> ", ""],
+                          ["> ", "Name: HAProxy\n\n> "]]
+        self.client.command("show info")
+
+        self.assertEqual("Name: HAProxy\n", self.client.command("show info"))
+        self.assertEqual(2, len(self.sockets))
+        self.sockets[0].close.assert_called_once_with()
+
+    def test_raises_when_haproxy_is_down(self):
+        self.responses = [[]]
+        self.connect_error = socket.error("Connection refused")
+
+        self.assertRaises(socket.error, self.client.command, "show info")
+        self.sockets[0].close.assert_called_once_with()
+        self.assertIsNone(self.client.sock)
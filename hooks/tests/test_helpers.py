@@ -1,5 +1,8 @@
 import base64
+import json
 import os
+import shutil
+import tempfile
 
 from contextlib import contextmanager
 from StringIO import StringIO
@@ -25,6 +28,7 @@ class HelpersTest(TestCase):
             'global_quiet': False,
         }
         result = hooks.create_haproxy_globals()
+        stats_socket = hooks.default_haproxy_stats_socket
 
         expected = '\n'.join([
             'global',
@@ -34,9 +38,32 @@ class HelpersTest(TestCase):
             '    user foo-user',
             '    group foo-group',
             '    spread-checks 234',
+            ('    stats socket %s mode 660 group foo-group level admin' %
+             stats_socket),
         ])
         self.assertEqual(result, expected)
 
+    @patch('hooks.config_get')
+    def test_creates_haproxy_globals_with_stats_socket(self, config_get):
+        config_get.return_value = {
+            'global_log': 'foo-log',
+            'global_maxconn': 123,
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'global_spread_checks': 234,
+            'global_debug': False,
+            'global_quiet': False,
+            'stats_socket_path': '/run/haproxy/admin.sock',
+            'stats_socket_mode': '600',
+            'stats_socket_timeout': '1m',
+        }
+        result = hooks.create_haproxy_globals()
+
+        self.assertIn(
+            '    stats socket /run/haproxy/admin.sock mode 600 '
+            'group foo-group level admin\n'
+            '    stats timeout 1m', result)
+
     @patch('hooks.config_get')
     def test_creates_haproxy_globals_quietly_with_debug(self, config_get):
         config_get.return_value = {
@@ -49,6 +76,7 @@ class HelpersTest(TestCase):
             'global_quiet': True,
         }
         result = hooks.create_haproxy_globals()
+        stats_socket = hooks.default_haproxy_stats_socket
 
         expected = '\n'.join([
             'global',
@@ -60,6 +88,75 @@ class HelpersTest(TestCase):
             '    debug',
             '    quiet',
             '    spread-checks 234',
+            ('    stats socket %s mode 660 group foo-group level admin' %
+             stats_socket),
+        ])
+        self.assertEqual(result, expected)
+
+    def test_loads_default_charm_state_if_file_doesnt_exist(self):
+        with patch('hooks.default_charm_state_file', '/some/foo/file'):
+            self.assertEqual({}, hooks.load_charm_state('foo', {}))
+
+    def test_saves_and_loads_charm_state(self):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        state_file = os.path.join(state_dir, 'state', 'charm-state.yaml')
+
+        with patch('hooks.default_charm_state_file', state_file):
+            hooks.save_charm_state('foo', {'bar': [1, 2]})
+            hooks.save_charm_state('baz', 'qux')
+
+            self.assertEqual({'bar': [1, 2]}, hooks.load_charm_state('foo'))
+            self.assertEqual('qux', hooks.load_charm_state('baz'))
+            self.assertIsNone(hooks.load_charm_state('missing'))
+            self.assertEqual(['charm-state.yaml'],
+                             os.listdir(os.path.dirname(state_file)))
+
+    @patch.dict('hooks.hook_yaml_cache', clear=True)
+    def test_parses_yaml_once_per_content(self):
+        with patch('yaml.load', wraps=hooks.yaml.load) as load:
+            services = hooks.load_yaml("- service_name: foo\n")
+            services[0]['service_name'] = 'bar'
+
+            self.assertEqual([{'service_name': 'foo'}],
+                             hooks.load_yaml(u"- service_name: foo\n"))
+            self.assertEqual([{'service_name': 'baz'}],
+                             hooks.load_yaml("- service_name: baz\n"))
+        self.assertEqual(2, load.call_count)
+
+    def test_dumps_yaml_like_safe_dump(self):
+        services = [{'service_name': 'foo', 'service_port': 80,
+                     'service_options': ['mode http']}]
+        self.assertEqual(hooks.yaml.safe_dump(services),
+                         hooks.dump_yaml(services))
+        self.assertRaises(hooks.yaml.YAMLError, hooks.dump_yaml, object())
+
+    @patch('hooks.config_get')
+    def test_creates_haproxy_globals_with_server_state_file(self,
+                                                            config_get):
+        config_get.return_value = {
+            'global_log': 'foo-log',
+            'global_maxconn': 123,
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'global_spread_checks': 234,
+            'global_debug': False,
+            'global_quiet': False,
+            'server_state_file': '/var/lib/haproxy/server-state',
+        }
+        result = hooks.create_haproxy_globals()
+        stats_socket = hooks.default_haproxy_stats_socket
+
+        expected = '\n'.join([
+            'global',
+            '    log foo-log',
+            '    maxconn 123',
+            '    user foo-user',
+            '    group foo-group',
+            '    spread-checks 234',
+            ('    stats socket %s mode 660 group foo-group level admin' %
+             stats_socket),
+            '    server-state-file /var/lib/haproxy/server-state',
         ])
         self.assertEqual(result, expected)
 
@@ -107,6 +204,74 @@ class HelpersTest(TestCase):
         ])
         self.assertEqual(result, expected)
 
+    @patch('hooks.config_get')
+    def test_creates_haproxy_defaults_with_server_state_file(self,
+                                                             config_get):
+        config_get.return_value = {
+            'default_options': 'foo-option',
+            'default_timeouts': '234',
+            'default_log': 'foo-log',
+            'default_mode': 'foo-mode',
+            'default_retries': 321,
+            'server_state_file': '/var/lib/haproxy/server-state',
+        }
+        result = hooks.create_haproxy_defaults()
+
+        expected = '\n'.join([
+            'defaults',
+            '    log foo-log',
+            '    mode foo-mode',
+            '    option foo-option',
+            '    retries 321',
+            '    timeout 234',
+            '    load-server-state-from-file global',
+        ])
+        self.assertEqual(result, expected)
+
+    @patch('hooks.config_get')
+    def test_creates_haproxy_resolvers(self, config_get):
+        config_get.return_value = {
+            'dns_resolvers': '10.0.0.2 127.0.0.1:5353, ::1',
+            'dns_hold_valid': '30s',
+        }
+        result = hooks.create_haproxy_resolvers()
+
+        expected = '\n'.join([
+            'resolvers dns',
+            '    nameserver dns1 10.0.0.2:53',
+            '    nameserver dns2 127.0.0.1:5353',
+            '    nameserver dns3 ::1:53',
+            '    resolve_retries 3',
+            '    timeout retry 1s',
+            '    hold valid 30s',
+        ])
+        self.assertEqual(result, expected)
+
+    @patch('hooks.config_get')
+    def test_creates_no_haproxy_resolvers_if_disabled(self, config_get):
+        config_get.return_value = {'dns_resolvers': ''}
+        self.assertIsNone(hooks.create_haproxy_resolvers())
+
+    def test_gets_nameservers_from_resolv_conf(self):
+        with patch_open() as (mock_open, mock_file):
+            mock_file.__iter__.return_value = iter([
+                '# comment\n',
+                'nameserver 10.0.0.2\n',
+                'search example.com\n',
+                'nameserver 10.0.0.3\n',
+            ])
+            with patch('os.path.exists') as exists:
+                exists.return_value = True
+                result = hooks.get_nameservers('resolv.conf')
+
+            mock_open.assert_called_with('/etc/resolv.conf')
+        self.assertEqual(['10.0.0.2:53', '10.0.0.3:53'], result)
+
+    def test_is_ip_address(self):
+        self.assertTrue(hooks.is_ip_address('10.0.0.2'))
+        self.assertTrue(hooks.is_ip_address('fe80::1'))
+        self.assertFalse(hooks.is_ip_address('backend.example.com'))
+
     def test_returns_none_when_haproxy_config_doesnt_exist(self):
         self.assertIsNone(hooks.load_haproxy_config('/some/foo/file'))
 
@@ -204,21 +369,54 @@ class HelpersTest(TestCase):
 
         self.assertEqual((), stanzas)
 
+    @patch('hooks.load_haproxy_config')
+    def test_get_proxy_names(self, load_haproxy_config):
+        load_haproxy_config.return_value = '''
+        listen haproxy_monitoring 0.0.0.0:10000
+        listen foo.internal 1.2.3.4:123
+        frontend foo-2-234
+            bind 1.2.3.5:234
+            default_backend bar.internal
+        backend bar.internal
+        '''
+
+        self.assertEqual([('frontend', 'foo.internal'),
+                          ('backend', 'foo.internal'),
+                          ('frontend', 'foo-2-234'),
+                          ('backend', 'bar.internal')],
+                         hooks.get_proxy_names())
+
     def test_gets_no_ports_if_config_doesnt_exist(self):
         ports = hooks.get_service_ports('/some/foo/path')
         self.assertEqual((), ports)
 
+    @patch('hooks.save_charm_state')
     @patch('hooks.open_port')
     @patch('hooks.close_port')
-    def test_updates_service_ports(self, close_port, open_port):
+    def test_updates_service_ports(self, close_port, open_port,
+                                   save_charm_state):
         old_service_ports = [123, 234, 345]
         new_service_ports = [345, 456, 567]
 
         hooks.update_service_ports(old_service_ports, new_service_ports)
 
-        self.assertEqual(close_port.mock_calls, [call(123), call(234)])
+        self.assertEqual(close_port.mock_calls,
+                         [call(123, "TCP"), call(234, "TCP")])
         self.assertEqual(open_port.mock_calls,
-                         [call(345), call(456), call(567)])
+                         [call(456, "TCP"), call(567, "TCP")])
+        save_charm_state.assert_called_once_with(
+            "open_ports", [[345, "TCP"], [456, "TCP"], [567, "TCP"]])
+
+    @patch('hooks.save_charm_state')
+    @patch('hooks.open_port')
+    @patch('hooks.close_port')
+    def test_updates_service_ports_by_protocol(self, close_port, open_port,
+                                               save_charm_state):
+        hooks.update_service_ports(set([(53, "UDP"), (80, "TCP")]),
+                                   set([(53, "TCP"), (80, "TCP")]))
+
+        close_port.assert_called_once_with(53, "UDP")
+        open_port.assert_called_once_with(53, "TCP")
 
     @patch('hooks.open_port')
     @patch('hooks.close_port')
@@ -229,6 +427,41 @@ class HelpersTest(TestCase):
         self.assertFalse(close_port.called)
         self.assertFalse(open_port.called)
 
+    def test_gets_listen_ports(self):
+        services_dict = {
+            "foo": {"service_name": "foo", "service_port": 80},
+            "foo_be": {"service_name": "foo_be", "service_port": "81"},
+            }
+        config_data = {"enable_monitoring": True, "monitoring_port": 10000}
+
+        self.assertEqual(set([(80, "TCP"), (81, "TCP"), (10000, "TCP")]),
+                         hooks.get_listen_ports(services_dict, config_data))
+        config_data["enable_monitoring"] = False
+        self.assertEqual(set([(80, "TCP"), (81, "TCP")]),
+                         hooks.get_listen_ports(services_dict, config_data))
+
+    @patch('hooks.get_service_ports')
+    @patch('hooks.load_charm_state')
+    def test_gets_recorded_open_ports(self, load_charm_state,
+                                      get_service_ports):
+        load_charm_state.return_value = [[80, "TCP"], [53, "UDP"]]
+
+        self.assertEqual(set([(80, "TCP"), (53, "UDP")]),
+                         hooks.get_open_ports())
+        self.assertFalse(get_service_ports.called)
+
+    @patch('hooks.get_service_ports')
+    @patch('hooks.load_charm_state')
+    def test_gets_open_ports_from_config_until_recorded(self,
+                                                        load_charm_state,
+                                                        get_service_ports):
+        load_charm_state.return_value = None
+        get_service_ports.return_value = (80, 10000)
+
+        self.assertEqual(set([(80, "TCP"), (10000, "TCP")]),
+                         hooks.get_open_ports())
+        load_charm_state.assert_called_once_with("open_ports")
+
     @patch.dict(os.environ, {"JUJU_UNIT_NAME": "haproxy/2"})
     def test_creates_a_listen_stanza(self):
         service_name = 'some-name'
@@ -294,7 +527,7 @@ class HelpersTest(TestCase):
         service_port = 1234
         service_options = ('capture request header X-Man', 'mode http',
                            'option httplog', 'retries 3', 'balance uri',
-                           'option logasap')
+                           'option logasap', 'log-format %ci\\ %Tt')
         server_entries = [
             ('name-1', 'ip-1', 'port-1', ('foo1', 'bar1')),
             ('name-2', 'ip-2', 'port-2', ('foo2', 'bar2')),
@@ -312,6 +545,7 @@ class HelpersTest(TestCase):
             '    option httplog',
             '    capture request header X-Man',
             '    option logasap',
+            '    log-format %ci\\ %Tt',
             '',
             'backend some-name',
             '    mode http',
@@ -389,6 +623,75 @@ class HelpersTest(TestCase):
 
         self.assertEqual(expected, result)
 
+    @patch('hooks.config_get')
+    @patch.dict(os.environ, {"JUJU_UNIT_NAME": "haproxy/2"})
+    def test_creates_a_listen_stanza_with_rate_limit(self, config_get):
+        config_get.return_value = {'default_mode': 'http'}
+        server_entries = [
+            ('name-1', 'ip-1', 'port-1', ('foo1', 'bar1')),
+        ]
+        rate_limit = {'conn_cur': 20, 'http_req_rate': 100,
+                      'action': 'tarpit',
+                      'allowlist': ['10.0.0.0/8']}
+
+        result = hooks.create_listen_stanza('some-name', '10.11.12.13', 1234,
+                                            ('foo', 'bar'), server_entries,
+                                            None, rate_limit)
+
+        expected = '\n'.join((
+            'frontend haproxy-2-1234',
+            '    bind 10.11.12.13:1234',
+            '    default_backend some-name',
+            '    stick-table type ip size 100k expire 60s '
+            'store conn_cur,http_req_rate(10s)',
+            '    acl rate_limit_allowed src -f '
+            '/var/lib/haproxy/service_some-name/rate_limit_allowlist.acl',
+            '    tcp-request connection track-sc0 src '
+            'unless rate_limit_allowed',
+            '    tcp-request connection reject if { sc0_conn_cur gt 20 }',
+            '    http-request tarpit if { sc0_http_req_rate gt 100 }',
+            '',
+            'backend some-name',
+            '    foo',
+            '    bar',
+            '    server name-1 ip-1:port-1 foo1 bar1',
+        ))
+
+        self.assertEqual(expected, result)
+
+    @patch('hooks.config_get')
+    @patch.dict(os.environ, {"JUJU_UNIT_NAME": "haproxy/2"})
+    def test_creates_a_listen_stanza_with_rate_limit_in_tcp_default_mode(
+            self, config_get):
+        config_get.return_value = {'default_mode': 'tcp'}
+        rate_limit = {'conn_cur': 20, 'http_req_rate': 100}
+
+        result = hooks.create_listen_stanza('some-name', '10.11.12.13', 1234,
+                                            ['balance leastconn'], [], None,
+                                            rate_limit)
+
+        self.assertIn('    tcp-request connection reject if '
+                      '{ sc0_conn_cur gt 20 }\n', result)
+        self.assertNotIn('http_req_rate', result)
+        self.assertNotIn('http-request', result)
+
+    def test_creates_rate_limit_options_in_tcp_mode(self):
+        rate_limit = {'conn_cur': 20, 'http_req_rate': 100, 'period': '1m',
+                      'table_size': '1m', 'expire': '2m'}
+
+        result = hooks.create_rate_limit_options('some-name', rate_limit,
+                                                 http_mode=False)
+
+        self.assertEqual([
+            'stick-table type ip size 1m expire 2m store conn_cur',
+            'tcp-request connection track-sc0 src',
+            'tcp-request connection reject if { sc0_conn_cur gt 20 }',
+            ], result)
+
+    def test_creates_no_rate_limit_options_without_limits(self):
+        self.assertEqual([], hooks.create_rate_limit_options(
+            'some-name', {'http_req_rate': 100}, http_mode=False))
+
     def test_doesnt_create_listen_stanza_if_args_not_provided(self):
         self.assertIsNone(hooks.create_listen_stanza())
 
@@ -506,12 +809,12 @@ class HelpersTest(TestCase):
 
     @patch('hooks.is_proxy')
     @patch('hooks.config_get')
-    @patch('yaml.safe_load')
-    def test_gets_config_services(self, safe_load, config_get, is_proxy):
+    @patch('hooks.load_yaml')
+    def test_gets_config_services(self, load_yaml, config_get, is_proxy):
         config_get.return_value = {
             'services': 'some-services',
         }
-        safe_load.return_value = [
+        load_yaml.return_value = [
             {
                 'service_name': 'foo',
                 'service_options': {
@@ -549,13 +852,13 @@ class HelpersTest(TestCase):
 
     @patch('hooks.is_proxy')
     @patch('hooks.config_get')
-    @patch('yaml.safe_load')
-    def test_gets_config_services_with_forward_option(self, safe_load,
+    @patch('hooks.load_yaml')
+    def test_gets_config_services_with_forward_option(self, load_yaml,
                                                       config_get, is_proxy):
         config_get.return_value = {
             'services': 'some-services',
         }
-        safe_load.return_value = [
+        load_yaml.return_value = [
             {
                 'service_name': 'foo',
                 'service_options': {
@@ -593,13 +896,13 @@ class HelpersTest(TestCase):
 
     @patch('hooks.is_proxy')
     @patch('hooks.config_get')
-    @patch('yaml.safe_load')
-    def test_gets_config_services_with_options_string(self, safe_load,
+    @patch('hooks.load_yaml')
+    def test_gets_config_services_with_options_string(self, load_yaml,
                                                       config_get, is_proxy):
         config_get.return_value = {
             'services': 'some-services',
         }
-        safe_load.return_value = [
+        load_yaml.return_value = [
             {
                 'service_name': 'foo',
                 'service_options': {
@@ -637,13 +940,13 @@ class HelpersTest(TestCase):
 
     @patch('hooks.is_proxy')
     @patch('hooks.config_get')
-    @patch('yaml.safe_load')
-    def test_gets_config_services_with_proxy_no_forward(self, safe_load,
+    @patch('hooks.load_yaml')
+    def test_gets_config_services_with_proxy_no_forward(self, load_yaml,
                                                         config_get, is_proxy):
         config_get.return_value = {
             'services': 'some-services',
         }
-        safe_load.return_value = [
+        load_yaml.return_value = [
             {
                 'service_name': 'foo',
                 'service_options': {
@@ -681,13 +984,13 @@ class HelpersTest(TestCase):
 
     @patch('hooks.is_proxy')
     @patch('hooks.config_get')
-    @patch('yaml.safe_load')
-    def test_gets_config_services_no_service_options(self, safe_load,
+    @patch('hooks.load_yaml')
+    def test_gets_config_services_no_service_options(self, load_yaml,
                                                      config_get, is_proxy):
         config_get.return_value = {
             'services': '',
         }
-        safe_load.return_value = [
+        load_yaml.return_value = [
             {
                 'service_name': 'foo',
                 'server_options': 'baz1, baz2',
@@ -878,6 +1181,66 @@ class HelpersTest(TestCase):
         self.assertTrue(result)
         mock_call.assert_called_with(['service', 'haproxy', 'foo'])
 
+    @patch('hooks.save_server_state')
+    @patch('subprocess.call')
+    def test_saves_server_state_before_reload(self, mock_call,
+                                              save_server_state):
+        mock_call.return_value = 0
+
+        self.assertTrue(hooks.service_haproxy('reload'))
+
+        save_server_state.assert_called_once_with()
+        mock_call.assert_called_with(['service', 'haproxy', 'reload'])
+
+    @patch('hooks.save_server_state')
+    @patch('subprocess.call')
+    def test_doesnt_save_server_state_on_stop(self, mock_call,
+                                              save_server_state):
+        mock_call.return_value = 0
+
+        hooks.service_haproxy('stop')
+
+        self.assertFalse(save_server_state.called)
+
+    @patch('hooks.haproxy_admin_command')
+    @patch('hooks.config_get')
+    def test_saves_server_state(self, config_get, haproxy_admin_command):
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        state_file = os.path.join(state_dir, 'server-state')
+        config_get.return_value = {'server_state_file': state_file}
+        haproxy_admin_command.return_value = '1\n# be_id be_name\n'
+
+        self.assertTrue(hooks.save_server_state())
+
+        haproxy_admin_command.assert_called_once_with('show servers state')
+        with open(state_file) as f:
+            self.assertEqual('1\n# be_id be_name\n', f.read())
+
+    @patch('hooks.haproxy_admin_command')
+    @patch('hooks.config_get')
+    def test_doesnt_save_server_state_if_not_configured(
+            self, config_get, haproxy_admin_command):
+        config_get.return_value = {'server_state_file': ''}
+
+        self.assertFalse(hooks.save_server_state())
+        self.assertFalse(haproxy_admin_command.called)
+
+    @patch('hooks.haproxy_admin_command')
+    @patch('hooks.config_get')
+    def test_doesnt_save_server_state_if_haproxy_is_down(
+            self, config_get, haproxy_admin_command):
+        config_get.return_value = {'server_state_file': '/some/foo/file'}
+        haproxy_admin_command.return_value = None
+
+        self.assertFalse(hooks.save_server_state())
+
+    @patch('hooks.log')
+    def test_admin_command_returns_none_if_socket_is_missing(self, log):
+        self.assertIsNone(hooks.haproxy_admin_command('show info',
+                                                      '/some/foo/socket'))
+        self.assertTrue(log.called)
+
     @patch('subprocess.call')
     def test_fails_to_call_different_actions(self, mock_call):
         mock_call.return_value = 1
@@ -895,3 +1258,363 @@ class HelpersTest(TestCase):
     def test_doesnt_call_actions_if_config_is_none(self, mock_call):
         self.assertIsNone(hooks.service_haproxy('foo', None))
         self.assertFalse(mock_call.called)
+
+    def test_writes_managed_file_only_when_changed(self):
+        file_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, file_dir)
+        path = os.path.join(file_dir, 'foo')
+
+        self.assertTrue(hooks.write_managed_file(path, 'bar', 0755))
+        self.assertFalse(hooks.write_managed_file(path, 'bar', 0755))
+        self.assertTrue(hooks.write_managed_file(path, 'baz', 0755))
+        self.assertEqual(0755, os.stat(path).st_mode & 0777)
+        self.assertEqual(['foo'], os.listdir(file_dir))
+
+    def test_creates_exporter_job(self):
+        job = hooks.create_exporter_job({
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'metrics_address': '10.0.0.1',
+            'metrics_port': 9101,
+            'metrics_cache_ttl': 3,
+            })
+
+        self.assertIn('setuid foo-user\nsetgid foo-group\n', job)
+        self.assertIn('exec /usr/local/bin/haproxy-exporter --socket '
+                      '/var/lib/haproxy/stats.sock --address 10.0.0.1 '
+                      '--port 9101 --cache-ttl 3\n', job)
+
+    def test_exporter_job_listens_on_loopback_by_default(self):
+        job = hooks.create_exporter_job({
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'metrics_port': 9101,
+            })
+
+        self.assertIn(' --address 127.0.0.1 --port 9101 ', job)
+
+    @patch('hooks.save_charm_state')
+    @patch('hooks.load_charm_state')
+    @patch('hooks.close_port')
+    @patch('hooks.open_port')
+    @patch('hooks.service_start')
+    @patch('hooks.service_stop')
+    @patch('hooks.service_running')
+    @patch('hooks.write_managed_file')
+    @patch('hooks.install_stats_library')
+    @patch('hooks.config_get')
+    def test_starts_metrics_exporter(
+            self, config_get, install_stats_library, write_managed_file,
+            service_running, service_stop, service_start, open_port,
+            close_port, load_charm_state, save_charm_state):
+        config_get.return_value = {
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'metrics_port': 9101,
+            'metrics_open_port': True,
+            }
+        load_charm_state.return_value = 9100
+        write_managed_file.return_value = True
+        service_running.return_value = True
+
+        hooks.update_metrics_exporter()
+
+        install_stats_library.assert_called_once_with()
+        self.assertEqual(
+            ['/usr/local/bin/haproxy-exporter',
+             '/etc/init/haproxy-exporter.conf'],
+            [args[0] for args, _ in write_managed_file.call_args_list])
+        service_stop.assert_called_once_with('haproxy-exporter')
+        service_start.assert_called_once_with('haproxy-exporter')
+        open_port.assert_called_once_with(9101)
+        close_port.assert_called_once_with(9100)
+        save_charm_state.assert_called_once_with('metrics_port', 9101)
+
+    @patch('hooks.save_charm_state')
+    @patch('hooks.load_charm_state')
+    @patch('hooks.open_port')
+    @patch('hooks.service_start')
+    @patch('hooks.service_stop')
+    @patch('hooks.service_running')
+    @patch('hooks.write_managed_file')
+    @patch('hooks.install_stats_library')
+    @patch('hooks.config_get')
+    def test_leaves_unchanged_metrics_exporter_running(
+            self, config_get, install_stats_library, write_managed_file,
+            service_running, service_stop, service_start, open_port,
+            load_charm_state, save_charm_state):
+        config_get.return_value = {
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'metrics_port': 9101,
+            'metrics_open_port': True,
+            }
+        load_charm_state.return_value = 9101
+        write_managed_file.return_value = False
+        service_running.return_value = True
+
+        hooks.update_metrics_exporter()
+
+        self.assertFalse(service_stop.called)
+        self.assertFalse(service_start.called)
+        self.assertFalse(open_port.called)
+
+    @patch('hooks.save_charm_state')
+    @patch('hooks.load_charm_state')
+    @patch('hooks.close_port')
+    @patch('hooks.open_port')
+    @patch('hooks.update_upstart_service')
+    @patch('hooks.install_stats_library')
+    @patch('hooks.config_get')
+    def test_metrics_port_is_only_opened_on_request(
+            self, config_get, install_stats_library, update_upstart_service,
+            open_port, close_port, load_charm_state, save_charm_state):
+        config_get.return_value = {
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'metrics_port': 9101,
+            }
+        load_charm_state.return_value = 9101
+
+        hooks.update_metrics_exporter()
+
+        self.assertTrue(update_upstart_service.called)
+        self.assertFalse(open_port.called)
+        close_port.assert_called_once_with(9101)
+        save_charm_state.assert_called_once_with('metrics_port', 0)
+
+    @patch('os.remove')
+    @patch('os.path.exists')
+    @patch('hooks.save_charm_state')
+    @patch('hooks.load_charm_state')
+    @patch('hooks.close_port')
+    @patch('hooks.service_stop')
+    @patch('hooks.config_get')
+    def test_removes_metrics_exporter_when_disabled(
+            self, config_get, service_stop, close_port, load_charm_state,
+            save_charm_state, exists, remove):
+        config_get.return_value = {'metrics_port': 0}
+        load_charm_state.return_value = 9101
+        exists.return_value = True
+
+        hooks.update_metrics_exporter()
+
+        service_stop.assert_called_once_with('haproxy-exporter')
+        remove.assert_called_once_with('/etc/init/haproxy-exporter.conf')
+        close_port.assert_called_once_with(9101)
+        save_charm_state.assert_called_once_with('metrics_port', 0)
+
+    @patch('hooks.get_python_lib')
+    @patch('hooks.config_get')
+    def test_installs_stats_library_with_configured_socket(
+            self, config_get, get_python_lib):
+        library_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, library_dir)
+        get_python_lib.return_value = os.path.join(library_dir, 'lib')
+        config_get.return_value = {
+            'stats_socket_path': '/run/haproxy/admin.sock'}
+
+        hooks.install_stats_library()
+
+        with open(os.path.join(library_dir, 'lib', 'haproxy_stats.py')) as f:
+            library = f.read()
+        self.assertIn('\nDEFAULT_SOCKET = "/run/haproxy/admin.sock"\n',
+                      library)
+        self.assertIn('\nclass StatsClient(object):\n', library)
+
+    def test_creates_log_analyzer_job(self):
+        job = hooks.create_log_analyzer_job({
+            'global_user': 'foo-user',
+            'latency_log_file': '/var/log/foo.log',
+            'latency_window': 600,
+            })
+
+        self.assertIn('setuid foo-user\nsetgid adm\n', job)
+        self.assertIn('exec /usr/local/bin/haproxy-log-analyzer --log '
+                      '/var/log/foo.log --summary '
+                      '/var/lib/haproxy/latency/summary.json --window 600\n',
+                      job)
+
+    @patch('hooks.mkdir')
+    @patch('hooks.service_start')
+    @patch('hooks.service_stop')
+    @patch('hooks.service_running')
+    @patch('hooks.write_managed_file')
+    @patch('hooks.config_get')
+    def test_starts_log_analyzer(
+            self, config_get, write_managed_file, service_running,
+            service_stop, service_start, mkdir):
+        config_get.return_value = {
+            'global_user': 'foo-user',
+            'global_group': 'foo-group',
+            'latency_log_file': '/var/log/haproxy.log',
+            'latency_window': 300,
+            }
+        write_managed_file.return_value = False
+        service_running.return_value = False
+
+        hooks.update_log_analyzer()
+
+        mkdir.assert_called_once_with('/var/lib/haproxy/latency',
+                                      owner='foo-user', group='foo-group',
+                                      perms=0755)
+        self.assertEqual(
+            ['/usr/local/bin/haproxy-log-analyzer',
+             '/etc/init/haproxy-log-analyzer.conf'],
+            [args[0] for args, _ in write_managed_file.call_args_list])
+        self.assertFalse(service_stop.called)
+        service_start.assert_called_once_with('haproxy-log-analyzer')
+
+    @patch('os.path.exists')
+    @patch('hooks.service_stop')
+    @patch('hooks.config_get')
+    def test_leaves_log_analyzer_disabled(self, config_get, service_stop,
+                                          exists):
+        config_get.return_value = {'latency_window': 0}
+        exists.return_value = False
+
+        hooks.update_log_analyzer()
+
+        self.assertFalse(service_stop.called)
+
+    def patch_munin_dirs(self):
+        munin_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, munin_dir)
+        plugins_dir = os.path.join(munin_dir, 'plugins')
+        os.mkdir(plugins_dir)
+        plugin = os.path.join(munin_dir, 'haproxy_')
+        for name, value in (('default_munin_plugins_dir', plugins_dir),
+                            ('default_munin_plugin', plugin),
+                            ('default_munin_plugin_conf',
+                             os.path.join(munin_dir, 'haproxy'))):
+            patcher = patch('hooks.%s' % name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        return plugins_dir, plugin
+
+    @patch('hooks.service_restart')
+    @patch('hooks.get_proxy_names')
+    @patch('hooks.install_stats_library')
+    @patch('hooks.config_get')
+    def test_updates_munin_plugins(self, config_get, install_stats_library,
+                                   get_proxy_names, service_restart):
+        config_get.return_value = {'global_group': 'foo-group'}
+        plugins_dir, plugin = self.patch_munin_dirs()
+        os.symlink(plugin, os.path.join(plugins_dir, 'haproxy_backend_old'))
+        os.symlink('/some/other', os.path.join(plugins_dir, 'haproxy_foo'))
+        get_proxy_names.return_value = [('frontend', 'foo-2-80'),
+                                        ('backend', 'foo')]
+
+        hooks.update_munin_plugins()
+
+        self.assertEqual(
+            ['haproxy_backend_foo', 'haproxy_foo',
+             'haproxy_frontend_foo-2-80'],
+            sorted(os.listdir(plugins_dir)))
+        self.assertEqual(plugin, os.readlink(
+            os.path.join(plugins_dir, 'haproxy_backend_foo')))
+        self.assertTrue(os.access(plugin, os.X_OK))
+        service_restart.assert_called_once_with('munin-node')
+
+        service_restart.reset_mock()
+        hooks.update_munin_plugins()
+        self.assertFalse(service_restart.called)
+
+    @patch('hooks.install_stats_library')
+    def test_doesnt_update_munin_plugins_without_munin(
+            self, install_stats_library):
+        with patch('hooks.default_munin_plugins_dir', '/some/foo/dir'):
+            hooks.update_munin_plugins()
+
+        self.assertFalse(install_stats_library.called)
+
+    @patch('hooks.hook_phase_stack', [])
+    @patch('hooks.hook_phases', [])
+    def test_times_nested_phases(self):
+        with hooks.timed_phase('services'):
+            with hooks.timed_phase('relations'):
+                pass
+        try:
+            with hooks.timed_phase('check'):
+                raise ValueError()
+        except ValueError:
+            pass
+
+        self.assertEqual(['services.relations', 'services', 'check'],
+                         [phase for phase, _ in hooks.hook_phases])
+        self.assertEqual([], hooks.hook_phase_stack)
+
+    @patch('hooks.hook_phases', [('services', 0.5), ('check', 0.25)])
+    def test_writes_hook_timing(self):
+        timings_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, timings_dir)
+        timings_file = os.path.join(timings_dir, 'hook-timings.jsonl')
+
+        with patch('hooks.default_hook_timings_file', timings_file):
+            with patch.dict(os.environ, {'JUJU_UNIT_NAME': 'haproxy/0'}):
+                hooks.write_hook_timing('config-changed', 1.5, 'ok')
+                with patch('hooks.hook_timings_max_size', 0):
+                    hooks.write_hook_timing('start', 0.1, 'ok')
+
+        with open(timings_file + '.1') as f:
+            record = json.loads(f.read())
+        self.assertEqual('config-changed', record['hook'])
+        self.assertEqual('haproxy/0', record['unit'])
+        self.assertEqual(1.5, record['duration'])
+        self.assertEqual('ok', record['status'])
+        self.assertEqual([{'phase': 'services', 'duration': 0.5},
+                          {'phase': 'check', 'duration': 0.25}],
+                         record['phases'])
+        with open(timings_file) as f:
+            self.assertEqual(['start'], [json.loads(line)['hook']
+                                         for line in f])
+
+    @patch('hooks.log')
+    def test_doesnt_fail_hook_if_timings_cant_be_written(self, log):
+        with patch('hooks.default_hook_timings_file', '/some/foo/file'):
+            hooks.write_hook_timing('start', 0.1, 'ok')
+
+        self.assertTrue(log.called)
+
+    @patch('hooks.write_hook_profile')
+    @patch('hooks.write_hook_timing')
+    @patch('hooks.run_hook')
+    @patch('hooks.config_get')
+    def test_main_records_hook_timing(self, config_get, run_hook,
+                                      write_hook_timing, write_hook_profile):
+        config_get.return_value = {'profile_hooks': False}
+
+        hooks.main('start')
+
+        run_hook.assert_called_once_with('start')
+        hook_name, _, status = write_hook_timing.call_args[0]
+        self.assertEqual(('start', 'ok'), (hook_name, status))
+        self.assertFalse(write_hook_profile.called)
+
+    @patch('hooks.write_hook_profile')
+    @patch('hooks.write_hook_timing')
+    @patch('hooks.run_hook')
+    @patch('hooks.config_get')
+    def test_main_records_failed_hooks_and_profiles(
+            self, config_get, run_hook, write_hook_timing,
+            write_hook_profile):
+        config_get.return_value = {'profile_hooks': True}
+        run_hook.side_effect = SystemExit(1)
+
+        self.assertRaises(SystemExit, hooks.main, 'config-changed')
+
+        self.assertEqual('failed', write_hook_timing.call_args[0][2])
+        self.assertEqual('config-changed', write_hook_profile.call_args[0][1])
+
+    def test_writes_hook_profiles(self):
+        profiles_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profiles_dir)
+        profiler = MagicMock()
+        profiler.dump_stats.side_effect = lambda path: open(path, 'w').close()
+
+        with patch('hooks.default_hook_profiles_dir', profiles_dir):
+            for n in range(3):
+                with patch('time.strftime', return_value=str(n)):
+                    hooks.write_hook_profile(profiler, 'start', keep=2)
+
+        self.assertEqual(2, len(os.listdir(profiles_dir)))
@@ -0,0 +1,233 @@
+import imp
+import os
+import shutil
+import tempfile
+
+from testtools import TestCase
+
+analyzer = imp.load_source(
+    "haproxy_log_analyzer", os.path.join(os.environ["CHARM_DIR"], "files",
+                                         "analyzer",
+                                         "haproxy_log_analyzer.py"))
+
+SYSLOG_PREFIX = "Oct 18 10:00:00 foo haproxy[1234]: "
+
+HTTPLOG_LINE = SYSLOG_PREFIX + (
+    '10.0.0.1:51234 [18/Oct/2026:10:00:00.123] web web_be/foo-0-4242 '
+    '0/0/1/35/40 200 512 - - ---- 1/1/0/0/0 0/0 "GET / HTTP/1.1"\n')
+TCPLOG_LINE = SYSLOG_PREFIX + (
+    '10.0.0.1:51234 [18/Oct/2026:10:00:00.123] db db_be/db-0-5432 '
+    '0/1/250 1024 -- 1/1/0/0/0 0/0\n')
+JSON_LINE = SYSLOG_PREFIX + (
+    '{"timestamp":1792317600.123,"frontend":"web","backend":"web_be",'
+    '"server":"foo-1-4242","Tq":0,"Tw":0,"Tc":1,"Tr":-1,"Ta":3001,'
+    '"Tt":3001,"status":504,"request":"GET / HTTP/1.1"}\n')
+CLF_LINE = SYSLOG_PREFIX + (
+    '10.0.0.1 - - [18/Oct/2026:10:00:00 +0000] "GET /foo HTTP/1.1" 404 '
+    '120 "" "" 51234 123 web web_be foo-0-4242 0 0 1 12 15 ---- 1 1 0 0 '
+    '0 0 0\n')
+TIMING_LINE = SYSLOG_PREFIX + (
+    'web web_be/foo-0-4242 Tq=0 Tw=0 Tc=1 Tr=20 Ta=25 Tt=25 status=302 '
+    'retries=0 queue=0/0\n')
+
+
+class LatencySketchTest(TestCase):
+
+    def test_quantiles_within_relative_accuracy(self):
+        sketch = analyzer.LatencySketch(relative_accuracy=0.01)
+        for value in range(1, 10001):
+            sketch.add(value)
+
+        for q, expected in ((0.5, 5000), (0.95, 9500), (0.99, 9900)):
+            self.assertTrue(abs(sketch.quantile(q) - expected) <=
+                            expected * 0.011)
+        self.assertEqual(5000.5, sketch.mean())
+
+    def test_counts_zeros(self):
+        sketch = analyzer.LatencySketch()
+        for value in (0, 0, 0, 100):
+            sketch.add(value)
+
+        self.assertEqual(0.0, sketch.quantile(0.5))
+        self.assertTrue(99 <= sketch.quantile(1) <= 101)
+
+    def test_merges_sketches(self):
+        first = analyzer.LatencySketch()
+        second = analyzer.LatencySketch()
+        for value in range(1, 501):
+            first.add(value)
+        for value in range(501, 1001):
+            second.add(value)
+
+        first.merge(second)
+
+        self.assertEqual(1000, first.count)
+        self.assertTrue(abs(first.quantile(0.9) - 900) <= 9)
+
+    def test_bounds_buckets(self):
+        sketch = analyzer.LatencySketch(max_buckets=10)
+        for value in range(1, 100000, 7):
+            sketch.add(value)
+
+        self.assertTrue(len(sketch.buckets) <= 10)
+        self.assertTrue(abs(sketch.quantile(0.99) - 99000) <= 1000)
+
+    def test_empty_sketch(self):
+        sketch = analyzer.LatencySketch()
+
+        self.assertIsNone(sketch.quantile(0.5))
+        self.assertIsNone(sketch.mean())
+
+
+class ParseLineTest(TestCase):
+
+    def test_parses_httplog(self):
+        self.assertEqual(("web_be", "foo-0-4242", 40, 35, 200),
+                         analyzer.parse_line(HTTPLOG_LINE))
+
+    def test_parses_tcplog(self):
+        self.assertEqual(("db_be", "db-0-5432", 250, None, None),
+                         analyzer.parse_line(TCPLOG_LINE))
+
+    def test_parses_json(self):
+        self.assertEqual(("web_be", "foo-1-4242", 3001, None, 504),
+                         analyzer.parse_line(JSON_LINE))
+
+    def test_parses_extended_clf(self):
+        self.assertEqual(("web_be", "foo-0-4242", 15, 12, 404),
+                         analyzer.parse_line(CLF_LINE))
+
+    def test_parses_timing_only(self):
+        self.assertEqual(("web_be", "foo-0-4242", 25, 20, 302),
+                         analyzer.parse_line(TIMING_LINE))
+
+    def test_aborted_requests_have_no_times(self):
+        line = HTTPLOG_LINE.replace("0/0/1/35/40", "0/0/1/-1/40")
+
+        self.assertEqual(("web_be", "foo-0-4242", 40, None, 200),
+                         analyzer.parse_line(line))
+
+    def test_ignores_other_lines(self):
+        for line in (SYSLOG_PREFIX + "Proxy web started.\n",
+                     SYSLOG_PREFIX + "Server web_be/foo-0-4242 is DOWN\n",
+                     SYSLOG_PREFIX + "{not json\n",
+                     "garbage\n"):
+            self.assertIsNone(analyzer.parse_line(line))
+
+    def test_parse_lines_keeps_idle_ticks(self):
+        self.assertEqual(
+            [("web_be", "foo-0-4242", 40, 35, 200), None],
+            list(analyzer.parse_lines(["garbage\n", HTTPLOG_LINE, None])))
+
+
+class SlidingWindowTest(TestCase):
+
+    def setUp(self):
+        super(SlidingWindowTest, self).setUp()
+        self.now = 1000
+        self.window = analyzer.SlidingWindow(3, 10, clock=lambda: self.now)
+
+    def test_summarizes_backends_and_servers(self):
+        records = [("web_be", "foo-0-4242", 40, 35, 200)] * 9 + [
+            ("web_be", "foo-1-4242", 3000, None, 504)]
+        self.window.add_all(records)
+
+        summary = self.window.summary()
+
+        self.assertEqual(1000, summary["generated"])
+        self.assertEqual(10, summary["window"])
+        backend = summary["backends"]["web_be"]
+        self.assertEqual(10, backend["requests"])
+        self.assertEqual(1.0, backend["rate"])
+        self.assertEqual(0.1, backend["5xx_ratio"])
+        self.assertEqual(0.9, backend["status"]["2xx"])
+        self.assertEqual(336.0, backend["total"]["mean"])
+        self.assertTrue(39 <= backend["total"]["p50"] <= 41)
+        self.assertTrue(2970 <= backend["servers"]["foo-1-4242"]["total"]
+                        ["p99"] <= 3030)
+        self.assertEqual(
+            1, backend["servers"]["foo-1-4242"]["requests"])
+        self.assertIsNone(
+            backend["servers"]["foo-1-4242"]["response"]["p50"])
+
+    def test_expires_old_slots(self):
+        self.window.add_all([("web_be", "foo-0-4242", 40, 35, 200)])
+        self.now += 20
+        self.window.add_all([("web_be", "foo-0-4242", 80, 75, 500)])
+
+        self.assertEqual(
+            2, self.window.summary()["backends"]["web_be"]["requests"])
+
+        self.now += 10
+
+        summary = self.window.summary()
+        self.assertEqual(30, summary["window"])
+        self.assertEqual(1, summary["backends"]["web_be"]["requests"])
+        self.assertEqual(1.0, summary["backends"]["web_be"]["5xx_ratio"])
+
+    def test_stops_on_idle_ticks(self):
+        records = iter([("web_be", "foo-0-4242", 40, 35, 200), None,
+                        ("web_be", "foo-0-4242", 40, 35, 200)])
+
+        self.assertEqual(1, self.window.add_all(records))
+        self.assertEqual(1, self.window.add_all(records))
+
+
+class AnalyzeLogTest(TestCase):
+
+    def setUp(self):
+        super(AnalyzeLogTest, self).setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        self.path = os.path.join(self.log_dir, "haproxy.log")
+
+    def test_counts_records_across_intervals(self):
+        """
+        Reading a large log can take several intervals, none of which may
+        expire records read earlier.
+        """
+        with open(self.path, "w") as f:
+            f.write(HTTPLOG_LINE * 5000)
+        clock = iter(range(0, 100000, 5)).next
+
+        summary = analyzer.analyze_log(self.path, 10, clock=clock)
+
+        self.assertEqual(5000, summary["backends"]["web_be"]["requests"])
+
+
+class FollowTest(TestCase):
+
+    def setUp(self):
+        super(FollowTest, self).setUp()
+        self.log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.log_dir)
+        self.path = os.path.join(self.log_dir, "haproxy.log")
+
+    def append(self, content, path=None):
+        with open(path or self.path, "a") as f:
+            f.write(content)
+
+    def test_follows_appended_lines_across_rotation(self):
+        self.append("old\n")
+        lines = analyzer.follow(self.path, sleep=lambda interval: None)
+
+        self.assertIsNone(next(lines))
+        self.append("first\nsecond\npart")
+        self.assertEqual("first\n", next(lines))
+        self.assertEqual("second\n", next(lines))
+        self.assertIsNone(next(lines))
+        self.append("ial\n")
+        self.assertEqual("partial\n", next(lines))
+
+        os.rename(self.path, self.path + ".1")
+        self.append("late\n", self.path + ".1")
+        self.append("rotated\n")
+        self.assertEqual("late\n", next(lines))
+        self.assertEqual("rotated\n", next(lines))
+
+    def test_waits_for_the_log_file(self):
+        lines = analyzer.follow(self.path, sleep=lambda interval: None)
+
+        self.assertIsNone(next(lines))
+        self.append("first\n")
+        self.assertEqual("first\n", next(lines))
@@ -0,0 +1,86 @@
+import imp
+import os
+import shutil
+import tempfile
+
+from testtools import TestCase
+from mock import patch
+
+import haproxy_stats
+from test_haproxy_stats import SHOW_STAT
+
+plugin = imp.load_source(
+    "haproxy_munin_plugin", os.path.join(os.environ["CHARM_DIR"], "files",
+                                         "munin", "haproxy_"))
+
+
+class MuninPluginTest(TestCase):
+
+    def test_parses_plugin_name(self):
+        self.assertEqual(("frontend", "foo-2-80"),
+                         plugin.parse_plugin_name("haproxy_frontend_foo-2-80"))
+        self.assertEqual(("backend", "foo_be"),
+                         plugin.parse_plugin_name("haproxy_backend_foo_be"))
+        self.assertEqual((None, None), plugin.parse_plugin_name("haproxy_"))
+
+    def test_config(self):
+        lines = plugin.config("backend", "web.be")
+
+        self.assertEqual("multigraph haproxy_backend_web_be_sessions",
+                         lines[0])
+        self.assertIn("graph_title haproxy backend web.be sessions", lines)
+        self.assertIn("multigraph haproxy_backend_web_be_queue", lines)
+        self.assertIn("stot.type DERIVE", lines)
+        self.assertIn("stot.min 0", lines)
+        self.assertNotIn("multigraph haproxy_frontend_web_be_queue", lines)
+
+    def test_fetch(self):
+        records = haproxy_stats.parse_stat(SHOW_STAT)
+
+        lines = plugin.fetch("backend", "web_be", records)
+
+        self.assertEqual(["multigraph haproxy_backend_web_be_sessions",
+                          "scur.value 1", "stot.value 120"], lines[:3])
+        self.assertIn("multigraph haproxy_backend_web_be_queue\n"
+                      "qcur.value 0", "\n".join(lines))
+        self.assertIn("bin.value U", lines)
+
+    def test_fetch_missing_proxy(self):
+        lines = plugin.fetch("frontend", "missing", [])
+
+        self.assertIn("scur.value U", lines)
+
+
+class CachedShowStatTest(TestCase):
+
+    def setUp(self):
+        super(CachedShowStatTest, self).setUp()
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        self.cache_file = os.path.join(cache_dir, "haproxy_stats.cache")
+
+    @patch('haproxy_stats.send_command')
+    def test_shares_snapshot_until_it_expires(self, send_command):
+        send_command.return_value = SHOW_STAT
+
+        first = haproxy_stats.cached_show_stat(self.cache_file, 60)
+        second = haproxy_stats.cached_show_stat(self.cache_file, 60)
+
+        self.assertEqual(first, second)
+        self.assertEqual(1, send_command.call_count)
+
+        haproxy_stats.cached_show_stat(self.cache_file, 0)
+        self.assertEqual(2, send_command.call_count)
+
+    @patch('sys.stdout')
+    @patch('haproxy_stats.send_command')
+    def test_main_fetches_from_cache(self, send_command, stdout):
+        send_command.return_value = SHOW_STAT
+
+        with patch.dict(os.environ, {
+                "MUNIN_PLUGSTATE": os.path.dirname(self.cache_file)}):
+            for name in ("haproxy_frontend_web", "haproxy_backend_web_be"):
+                self.assertEqual(0, plugin.main([], name))
+
+        self.assertEqual(1, send_command.call_count)
+        self.assertTrue(os.path.exists(self.cache_file))
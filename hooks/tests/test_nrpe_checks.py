@@ -0,0 +1,394 @@
+import imp
+import json
+import os
+import shutil
+import socket
+import tempfile
+
+from testtools import TestCase
+from mock import patch
+
+import haproxy_stats
+from test_haproxy_stats import SHOW_STAT
+
+
+NRPE_FILES = os.path.join(os.environ["CHARM_DIR"], "files", "nrpe")
+
+
+def load_check(name):
+    return imp.load_source(name, os.path.join(NRPE_FILES, "%s.py" % name))
+
+
+# Loaded first, as the checks import their helpers from it.
+nagios_plugin = load_check("nagios_plugin")
+
+
+class CheckHAProxyTest(TestCase):
+
+    def setUp(self):
+        super(CheckHAProxyTest, self).setUp()
+        self.check = load_check("check_haproxy")
+        self.proxies = haproxy_stats.group_by_proxy(
+            haproxy_stats.parse_stat(SHOW_STAT))
+
+    def test_critical_when_any_server_is_down_by_default(self):
+        status, messages, perfdata = self.check.check_backends(
+            self.proxies, None, self.check.parse_threshold("0"))
+
+        self.assertEqual(self.check.CRITICAL, status)
+        self.assertEqual(["web_be: 1/2 servers down (foo-1-4242)"],
+                         messages)
+        self.assertEqual(["'web_be_down'=1;;0;0;2"], perfdata)
+
+    def test_percentage_thresholds(self):
+        status, messages, _ = self.check.check_backends(
+            self.proxies, self.check.parse_threshold("0"),
+            self.check.parse_threshold("50%"))
+
+        self.assertEqual(self.check.WARNING, status)
+
+    def test_backend_thresholds(self):
+        thresholds = self.check.parse_backend_thresholds(["web_be=1,2"])
+
+        status, messages, perfdata = self.check.check_backends(
+            self.proxies, None, self.check.parse_threshold("0"), thresholds)
+
+        self.assertEqual(self.check.OK, status)
+        self.assertEqual([], messages)
+        self.assertEqual(["'web_be_down'=1;1;2;0;2"], perfdata)
+
+    def test_backend_warning_threshold_keeps_global_critical(self):
+        thresholds = self.check.parse_backend_thresholds(["web_be=0,"])
+
+        status, messages, perfdata = self.check.check_backends(
+            self.proxies, None, self.check.parse_threshold("0"), thresholds)
+
+        self.assertEqual(self.check.CRITICAL, status)
+        self.assertEqual(["'web_be_down'=1;0;0;0;2"], perfdata)
+
+    def test_critical_when_backend_is_down(self):
+        self.proxies["web_be"]["backend"]["status"] = "DOWN"
+        thresholds = self.check.parse_backend_thresholds(["web_be=,"])
+
+        status, _, _ = self.check.check_backends(
+            self.proxies, None, None, thresholds)
+
+        self.assertEqual(self.check.CRITICAL, status)
+
+    @patch('sys.stdout')
+    @patch('haproxy_stats.send_command')
+    def test_main(self, send_command, stdout):
+        send_command.return_value = SHOW_STAT
+
+        self.assertEqual(self.check.OK,
+                         self.check.main(["-s", "/some/socket", "-c", "1"]))
+        send_command.assert_called_once_with("show stat", "/some/socket",
+                                             haproxy_stats.DEFAULT_TIMEOUT)
+
+    def test_parses_only_needed_fields(self):
+        records = haproxy_stats.parse_stat(SHOW_STAT,
+                                           self.check.STAT_FIELDS)
+        self.assertEqual(
+            {"pxname": "web_be", "svname": "BACKEND", "status": "UP",
+             "type": 1}, records[3])
+
+    @patch('sys.stdout')
+    @patch('haproxy_stats.send_command')
+    def test_main_unknown_when_haproxy_is_down(self, send_command, stdout):
+        send_command.side_effect = socket.error("Connection refused")
+
+        self.assertEqual(self.check.UNKNOWN, self.check.main([]))
+
+
+QUEUE_STAT = (
+    "# pxname,svname,qcur,qmax,scur,smax,slim,status,type,rate,rate_lim,\n"
+    "web,FRONTEND,,,1900,1900,2000,OPEN,0,90,100,\n"
+    "web_be,foo-0-4242,3,12,100,100,100,UP,2,45,,\n"
+    "web_be,BACKEND,4,12,100,100,200,UP,1,45,,\n"
+    "api_be,BACKEND,0,150,10,10,200,UP,1,5,,\n"
+    "\n")
+
+
+class CheckQueueDepthTest(TestCase):
+
+    def setUp(self):
+        super(CheckQueueDepthTest, self).setUp()
+        self.check = load_check("check_haproxy_queue_depth")
+        self.records = haproxy_stats.parse_stat(QUEUE_STAT,
+                                                self.check.STAT_FIELDS)
+        self.thresholds = {
+            "queue": self.check.parse_thresholds(",0"),
+            "max_queue": self.check.parse_thresholds(",100"),
+            "saturation": self.check.parse_thresholds("80,95"),
+            "rate_headroom": self.check.parse_thresholds("20,5"),
+            }
+
+    def test_reports_every_proxy_in_trouble(self):
+        status, messages, _ = self.check.check_proxies(self.records,
+                                                       self.thresholds)
+
+        self.assertEqual(nagios_plugin.CRITICAL, status)
+        self.assertEqual(
+            ["api_be max queue depth 150 (CRITICAL)",
+             "web_frontend session saturation 95% (WARNING)",
+             "web_frontend session rate headroom 10% (WARNING)",
+             "web_be queue depth 4 (CRITICAL)"],
+            messages)
+
+    def test_perfdata(self):
+        _, _, perfdata = self.check.check_proxies(self.records,
+                                                  self.thresholds)
+
+        self.assertEqual(
+            ["'api_be_qcur'=0;;0;0;",
+             "'api_be_qmax'=150;;100;0;",
+             "'api_be_saturation'=5%;80;95;0;100",
+             "'web_frontend_saturation'=95%;80;95;0;100",
+             "'web_frontend_rate_headroom'=10%;20;5;0;100",
+             "'web_be_qcur'=4;;0;0;",
+             "'web_be_qmax'=12;;100;0;",
+             "'web_be_saturation'=50%;80;95;0;100"],
+            perfdata)
+
+    def test_ok_within_thresholds(self):
+        self.thresholds["queue"] = self.check.parse_thresholds("5,10")
+        self.thresholds["max_queue"] = self.check.parse_thresholds("")
+        self.thresholds["saturation"] = self.check.parse_thresholds(",")
+        self.thresholds["rate_headroom"] = self.check.parse_thresholds(",5")
+
+        status, messages, _ = self.check.check_proxies(self.records,
+                                                       self.thresholds)
+
+        self.assertEqual(nagios_plugin.OK, status)
+        self.assertEqual([], messages)
+
+    @patch('sys.stdout')
+    @patch('haproxy_stats.send_command')
+    def test_main(self, send_command, stdout):
+        send_command.return_value = QUEUE_STAT
+
+        self.assertEqual(nagios_plugin.CRITICAL, self.check.main(
+            ["-s", "/some/socket", "--saturation=,"]))
+        send_command.assert_called_once_with("show stat", "/some/socket",
+                                             haproxy_stats.DEFAULT_TIMEOUT)
+
+    @patch('sys.stdout')
+    @patch('haproxy_stats.send_command')
+    def test_main_unknown_when_haproxy_is_down(self, send_command, stdout):
+        send_command.side_effect = socket.error("Connection refused")
+
+        self.assertEqual(nagios_plugin.UNKNOWN, self.check.main([]))
+
+
+LATENCY_SUMMARY = {
+    "generated": 1000,
+    "window": 300,
+    "backends": {
+        "api_be": {
+            "rate": 2.5,
+            "total": {"p95": 120.0, "p99": 2400.0},
+            "5xx_ratio": 0.0,
+            },
+        "db_be": {
+            "rate": 0.5,
+            "total": {"p95": 800.0, "p99": 900.0},
+            "5xx_ratio": None,
+            },
+        "web_be": {
+            "rate": 10.0,
+            "total": {"p95": 40.0, "p99": 60.0},
+            "5xx_ratio": 0.08,
+            },
+        },
+    }
+
+
+class CheckLatencyTest(TestCase):
+
+    def setUp(self):
+        super(CheckLatencyTest, self).setUp()
+        self.check = load_check("check_haproxy_latency")
+        self.thresholds = {
+            "p95": self.check.parse_thresholds("500,1000"),
+            "p99": self.check.parse_thresholds("1000,2000"),
+            "5xx": self.check.parse_thresholds("1,5"),
+            }
+
+    def write_summary(self, summary):
+        summary_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, summary_dir)
+        path = os.path.join(summary_dir, "summary.json")
+        with open(path, "w") as f:
+            json.dump(summary, f)
+        return path
+
+    def test_reports_every_backend_in_trouble(self):
+        status, messages, _ = self.check.check_summary(LATENCY_SUMMARY,
+                                                       self.thresholds)
+
+        self.assertEqual(nagios_plugin.CRITICAL, status)
+        self.assertEqual(["api_be p99 2400ms (CRITICAL)",
+                          "db_be p95 800ms (WARNING)",
+                          "web_be 5xx 8% (CRITICAL)"], messages)
+
+    def test_perfdata(self):
+        _, _, perfdata = self.check.check_summary(LATENCY_SUMMARY,
+                                                  self.thresholds)
+
+        self.assertEqual(
+            ["'db_be_p95'=800ms;500;1000;0;",
+             "'db_be_p99'=900ms;1000;2000;0;",
+             "'db_be_rate'=0.5;;;0;"],
+            perfdata[4:7])
+
+    def test_ok_without_thresholds(self):
+        thresholds = dict((metric, self.check.parse_thresholds(""))
+                          for metric in ("p95", "p99", "5xx"))
+
+        status, messages, _ = self.check.check_summary(LATENCY_SUMMARY,
+                                                       thresholds)
+
+        self.assertEqual(nagios_plugin.OK, status)
+        self.assertEqual([], messages)
+
+    @patch('sys.stdout')
+    def test_main(self, stdout):
+        path = self.write_summary(LATENCY_SUMMARY)
+
+        self.assertEqual(nagios_plugin.WARNING, self.check.main(
+            ["-f", path, "--p95=500,1000", "--5xx=5,10"],
+            clock=lambda: 1060))
+
+    @patch('sys.stdout')
+    def test_main_unknown_when_summary_is_stale(self, stdout):
+        path = self.write_summary(LATENCY_SUMMARY)
+
+        self.assertEqual(nagios_plugin.UNKNOWN, self.check.main(
+            ["-f", path], clock=lambda: 1200))
+
+    @patch('sys.stdout')
+    def test_main_unknown_without_summary(self, stdout):
+        self.assertEqual(nagios_plugin.UNKNOWN, self.check.main(
+            ["-f", "/nonexistent/summary.json"]))
+
+
+SLO_STAT = (
+    "# pxname,svname,stot,type,hrsp_2xx,hrsp_5xx,rtime,ttime,\n"
+    "web,FRONTEND,500,0,480,20,,,\n"
+    "web_be,BACKEND,%d,1,%d,%d,%d,%d,\n"
+    "api_be,BACKEND,%d,1,%d,%d,%d,%d,\n")
+
+
+def slo_stat(web_be, api_be):
+    return SLO_STAT % (web_be + api_be)
+
+
+class CheckSLOTest(TestCase):
+
+    def setUp(self):
+        super(CheckSLOTest, self).setUp()
+        self.check = load_check("check_haproxy_slo")
+        state_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, state_dir)
+        self.state = os.path.join(state_dir, "slo.json")
+
+    def test_takes_backend_samples(self):
+        records = haproxy_stats.parse_stat(
+            slo_stat((100, 90, 10, 20, 40), (50, 50, 0, 5, 8)))
+
+        self.assertEqual({"web_be": [100, 100, 10, 20, 40],
+                          "api_be": [50, 50, 0, 5, 8]},
+                         self.check.take_sample(records))
+
+    def test_keeps_one_sample_before_the_window(self):
+        samples = []
+        for now in (0, 300, 600, 900, 1200):
+            samples = self.check.add_sample(samples, now, {}, 600)
+
+        self.assertEqual([600, 900, 1200], [now for now, _ in samples])
+
+    def test_weights_average_times_by_requests(self):
+        samples = [
+            [0, {"web_be": [100, 100, 0, 10, 20]}],
+            [300, {"web_be": [400, 400, 30, 100, 200]}],
+            [600, {"web_be": [500, 500, 30, 20, 40],
+                   "api_be": [5, 5, 0, 1, 1]}],
+            ]
+
+        stats = self.check.window_stats(samples)
+
+        self.assertEqual({"web_be": {"requests": 400,
+                                     "response_time": 80.0,
+                                     "total_time": 160.0,
+                                     "5xx": 7.5}}, stats)
+
+    def test_counters_reset_on_reload(self):
+        samples = [[0, {"web_be": [1000, 1000, 100, 10, 20]}],
+                   [300, {"web_be": [50, 50, 5, 10, 20]}]]
+
+        self.assertEqual(50, self.check.window_stats(samples)
+                         ["web_be"]["requests"])
+
+    def test_idle_backend_has_no_metrics(self):
+        samples = [[0, {"web_be": [100, 100, 0, 10, 20]}],
+                   [300, {"web_be": [100, 100, 0, 10, 20]}]]
+
+        self.assertEqual({"web_be": {"requests": 0, "response_time": None,
+                                     "total_time": None, "5xx": None}},
+                         self.check.window_stats(samples))
+
+    def test_checks_backend_thresholds(self):
+        stats = {"web_be": {"requests": 400, "response_time": 80.0,
+                            "total_time": 160.0, "5xx": 7.5},
+                 "api_be": {"requests": 10, "response_time": 5.0,
+                            "total_time": 9.0, "5xx": 0.0}}
+        thresholds = {
+            "response_time": {"web_be": (None, (50.0, False))},
+            "total_time": {},
+            "5xx": self.check.parse_backend_thresholds(["web_be=1,10",
+                                                        "api_be=1,5"]),
+            }
+
+        status, messages, perfdata = self.check.check_backends(stats,
+                                                               thresholds)
+
+        self.assertEqual(nagios_plugin.CRITICAL, status)
+        self.assertEqual(
+            ["web_be average response time 80ms (CRITICAL)",
+             "web_be 5xx ratio 7.5% (WARNING)"], messages)
+        self.assertEqual(
+            ["'api_be_response_time'=5ms;;;0;",
+             "'api_be_total_time'=9ms;;;0;",
+             "'api_be_5xx'=0%;1;5;0;100",
+             "'web_be_response_time'=80ms;;50;0;",
+             "'web_be_total_time'=160ms;;;0;",
+             "'web_be_5xx'=7.5%;1;10;0;100"], perfdata)
+
+    @patch('sys.stdout')
+    @patch('haproxy_stats.send_command')
+    def test_main(self, send_command, stdout):
+        args = ["-s", "/some/socket", "-f", self.state,
+                "-R", "web_be=50,100", "-E", "api_be=1,5"]
+        send_command.return_value = slo_stat((100, 100, 0, 10, 20),
+                                             (10, 10, 0, 5, 5))
+
+        self.assertEqual(nagios_plugin.OK,
+                         self.check.main(args, clock=lambda: 0))
+
+        send_command.return_value = slo_stat((200, 200, 0, 80, 90),
+                                             (20, 19, 1, 5, 5))
+
+        self.assertEqual(nagios_plugin.CRITICAL,
+                         self.check.main(args, clock=lambda: 300))
+        with open(self.state) as f:
+            self.assertEqual([0, 300],
+                             [now for now, _ in json.load(f)["samples"]])
+
+    @patch('sys.stdout')
+    @patch('haproxy_stats.send_command')
+    def test_main_unknown_when_haproxy_is_down(self, send_command, stdout):
+        send_command.side_effect = socket.error("Connection refused")
+
+        self.assertEqual(nagios_plugin.UNKNOWN,
+                         self.check.main(["-f", self.state]))
+        self.assertFalse(os.path.exists(self.state))
@@ -1,3 +1,6 @@
+import grp
+import pwd
+
 from testtools import TestCase
 from mock import call, patch, MagicMock
 
@@ -6,9 +9,29 @@ import hooks
 
 class NRPEHooksTest(TestCase):
 
+    @patch('hooks.config_get')
+    @patch('hooks.get_config_services')
     @patch('hooks.install_nrpe_scripts')
     @patch('charmhelpers.contrib.charmsupport.nrpe.NRPE')
-    def test_update_nrpe_config(self, nrpe, install_nrpe_scripts):
+    def test_update_nrpe_config(self, nrpe, install_nrpe_scripts,
+                                get_config_services, config_get):
+        config_get.return_value = {
+            "nagios_queue_thresholds": ",0",
+            "nagios_max_queue_thresholds": "50,100",
+            "nagios_saturation_thresholds": "",
+            "nagios_rate_headroom_thresholds": "20,5",
+            "nagios_slo_window": 900,
+            "latency_window": 0,
+            }
+        get_config_services.return_value = {
+            None: {"service_name": "foo"},
+            "foo": {"service_name": "foo",
+                    "down_thresholds": {"warning": 1, "critical": "50%"}},
+            "bar": {"service_name": "bar",
+                    "slo": {"response_time": {"warning": 200,
+                                              "critical": 500},
+                            "5xx": {"critical": 5}}},
+            }
         nrpe_compat = MagicMock()
         nrpe_compat.checks = [MagicMock(shortname="haproxy"),
                               MagicMock(shortname="haproxy_queue")]
@@ -18,7 +41,77 @@ class NRPEHooksTest(TestCase):
 
         self.assertEqual(
             nrpe_compat.mock_calls,
-            [call.add_check('haproxy', 'Check HAProxy', 'check_haproxy.sh'),
+            [call.add_check('haproxy', 'Check HAProxy',
+                            'check_haproxy.py -b foo=1,50% -b foo_be=1,50%'),
              call.add_check('haproxy_queue', 'Check HAProxy queue depth',
-                            'check_haproxy_queue_depth.sh'),
+                            'check_haproxy_queue_depth.py --queue=,0 '
+                            '--max-queue=50,100 --rate-headroom=20,5'),
+             call.add_check('haproxy_slo', 'Check HAProxy backend SLOs',
+                            'check_haproxy_slo.py --window=900 '
+                            '-R bar=200,500 -R bar_be=200,500 '
+                            '-E bar=,5 -E bar_be=,5'),
              call.write()])
+
+    @patch('hooks.config_get')
+    @patch('hooks.get_config_services')
+    @patch('hooks.install_nrpe_scripts')
+    @patch('charmhelpers.contrib.charmsupport.nrpe.NRPE')
+    def test_update_nrpe_config_with_latency_check(
+            self, nrpe, install_nrpe_scripts, get_config_services,
+            config_get):
+        config_get.return_value = {
+            "latency_window": 300,
+            "nagios_latency_p95_thresholds": "500,1000",
+            "nagios_latency_p99_thresholds": "",
+            "nagios_latency_5xx_thresholds": "1,5",
+            }
+        get_config_services.return_value = {
+            None: {"service_name": "foo"},
+            "foo": {"service_name": "foo"},
+            }
+        nrpe_compat = MagicMock()
+        nrpe.return_value = nrpe_compat
+
+        hooks.update_nrpe_config()
+
+        self.assertIn(
+            call.add_check('haproxy_latency',
+                           'Check HAProxy backend latencies',
+                           'check_haproxy_latency.py --p95=500,1000 '
+                           '--5xx=1,5'),
+            nrpe_compat.mock_calls)
+
+    @patch('hooks.service_restart')
+    @patch('hooks.service_running')
+    @patch('hooks.add_user_to_group')
+    @patch('grp.getgrnam')
+    @patch('pwd.getpwnam')
+    def test_grants_stats_socket_access_and_restarts_nrpe(
+            self, getpwnam, getgrnam, add_user_to_group, service_running,
+            service_restart):
+        getpwnam.return_value = pwd.struct_passwd(
+            ("nagios", "x", 110, 110, "", "/var/lib/nagios", "/bin/false"))
+        getgrnam.return_value = grp.struct_group(
+            ("haproxy", "x", 120, ["foo"]))
+        service_running.return_value = True
+
+        hooks.grant_stats_socket_access("nagios", "haproxy")
+
+        add_user_to_group.assert_called_once_with("nagios", "haproxy")
+        service_restart.assert_called_once_with("nagios-nrpe-server")
+
+    @patch('hooks.service_restart')
+    @patch('hooks.add_user_to_group')
+    @patch('grp.getgrnam')
+    @patch('pwd.getpwnam')
+    def test_doesnt_grant_stats_socket_access_twice(
+            self, getpwnam, getgrnam, add_user_to_group, service_restart):
+        getpwnam.return_value = pwd.struct_passwd(
+            ("nagios", "x", 110, 110, "", "/var/lib/nagios", "/bin/false"))
+        getgrnam.return_value = grp.struct_group(
+            ("haproxy", "x", 120, ["foo", "nagios"]))
+
+        hooks.grant_stats_socket_access("nagios", "haproxy")
+
+        self.assertFalse(add_user_to_group.called)
+        self.assertFalse(service_restart.called)
@@ -131,6 +131,71 @@ class PeerRelationTest(TestCase):
             }
         self.assertEqual(expected, hooks.apply_peer_config(services_dict))
 
+    @patch.dict(os.environ, {"JUJU_UNIT_NAME": "haproxy/2"})
+    def test_moves_rate_limit_to_peer_service(self):
+        self.unit_get.return_value = "1.2.4.5"
+        self.relations_of_type.return_value = [
+            {"__unit__": "haproxy/1",
+             "hostname": "haproxy-1",
+             "private-address": "1.2.4.4",
+             "all_services": yaml.dump([
+                 {"service_name": "foo_service",
+                  "service_host": "0.0.0.0",
+                  "service_port": 4242},
+                 ])
+             }
+            ]
+
+        services_dict = {
+            "foo_service": {
+                "service_name": "foo_service",
+                "service_host": "0.0.0.0",
+                "service_port": 4242,
+                "service_options": ["balance leastconn"],
+                "rate_limit": {"conn_cur": 10},
+                "servers": [("backend_1__8080", "1.2.3.4",
+                             8080, ["maxconn 4"])],
+                },
+            }
+
+        result = hooks.apply_peer_config(services_dict)
+        self.assertEqual({"conn_cur": 10},
+                         result["foo_service"]["rate_limit"])
+        self.assertNotIn("rate_limit", result["foo_service_be"])
+        self.assertFalse(self.log.called)
+
+    @patch.dict(os.environ, {"JUJU_UNIT_NAME": "haproxy/2"})
+    def test_warns_http_req_rate_is_not_applied_with_peers(self):
+        self.unit_get.return_value = "1.2.4.5"
+        self.relations_of_type.return_value = [
+            {"__unit__": "haproxy/1",
+             "hostname": "haproxy-1",
+             "private-address": "1.2.4.4",
+             "all_services": yaml.dump([
+                 {"service_name": "foo_service",
+                  "service_host": "0.0.0.0",
+                  "service_port": 4242},
+                 ])
+             }
+            ]
+        services_dict = {
+            "foo_service": {
+                "service_name": "foo_service",
+                "service_host": "0.0.0.0",
+                "service_port": 4242,
+                "service_options": ["balance leastconn"],
+                "rate_limit": {"conn_cur": 10, "http_req_rate": 100},
+                "servers": [("backend_1__8080", "1.2.3.4",
+                             8080, ["maxconn 4"])],
+                },
+            }
+
+        hooks.apply_peer_config(services_dict)
+
+        self.log.assert_called_once_with(
+            "WARNING: http_req_rate of service 'foo_service' is not applied "
+            "with peers, only its conn_cur limit is.")
+
     @patch.dict(os.environ, {"JUJU_UNIT_NAME": "haproxy/2"})
     def test_with_no_relation_data(self):
         self.unit_get.return_value = "1.2.4.5"
@@ -196,7 +261,7 @@ class PeerRelationTest(TestCase):
 
                 create_listen_stanza.assert_called_with(
                     'bar', 'some-host', 'some-port', 'some-options',
-                    (1, 2), [])
+                    (1, 2), [], None)
                 mock_open.assert_called_with(
                     '/var/run/haproxy/bar.service', 'w')
                 mock_file.write.assert_called_with('some content')
@@ -232,3 +297,33 @@ class PeerRelationTest(TestCase):
                     '/var/lib/haproxy/service_bar/403.http', 'w')
                 mock_file.write.assert_any_call(content)
         self.assertTrue(create_listen_stanza.called)
+
+    @patch('hooks.create_listen_stanza')
+    def test_writes_rate_limit_allowlist(self, create_listen_stanza):
+        create_listen_stanza.return_value = 'some content'
+        rate_limit = {'conn_cur': 10,
+                      'allowlist': ['10.0.0.0/8', '192.168.0.0/16']}
+        services_dict = {
+            'foo': {
+                'service_name': 'bar',
+                'service_host': 'some-host',
+                'service_port': 'some-port',
+                'service_options': 'some-options',
+                'servers': (1, 2),
+                'rate_limit': rate_limit,
+            },
+        }
+
+        with patch.object(os.path, "exists") as exists:
+            exists.return_value = True
+            with patch_open() as (mock_open, mock_file):
+                hooks.write_service_config(services_dict)
+
+                mock_open.assert_any_call(
+                    '/var/lib/haproxy/service_bar/rate_limit_allowlist.acl',
+                    'w')
+                mock_file.write.assert_any_call(
+                    '10.0.0.0/8\n192.168.0.0/16\n')
+        create_listen_stanza.assert_called_with(
+            'bar', 'some-host', 'some-port', 'some-options',
+            (1, 2), [], rate_limit)
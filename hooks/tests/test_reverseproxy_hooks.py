@@ -1,3 +1,6 @@
+import copy
+import json
+import re
 import yaml
 
 from testtools import TestCase
@@ -19,6 +22,17 @@ class ReverseProxyRelationTest(TestCase):
         self.write_service_config = self.patch_hook("write_service_config")
         self.apply_peer_config = self.patch_hook("apply_peer_config")
         self.apply_peer_config.side_effect = lambda value: value
+        self.allocate_server_ids = self.patch_hook("allocate_server_ids")
+        self.allocate_server_ids.side_effect = lambda value: value
+        services = patch.dict(hooks.hook_services, clear=True)
+        services.start()
+        self.addCleanup(services.stop)
+        self.charm_state = {}
+        self.patch_hook("load_charm_state").side_effect = (
+            lambda key, default=None: copy.deepcopy(
+                self.charm_state.get(key, default)))
+        self.patch_hook("save_charm_state").side_effect = (
+            self.charm_state.__setitem__)
 
     def patch_hook(self, hook_name):
         mock_controller = patch.object(hooks, hook_name)
@@ -135,6 +149,27 @@ class ReverseProxyRelationTest(TestCase):
         self.assertEqual(expected, hooks.create_services())
         self.write_service_config.assert_called_with(expected)
 
+    def test_created_services_are_kept_for_the_hook(self):
+        self.get_config_services.return_value = {
+            None: {
+                "service_name": "service",
+                },
+            "service": {
+                "service_name": "service",
+                "servers": [
+                    ("legacy-backend", "1.2.3.1", 4242, ["maxconn 42"]),
+                    ]
+                },
+            }
+        self.relations_of_type.return_value = []
+
+        services = hooks.create_services()
+        self.relations_of_type.reset_mock()
+
+        self.assertIs(services, hooks.get_services())
+        self.relations_of_type.assert_not_called()
+        self.write_service_config.assert_called_once_with(services)
+
     def test_relation_default_service(self):
         self.get_config_services.return_value = {
             None: {
@@ -348,6 +383,85 @@ class ReverseProxyRelationTest(TestCase):
         self.assertEqual(expected, hooks.create_services())
         self.write_service_config.assert_called_with(expected)
 
+    def test_with_agent_port(self):
+        self.get_config_services.return_value = {
+            None: {
+                "service_name": "service",
+                },
+            "service": {
+                "service_name": "service",
+                "server_options": ["maxconn 4"],
+                "agent_inter": "5s",
+                },
+            }
+        self.relations_of_type.return_value = [
+            {"port": 4242,
+             "hostname": "backend.1",
+             "private-address": "1.2.3.4",
+             "agent-port": "4243",
+             "__unit__": "foo/0"},
+            {"port": 4242,
+             "hostname": "backend.2",
+             "private-address": "1.2.3.5",
+             "__unit__": "foo/1"},
+        ]
+
+        expected = {
+            'service': {
+                'service_name': 'service',
+                'service_host': '0.0.0.0',
+                'service_port': 10002,
+                'server_options': ["maxconn 4"],
+                'agent_inter': "5s",
+                'servers': [
+                    ('foo-0-4242', '1.2.3.4', 4242,
+                     ["maxconn 4",
+                      "agent-check agent-port 4243 agent-inter 5s"]),
+                    ('foo-1-4242', '1.2.3.5', 4242, ["maxconn 4"]),
+                    ],
+                },
+            }
+        self.assertEqual(expected, hooks.create_services())
+
+    def test_with_dns_resolvers(self):
+        self.config_get.return_value = {"monitoring_port": "10000",
+                                        "dns_resolvers": "resolv.conf"}
+        self.get_config_services.return_value = {
+            None: {
+                "service_name": "service",
+                },
+            "service": {
+                "service_name": "service",
+                "server_options": ["maxconn 4"],
+                },
+            }
+        self.relations_of_type.return_value = [
+            {"port": 4242,
+             "hostname": "backend.1",
+             "private-address": "1.2.3.4",
+             "__unit__": "foo/0"},
+            {"port": 4242,
+             "hostname": "1.2.3.5",
+             "private-address": "1.2.3.5",
+             "__unit__": "foo/1"},
+        ]
+
+        expected = {
+            'service': {
+                'service_name': 'service',
+                'service_host': '0.0.0.0',
+                'service_port': 10002,
+                'server_options': ["maxconn 4"],
+                'servers': [
+                    ('foo-0-4242', 'backend.1', 4242,
+                     ["maxconn 4",
+                      "resolvers dns init-addr last,libc,none"]),
+                    ('foo-1-4242', '1.2.3.5', 4242, ["maxconn 4"]),
+                    ],
+                },
+            }
+        self.assertEqual(expected, hooks.create_services())
+
     def test_with_multiple_units_in_relation(self):
         """
         Have multiple units specifying "services" in the relation.
@@ -421,3 +535,507 @@ class ReverseProxyRelationTest(TestCase):
 
         expected = {'service_name': 'left', 'foo': 'bar', 'bar': 'baz'}
         self.assertEqual(expected, hooks.merge_service(s1, s2))
+
+    def test_apply_hash_config_without_hash_type(self):
+        """ Services without a 'hash_type' are left untouched. """
+        services_dict = {
+            "service": {
+                "service_name": "service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, ["maxconn 4"])],
+                },
+            }
+        expected = {
+            "service": {
+                "service_name": "service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, ["maxconn 4"])],
+                },
+            }
+        self.assertEqual(expected, hooks.apply_hash_config(services_dict))
+
+    def test_apply_hash_config(self):
+        """
+        Servers of a hashed service get an explicit weight, and the
+        hash-type is added to the service options.
+        """
+        server_options = ["maxconn 4"]
+        services_dict = {
+            "service": {
+                "service_name": "service",
+                "service_options": ["balance uri"],
+                "hash_type": "consistent",
+                "server_weight": 10,
+                "servers": [
+                    ("foo-0-4242", "1.2.3.4", 4242, server_options),
+                    ("foo-1-4242", "1.2.3.5", 4242, server_options),
+                    ],
+                },
+            }
+
+        expected = {
+            "service": {
+                "service_name": "service",
+                "service_options": ["balance uri", "hash-type consistent"],
+                "hash_type": "consistent",
+                "server_weight": 10,
+                "servers": [
+                    ("foo-0-4242", "1.2.3.4", 4242,
+                     ["maxconn 4", "weight 10"]),
+                    ("foo-1-4242", "1.2.3.5", 4242,
+                     ["maxconn 4", "weight 10"]),
+                    ],
+                },
+            }
+        self.assertEqual(expected, hooks.apply_hash_config(services_dict))
+        self.assertEqual(["maxconn 4"], server_options)
+
+    def test_apply_health_checks(self):
+        """
+        The health check policy of a service applies to every server, and
+        an existing 'check' option isn't repeated.
+        """
+        services_dict = {
+            "service": {
+                "service_name": "service",
+                "service_options": ["balance leastconn"],
+                "health_check": {
+                    "uri": "/health", "version": "HTTP/1.1",
+                    "expect": "status 200", "inter": "2s",
+                    "fastinter": "500ms", "downinter": "5s",
+                    "rise": 2, "fall": 3},
+                "servers": [
+                    ("foo-0-4242", "1.2.3.4", 4242, ["maxconn 4"]),
+                    ["legacy", "1.2.3.1", 4242, "check inter 10s"],
+                    ],
+                },
+            }
+
+        checks = ["inter 2s", "fastinter 500ms", "downinter 5s", "rise 2",
+                  "fall 3", "observe layer7", "on-error mark-down"]
+        expected = {
+            "service": {
+                "service_name": "service",
+                "service_options": ["balance leastconn",
+                                    "option httpchk GET /health HTTP/1.1",
+                                    "http-check expect status 200"],
+                "health_check": services_dict["service"]["health_check"],
+                "servers": [
+                    ("foo-0-4242", "1.2.3.4", 4242,
+                     ["maxconn 4", "check"] + checks),
+                    ["legacy", "1.2.3.1", 4242,
+                     ["check inter 10s"] + checks],
+                    ],
+                },
+            }
+        self.assertEqual(expected, hooks.apply_health_checks(services_dict))
+
+    def test_apply_health_checks_with_tcp_default_mode(self):
+        """
+        Services in tcp mode, including by default, only get layer4 checks.
+        """
+        self.config_get.return_value = {"default_mode": "tcp"}
+        services_dict = {
+            "tcp": {"service_name": "tcp",
+                    "health_check": {"uri": "/health", "expect": "status 200"},
+                    "servers": [("foo-0-4242", "1.2.3.4", 4242, [])]},
+            "http": {"service_name": "http",
+                     "service_options": ["mode http"],
+                     "health_check": {"uri": "/health"},
+                     "servers": [("foo-0-4242", "1.2.3.4", 4242, [])]},
+            }
+
+        services_dict = hooks.apply_health_checks(services_dict)
+
+        self.assertEqual([], services_dict["tcp"]["service_options"])
+        self.assertEqual(
+            [("foo-0-4242", "1.2.3.4", 4242,
+              ["check", "observe layer4", "on-error mark-down"])],
+            services_dict["tcp"]["servers"])
+        self.assertEqual(["mode http", "option httpchk GET /health"],
+                         services_dict["http"]["service_options"])
+
+    def test_is_http_mode(self):
+        self.assertTrue(hooks.is_http_mode([], {}))
+        self.assertFalse(hooks.is_http_mode([], {"default_mode": "tcp"}))
+        self.assertTrue(hooks.is_http_mode([" mode http"],
+                                           {"default_mode": "tcp"}))
+        self.assertFalse(hooks.is_http_mode(["mode tcp"],
+                                            {"default_mode": "http"}))
+
+    def test_create_health_check_options_in_tcp_mode(self):
+        """ TCP services only get layer4 checks. """
+        self.assertEqual(
+            ([], ["check", "fall 2", "observe layer4", "error-limit 5",
+                  "on-error fastinter"]),
+            hooks.create_health_check_options(
+                {"uri": "/health", "fall": 2, "error_limit": 5,
+                 "on_error": "fastinter"}, http_mode=False))
+
+    def test_create_health_check_options_without_observe(self):
+        self.assertEqual(
+            (["option httpchk HEAD /"], ["check"]),
+            hooks.create_health_check_options(
+                {"method": "HEAD", "uri": "/", "observe": False}))
+
+    def test_apply_check_tracking(self):
+        """
+        Servers checked in several backends are only checked in the first
+        one, and tracked in the others.
+        """
+        checks = ["maxconn 4", "check inter 2s", "rise 2", "observe layer7"]
+        services_dict = {
+            "b_service": {
+                "service_name": "b_service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, checks),
+                            ("foo-1-4242", "1.2.3.5", 4242, checks)],
+                },
+            "a_service": {
+                "service_name": "a_service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, checks)],
+                },
+            "c_service": {
+                "service_name": "c_service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, ["maxconn 4"])],
+                },
+            }
+
+        expected = {
+            "b_service": {
+                "service_name": "b_service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242,
+                             ["maxconn 4", "track a_service/foo-0-4242"]),
+                            ("foo-1-4242", "1.2.3.5", 4242, checks)],
+                },
+            "a_service": {
+                "service_name": "a_service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, checks)],
+                },
+            "c_service": {
+                "service_name": "c_service",
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, ["maxconn 4"])],
+                },
+            }
+        self.assertEqual(expected, hooks.apply_check_tracking(services_dict))
+
+    def test_apply_check_tracking_with_different_checks(self):
+        """
+        Servers checked differently in several backends keep their own
+        checks, since the state of one check doesn't tell the other.
+        """
+        checks = ["check inter 2s", "rise 2"]
+        services_dict = {
+            "a_service": {
+                "service_name": "a_service",
+                "service_options": ["option httpchk GET /a"],
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, checks)],
+                },
+            "b_service": {
+                "service_name": "b_service",
+                "service_options": ["option httpchk GET /b"],
+                "servers": [("foo-0-4242", "1.2.3.4", 4242, checks)],
+                },
+            "c_service": {
+                "service_name": "c_service",
+                "service_options": ["option httpchk GET /a"],
+                "servers": [("foo-0-4242", "1.2.3.4", 4242,
+                             ["check inter 5s", "rise 2"])],
+                },
+            }
+        expected = copy.deepcopy(services_dict)
+
+        self.assertEqual(expected, hooks.apply_check_tracking(services_dict))
+
+    def test_get_check_signature(self):
+        service = {"service_options": ["balance leastconn",
+                                       "option httpchk GET /",
+                                       "http-check expect status 200",
+                                       "option forwardfor"]}
+        server = ("foo-0-4242", "1.2.3.4", 4242,
+                  ["maxconn 4", "check port 8080 inter 2s", "fall 3"])
+
+        self.assertEqual(
+            (("option httpchk GET /", "http-check expect status 200"),
+             ("check", "fall 3", "inter 2s", "port 8080")),
+            hooks.get_check_signature(service, server))
+
+    def test_remove_check_options(self):
+        self.assertEqual(
+            ["maxconn 4", "agent-check agent-port 4243", "weight 10"],
+            hooks.remove_check_options(
+                ["maxconn 4", "check", "inter 2s fall 3",
+                 "agent-check agent-port 4243", "weight 10",
+                 "observe layer7 error-limit 10 on-error mark-down"]))
+
+    def test_escapes_log_format(self):
+        self.assertEqual(
+            r'{\"request\":%{+Q}r,\ \"path\":\ \"a\\b\#c\'\"}',
+            hooks.escape_log_format(
+                '{"request":%{+Q}r, "path": "a\\b#c\'"}'))
+
+    def test_create_log_format_option_from_preset(self):
+        option = hooks.create_log_format_option("json")
+
+        self.assertTrue(option.startswith(
+            r'log-format {\"timestamp\":%Ts.%ms,\"client_ip\":\"%ci\",'))
+        self.assertIn(r'\"Tq\":%Tq,\"Tw\":%Tw,\"Tc\":%Tc,', option)
+        self.assertIn(r',\"uri\":%{+Q}[capture.req.uri,json(utf8s)],', option)
+        self.assertTrue(option.endswith(r',\"version\":\"%HV\"}'))
+        self.assertNotIn(" ", option[len("log-format "):])
+
+    def test_json_log_format_renders_valid_json(self):
+        """
+        Lines logged with the json format are valid JSON, whatever the URI:
+        haproxy's json converter escapes it, the other fields being numbers
+        or tokens.
+        """
+        uri = '/x?a[]=1&b="\\"'
+        for log_format in hooks.log_format_presets["json"]:
+            line = log_format.replace(
+                "%{+Q}[capture.req.uri,json(utf8s)]", json.dumps(uri))
+            line = re.sub(r"%\w+", "1", line)
+
+            record = json.loads(line)
+
+            self.assertEqual(uri, record.get("uri", uri))
+
+    def test_create_log_format_option_in_tcp_mode(self):
+        self.assertNotIn("%Tr", hooks.create_log_format_option(
+            "json", http_mode=False))
+        self.assertIsNone(hooks.create_log_format_option(
+            "extended-clf", http_mode=False))
+
+    def test_create_custom_log_format_option(self):
+        self.assertEqual(
+            r"log-format %ci\ %b/%s\ %Tr",
+            hooks.create_log_format_option("%ci %b/%s %Tr"))
+
+    def test_apply_log_format(self):
+        """
+        Services get the default log format unless they set their own, or
+        disable it.
+        """
+        self.config_get.return_value = {"log_format": "timing-only"}
+        services_dict = {
+            "default": {"service_name": "default"},
+            "custom": {"service_name": "custom",
+                       "log_format": "%ci %Tt"},
+            "tcp": {"service_name": "tcp",
+                    "service_options": ["mode tcp"]},
+            "disabled": {"service_name": "disabled",
+                         "log_format": ""},
+            "explicit": {"service_name": "explicit",
+                         "service_options": ["log-format %ci"]},
+            }
+
+        services_dict = hooks.apply_log_format(services_dict)
+
+        self.assertEqual(
+            [hooks.create_log_format_option("timing-only")],
+            services_dict["default"]["service_options"])
+        self.assertEqual([r"log-format %ci\ %Tt"],
+                         services_dict["custom"]["service_options"])
+        self.assertEqual(
+            ["mode tcp",
+             hooks.create_log_format_option("timing-only", False)],
+            services_dict["tcp"]["service_options"])
+        self.assertNotIn("service_options", services_dict["disabled"])
+        self.assertEqual(["log-format %ci"],
+                         services_dict["explicit"]["service_options"])
+
+    def test_apply_log_format_with_tcp_default_mode(self):
+        self.config_get.return_value = {"log_format": "json",
+                                        "default_mode": "tcp"}
+        services_dict = {"tcp": {"service_name": "tcp"}}
+
+        services_dict = hooks.apply_log_format(services_dict)
+
+        self.assertEqual(
+            [hooks.create_log_format_option("json", False)],
+            services_dict["tcp"]["service_options"])
+
+
+class ServerIdAllocationTest(TestCase):
+
+    def setUp(self):
+        super(ServerIdAllocationTest, self).setUp()
+        self.state = {}
+        self.load_charm_state = self.patch_hook("load_charm_state")
+        self.load_charm_state.side_effect = (
+            lambda key, default=None: self.state.get(key, default))
+        self.save_charm_state = self.patch_hook("save_charm_state")
+        self.save_charm_state.side_effect = self.state.__setitem__
+
+    def patch_hook(self, hook_name):
+        mock_controller = patch.object(hooks, hook_name)
+        mock = mock_controller.start()
+        self.addCleanup(mock_controller.stop)
+        return mock
+
+    def allocate(self, *servers, **kwargs):
+        backend = kwargs.get("backend", "service")
+        services_dict = {
+            "service": {
+                "service_name": backend,
+                "servers": [(name, "1.2.3.4", 4242, ["maxconn 4"])
+                            for name in servers],
+                },
+            }
+        result = hooks.allocate_server_ids(services_dict)
+        return dict((server[0], hooks.get_server_id(server))
+                    for server in result["service"]["servers"])
+
+    def test_allocates_ids_in_order(self):
+        self.assertEqual({"foo-0": 1, "foo-1": 2, "foo-2": 3},
+                         self.allocate("foo-0", "foo-1", "foo-2"))
+
+    def test_keeps_server_options(self):
+        services_dict = {
+            "service": {
+                "service_name": "service",
+                "servers": [("foo-0", "1.2.3.4", 4242, "maxconn 4")],
+                },
+            }
+        result = hooks.allocate_server_ids(services_dict)
+        self.assertEqual([("foo-0", "1.2.3.4", 4242, ["maxconn 4", "id 1"])],
+                         result["service"]["servers"])
+
+    def test_ids_survive_earlier_server_leaving(self):
+        self.allocate("foo-0", "foo-1", "foo-2")
+        self.assertEqual({"foo-1": 2, "foo-2": 3},
+                         self.allocate("foo-1", "foo-2"))
+
+    def test_released_ids_are_not_reused_right_away(self):
+        self.allocate("foo-0", "foo-1")
+        self.allocate("foo-1")
+        self.assertEqual({"foo-1": 2, "foo-2": 3},
+                         self.allocate("foo-1", "foo-2"))
+
+    def test_returning_server_gets_its_id_back(self):
+        self.allocate("foo-0", "foo-1")
+        self.allocate("foo-1")
+        self.allocate("foo-1", "foo-2")
+        self.assertEqual({"foo-0": 1, "foo-1": 2, "foo-2": 3},
+                         self.allocate("foo-0", "foo-1", "foo-2"))
+
+    def test_released_ids_are_recycled_past_the_reserve(self):
+        reserve = hooks.released_server_ids_reserve
+        names = ["old-%d" % i for i in range(reserve + 1)]
+        self.allocate(*names)
+        self.allocate()
+        self.assertEqual({"new-0": 1}, self.allocate("new-0"))
+
+    def test_explicit_ids_are_respected(self):
+        services_dict = {
+            "service": {
+                "service_name": "service",
+                "servers": [("foo-0", "1.2.3.4", 4242, ["id 1"]),
+                            ("foo-1", "1.2.3.5", 4242, [])],
+                },
+            }
+        result = hooks.allocate_server_ids(services_dict)
+        self.assertEqual([("foo-0", "1.2.3.4", 4242, ["id 1"]),
+                          ("foo-1", "1.2.3.5", 4242, ["id 2"])],
+                         result["service"]["servers"])
+
+    def test_duplicate_names_get_distinct_ids(self):
+        services_dict = {
+            "service": {
+                "service_name": "service",
+                "servers": [("foo-0", "1.2.3.4", 4242, []),
+                            ("foo-0", "1.2.3.5", 4242, [])],
+                },
+            }
+        result = hooks.allocate_server_ids(services_dict)
+        self.assertEqual([("foo-0", "1.2.3.4", 4242, ["id 1"]),
+                          ("foo-0", "1.2.3.5", 4242, ["id 2"])],
+                         result["service"]["servers"])
+
+    def test_forgets_removed_backends(self):
+        self.allocate("foo-0", backend="old")
+        self.allocate("foo-0", backend="new")
+        self.assertEqual(["new"], self.state["server_ids"].keys())
+
+
+class ServicePortAllocationTest(TestCase):
+
+    def setUp(self):
+        super(ServicePortAllocationTest, self).setUp()
+        self.state = {}
+        self.load_charm_state = self.patch_hook("load_charm_state")
+        self.load_charm_state.side_effect = (
+            lambda key, default=None: copy.deepcopy(
+                self.state.get(key, default)))
+        self.save_charm_state = self.patch_hook("save_charm_state")
+        self.save_charm_state.side_effect = self.state.__setitem__
+        self.config_get = self.patch_hook("config_get")
+        self.config_get.return_value = {"monitoring_port": "10000"}
+        self.time = self.patch_hook("time")
+        self.time.time.return_value = 1000
+
+    def patch_hook(self, hook_name):
+        mock_controller = patch.object(hooks, hook_name)
+        mock = mock_controller.start()
+        self.addCleanup(mock_controller.stop)
+        return mock
+
+    def allocate(self, *names, **explicit_ports):
+        services = dict((name, {"service_name": name}) for name in names)
+        for name, port in explicit_ports.iteritems():
+            services[name] = {"service_name": name, "service_host": "0.0.0.0",
+                              "service_port": port}
+        result = hooks.ensure_service_host_port(services)
+        return dict((name, service["service_port"])
+                    for name, service in result.iteritems()
+                    if name not in explicit_ports)
+
+    def test_allocates_ports_in_order(self):
+        self.assertEqual({"bar": 10002, "foo": 10004},
+                         self.allocate("foo", "bar"))
+
+    def test_allocates_ports_from_highest_explicit_port(self):
+        self.assertEqual({"bar": 8082, "foo": 8084},
+                         self.allocate("foo", "bar", explicit=8080))
+        self.assertEqual({"bar": 8082, "foo": 8084},
+                         self.allocate("foo", "bar", explicit=4242))
+
+    def test_ports_survive_other_services_coming_and_going(self):
+        self.allocate("bar", "foo")
+        self.assertEqual({"aaa": 10006, "bar": 10002, "foo": 10004},
+                         self.allocate("aaa", "bar", "foo"))
+        self.assertEqual({"foo": 10004}, self.allocate("foo"))
+
+    def test_released_ports_cool_down_before_reuse(self):
+        self.allocate("bar", "foo")
+        self.allocate("foo")
+        self.assertEqual({"baz": 10006, "foo": 10004},
+                         self.allocate("baz", "foo"))
+
+        self.time.time.return_value += hooks.released_service_port_cooldown
+        self.allocate("foo")
+        self.assertEqual({"foo": 10004, "qux": 10002},
+                         self.allocate("foo", "qux"))
+
+    def test_returning_service_gets_its_port_back(self):
+        self.allocate("bar", "foo")
+        self.allocate("foo")
+        self.assertEqual({"bar": 10002, "foo": 10004},
+                         self.allocate("bar", "foo"))
+        self.assertEqual([], self.state["service_ports"]["released"])
+
+    def test_explicit_ports_take_over_allocated_ones(self):
+        self.allocate("bar", "foo")
+        self.assertEqual({"foo": 10006},
+                         self.allocate("foo", explicit=10004))
+
+    def test_allocated_ports_avoid_peer_ports_of_explicit_ones(self):
+        """
+        The port after an explicit one is used by the peer backend of its
+        service, so allocated ports move away from it.
+        """
+        self.allocate("bar", "foo")
+        self.assertEqual({"foo": 10005},
+                         self.allocate("foo", explicit=10003))
+
+    def test_allocated_peer_ports_avoid_explicit_ones(self):
+        self.allocate("bar", "foo")
+        self.assertEqual({"bar": 10002, "foo": 10007},
+                         self.allocate("bar", "foo", explicit=10005))
@@ -1,8 +1,14 @@
+import copy
+import hashlib
+import yaml
+
 from testtools import TestCase
 from mock import patch, call
 
 import hooks
 
+EMPTY_DIGEST = hashlib.sha1("").hexdigest()
+
 
 class WebsiteRelationTest(TestCase):
 
@@ -40,10 +46,19 @@ class NotifyRelationTest(TestCase):
         self.relations_for_id = self.patch_hook("relations_for_id")
         self.relation_set = self.patch_hook("relation_set")
         self.config_get = self.patch_hook("config_get")
+        self.config_get.return_value = {"services": ""}
         self.get_relation_ids = self.patch_hook("get_relation_ids")
         self.get_hostname = self.patch_hook("get_hostname")
         self.log = self.patch_hook("log")
-        self.get_config_service = self.patch_hook("get_config_service")
+        services = patch.dict(hooks.hook_services, clear=True)
+        services.start()
+        self.addCleanup(services.stop)
+        self.charm_state = {}
+        self.patch_hook("load_charm_state").side_effect = (
+            lambda key, default=None: copy.deepcopy(
+                self.charm_state.get(key, default)))
+        self.patch_hook("save_charm_state").side_effect = (
+            self.charm_state.__setitem__)
 
     def patch_hook(self, hook_name):
         mock_controller = patch.object(hooks, hook_name)
@@ -69,7 +84,8 @@ class NotifyRelationTest(TestCase):
         self.relations_for_id.assert_called_once_with(None)
         self.relation_set.assert_called_once_with(
             relation_id=None, port="80", hostname="foo.local",
-            all_services="")
+            all_services="", all_services_digest=EMPTY_DIGEST,
+            all_services_encoding="")
         self.get_relation_ids.assert_not_called()
 
     def test_notify_website_relation_with_relations(self):
@@ -90,9 +106,11 @@ class NotifyRelationTest(TestCase):
 
         self.relation_set.assert_has_calls([
             call(relation_id="website:1", port="80", hostname="foo.local",
-                 all_services=""),
+                 all_services="", all_services_digest=EMPTY_DIGEST,
+                 all_services_encoding=""),
             call(relation_id="website:2", port="80", hostname="foo.local",
-                 all_services=""),
+                 all_services="", all_services_digest=EMPTY_DIGEST,
+                 all_services_encoding=""),
             ])
 
     def test_notify_website_relation_with_different_sitenames(self):
@@ -113,7 +131,8 @@ class NotifyRelationTest(TestCase):
         self.relation_set.assert_has_calls([
             call.relation_set(
                 relation_id="website:1", port="80", hostname="foo.local",
-                all_services=""),
+                all_services="", all_services_digest=EMPTY_DIGEST,
+                all_services_encoding=""),
             ])
         self.log.assert_has_calls([
             call.log(
@@ -128,22 +147,171 @@ class NotifyRelationTest(TestCase):
         self.relations_for_id.return_value = [{"service_name": "bar"},
                                               {"service_name": "bar"}]
         self.config_get.return_value = {"services": ""}
-        self.get_config_service.return_value = {"service_host": "bar.local",
-                                                "service_port": "4242"}
+        # The port of the service may have been allocated by the charm, or
+        # the service may come from a relation.
+        hooks.hook_services["services"] = {
+            "bar": {"service_name": "bar", "service_host": "0.0.0.0",
+                    "service_port": 10002}}
 
         hooks.notify_relation("website")
 
         self.get_hostname.assert_has_calls([
             call(),
-            call("bar.local")])
+            call("0.0.0.0")])
         self.get_relation_ids.assert_called_once_with("website")
         self.relations_for_id.assert_has_calls([
             call("website:1"),
             ])
 
-        self.relation_set.assert_has_calls([
-            call.relation_set(
-                relation_id="website:1", port="4242", hostname="bar.local",
-                all_services=""),
-            ])
+        settings = self.relation_set.call_args[1]
+        self.assertEqual(("website:1", "10002", "bar.local"),
+                         (settings["relation_id"], settings["port"],
+                          settings["hostname"]))
         self.log.assert_not_called()
+
+    def test_notify_website_relation_with_unknown_sitename(self):
+        self.get_relation_ids.return_value = ("website:1",)
+        self.get_hostname.return_value = "foo.local"
+        self.relations_for_id.return_value = [{"service_name": "bar"}]
+        hooks.hook_services["services"] = {"foo": {"service_name": "foo"}}
+
+        hooks.notify_relation("website")
+
+        settings = self.relation_set.call_args[1]
+        self.assertEqual(("80", "foo.local"),
+                         (settings["port"], settings["hostname"]))
+        self.log.assert_called_once_with(
+            "Service 'bar' is not configured. "
+            "Falling back to default host/port.")
+
+    def test_notify_relation_reuses_services_of_the_hook(self):
+        self.get_relation_ids.side_effect = {
+            "website": ("website:1", "website:2"),
+            "peer": ("peer:1",)}.get
+        self.get_hostname.return_value = "foo.local"
+        self.relations_for_id.return_value = [{}]
+        services = {"foo": {"service_name": "foo", "service_port": 4242}}
+        hooks.hook_services["services"] = services
+
+        with patch.object(hooks, "build_services") as build_services:
+            hooks.notify_website()
+            hooks.notify_peer()
+
+        self.assertFalse(build_services.called)
+        all_services = yaml.safe_dump([services["foo"]])
+        digest = hashlib.sha1(all_services).hexdigest()
+        self.relation_set.assert_has_calls([
+            call(relation_id=rid, port="80", hostname="foo.local",
+                 all_services=all_services, all_services_digest=digest,
+                 all_services_encoding="")
+            for rid in ("website:1", "website:2", "peer:1")])
+
+    @patch('hooks.write_service_config')
+    @patch('hooks.build_services')
+    def test_notify_relation_builds_services_once(self, build_services,
+                                                  write_service_config):
+        self.get_relation_ids.side_effect = {
+            "website": ("website:1", "website:2"),
+            "peer": ("peer:1",)}.get
+        self.get_hostname.return_value = "foo.local"
+        self.relations_for_id.return_value = [{}]
+        build_services.return_value = {"foo": {"service_name": "foo"}}
+
+        hooks.notify_website()
+        hooks.notify_peer()
+
+        build_services.assert_called_once_with()
+        self.assertFalse(write_service_config.called)
+        self.assertEqual(3, self.relation_set.call_count)
+
+    def test_notify_relation_skips_unchanged_relations(self):
+        self.get_relation_ids.return_value = ("website:1", "website:2")
+        self.get_hostname.return_value = "foo.local"
+        self.relations_for_id.return_value = [{}]
+        hooks.hook_services["services"] = {"foo": {"service_name": "foo"}}
+
+        hooks.notify_website()
+        self.relation_set.reset_mock()
+        hooks.notify_website()
+
+        self.relation_set.assert_not_called()
+        self.log.assert_has_calls([
+            call("Relation website:1 is up to date, not setting it."),
+            call("Relation website:2 is up to date, not setting it.")])
+
+        hooks.hook_services.clear()
+        hooks.hook_services["services"] = {"bar": {"service_name": "bar"}}
+        hooks.notify_website(relation_ids=("website:2",))
+
+        self.relation_set.assert_called_once_with(
+            relation_id="website:2", port="80", hostname="foo.local",
+            all_services=yaml.safe_dump([{"service_name": "bar"}]),
+            all_services_digest=hashlib.sha1(yaml.safe_dump(
+                [{"service_name": "bar"}])).hexdigest(),
+            all_services_encoding="")
+
+    def test_notify_relation_forgets_departed_relations(self):
+        self.get_relation_ids.return_value = ("website:2",)
+        self.relations_for_id.return_value = [{}]
+        self.get_hostname.return_value = "foo.local"
+        self.charm_state["published_relations"] = {
+            "website:1": "foo", "website:2": "bar", "peer:1": "baz"}
+
+        hooks.notify_website()
+
+        self.assertEqual(["peer:1", "website:2"],
+                         sorted(self.charm_state["published_relations"]))
+        self.assertEqual(1, self.relation_set.call_count)
+
+    @patch.dict('hooks.hook_services', clear=True)
+    def test_compresses_large_published_services(self):
+        services = dict(("service%d" % index, {"service_name": "service%d" %
+                                               index, "service_port": index})
+                        for index in range(100))
+        hooks.hook_services["services"] = services
+        self.config_get.return_value = {"all_services_compress_size": 1024}
+
+        settings = hooks.get_published_services()
+
+        self.assertEqual("zlib+base64", settings["all_services_encoding"])
+        self.assertLess(len(settings["all_services"]), 1024)
+        all_services = hooks.get_relation_services(settings)
+        self.assertEqual(sorted(services.values()), yaml.safe_load(
+            all_services))
+        self.assertEqual(hashlib.sha1(all_services).hexdigest(),
+                         settings["all_services_digest"])
+
+    @patch.dict('hooks.hook_services', clear=True)
+    def test_clears_encoding_when_services_are_no_longer_compressed(self):
+        self.get_relation_ids.return_value = ("website:1",)
+        self.relations_for_id.return_value = [{}]
+        self.get_hostname.return_value = "foo.local"
+        services = dict(("service%d" % index, {"service_name": "service%d" %
+                                               index, "service_port": index})
+                        for index in range(100))
+        hooks.hook_services["services"] = services
+        self.config_get.return_value = {"all_services_compress_size": 1024}
+
+        hooks.notify_website()
+        self.assertEqual(
+            "zlib+base64",
+            self.relation_set.call_args[1]["all_services_encoding"])
+
+        hooks.hook_services.clear()
+        hooks.hook_services["services"] = {"foo": {"service_name": "foo"}}
+        hooks.notify_website()
+
+        settings = self.relation_set.call_args[1]
+        self.assertEqual("", settings["all_services_encoding"])
+        self.assertEqual([{"service_name": "foo"}],
+                         yaml.safe_load(hooks.get_relation_services(settings)))
+
+    def test_skips_services_that_cant_be_decoded(self):
+        settings = {"__unit__": "haproxy/1",
+                    "all_services": "- service_name: foo\n",
+                    "all_services_encoding": "zlib+base64"}
+
+        self.assertIsNone(hooks.get_relation_services(settings))
+        self.log.assert_called_once_with(
+            "Can't decode the services of 'haproxy/1', skipping: "
+            "Incorrect padding")